@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# One request per line, either a bare command ("stats") or a JSON object
+# ({"command": "stats"}); one JSON line comes back per request:
+# {"ok": true, "result": {...}} or {"ok": false, "error": "..."}.
+Command = Callable[[dict], dict]
+_MAX_REQUEST_BYTES = 4096
+
+
+class AdminServer:
+    # Local control socket. Only the owner can connect (mode 0600), which is
+    # the only access control; nothing here is reachable over the network.
+
+    def __init__(self, path: str, commands: Dict[str, Command]) -> None:
+        self.path = path
+        self._logger = logging.getLogger("aredn_ldap_bridge.admin")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if os.path.exists(path):
+            # A socket left by a previous run; refuse to take over a live one.
+            if _is_listening(path):
+                raise OSError(f"admin socket {path} is in use")
+            os.unlink(path)
+        self._server = _AdminUnixServer(path, _AdminHandler)
+        self._server.commands = commands
+        self._server.logger = self._logger
+        os.chmod(path, 0o600)
+        self._thread = threading.Thread(target=self._server.serve_forever, name="admin", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+        self._logger.info("Admin socket listening on %s", self.path)
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def close_socket(self) -> None:
+        # For a forked child, which has the listening socket but no serving
+        # thread; the socket file belongs to the parent and stays.
+        self._server.server_close()
+
+
+class _AdminUnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    commands: Dict[str, Command] = {}
+    logger: logging.Logger
+
+
+class _AdminHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        while True:
+            line = self.rfile.readline(_MAX_REQUEST_BYTES + 1)
+            if not line:
+                return
+            if len(line) > _MAX_REQUEST_BYTES:
+                self._reply({"ok": False, "error": "request too long"})
+                return
+            if not line.strip():
+                continue
+            self._reply(self._dispatch(line))
+
+    def _dispatch(self, line: bytes) -> dict:
+        text = line.decode("utf-8", errors="replace").strip()
+        try:
+            request = json.loads(text) if text.startswith("{") else {"command": text}
+        except ValueError as exc:
+            return {"ok": False, "error": f"invalid JSON: {exc}"}
+        name = str(request.get("command", ""))
+        command = self.server.commands.get(name)
+        if command is None:
+            return {"ok": False, "error": f"unknown command {name!r}", "commands": sorted(self.server.commands)}
+        self.server.logger.info("Admin command %s", name)
+        try:
+            return {"ok": True, "result": command(request)}
+        except Exception as exc:
+            self.server.logger.exception("Admin command %s failed", name)
+            return {"ok": False, "error": str(exc)}
+
+    def _reply(self, response: dict) -> None:
+        self.wfile.write(json.dumps(response, default=_json_default).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+
+def build_commands(
+    cache,
+    extra_stats: Optional[Callable[[], dict]] = None,
+    after_refresh: Optional[Callable[[], None]] = None,
+) -> Dict[str, Command]:
+    # `extra_stats` adds what only the caller knows (connections, workers);
+    # `after_refresh` runs once a forced refresh has finished.
+    def stats(request: dict) -> dict:
+        result = {"cache": cache.status(), "upstream": _node_health(cache.node_status())}
+        if extra_stats is not None:
+            result.update(extra_stats())
+        return result
+
+    def refresh(request: dict) -> dict:
+        started = time.monotonic()
+        cache.force_refresh()
+        if after_refresh is not None:
+            after_refresh()
+        status = cache.status()
+        return {
+            "generation": status["generation"],
+            "entries": status["entries"],
+            "elapsed_seconds": round(time.monotonic() - started, 3),
+        }
+
+    def drop_caches(request: dict) -> dict:
+        return {"dropped": cache.drop_caches()}
+
+    def dump(request: dict) -> dict:
+        # The entries searches currently see, without triggering a refresh.
+        generation, refreshed_at = cache.snapshot_info()
+        return {
+            "generation": generation,
+            "refreshed_at": refreshed_at,
+            "views": {
+                key: [
+                    {"dn": entry.dn, "uid": entry.uid, "cn": entry.cn, "telephoneNumber": entry.telephone_number}
+                    for entry in entries
+                ]
+                for key, entries in cache.current_views().items()
+            },
+        }
+
+    return {"stats": stats, "refresh": refresh, "drop-caches": drop_caches, "dump": dump}
+
+
+def send_command(path: str, command: str, timeout_seconds: float = 30.0) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout_seconds)
+        sock.connect(path)
+        sock.sendall(json.dumps({"command": command}).encode("utf-8") + b"\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if chunk.endswith(b"\n"):
+                break
+    if not chunks:
+        raise OSError("admin socket closed without a response")
+    return json.loads(b"".join(chunks).decode("utf-8"))
+
+
+def _node_health(status: Dict[str, float]) -> Dict[str, Optional[float]]:
+    # Seconds since each node last answered; null if it never has.
+    return {node: round(age, 3) if age == age else None for node, age in status.items()}
+
+
+def _is_listening(path: str) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def _json_default(value) -> str:
+    return str(value)
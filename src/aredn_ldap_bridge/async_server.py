@@ -0,0 +1,296 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Set
+
+from .cache import LazyCache
+from .config import Config, LiveConfig
+from .limits import ConnectionLimiter
+from .ldap_protocol import build_notice_of_disconnection, encode_ldap_message, peek_ldap_op_tag
+from .ldap_server import ABANDON_OP_TAG, MAX_QUEUED_OPERATIONS, UNBIND_OP_TAG, LDAPSession, tune_socket
+
+_SEARCH_OP_TAG = "1:1:3"
+# Encoded responses handed back from the executor per round trip to the loop.
+_RESPONSE_BATCH = 64
+
+
+class AsyncLDAPServer:
+    # asyncio engine: one coroutine per connection instead of one OS thread.
+    # Exposes the same serve_forever/shutdown/server_close surface as the
+    # socketserver engine so cli.py can drive either one.
+
+    def __init__(self, live: LiveConfig, cache: LazyCache) -> None:
+        config = live.current
+        self._live = live
+        self._cache = cache
+        self._logger = logging.getLogger("aredn_ldap_bridge.async_server")
+        self.limiter = ConnectionLimiter(
+            config.max_connections, config.max_connections_per_ip, config.accept_queue_size
+        )
+        self._executor = ThreadPoolExecutor(thread_name_prefix="ldap-search")
+        self._socket = socket.create_server(
+            (config.listen_address, config.listen_port),
+            reuse_port=config.worker_processes > 1,
+        )
+        self.server_address = self._socket.getsockname()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stopping: asyncio.Event | None = None
+        self._slots: asyncio.Condition | None = None
+        # One task per open connection, so shutdown can end them.
+        self._connections: Set[asyncio.Task] = set()
+        self._shutdown_requested = False
+        self._stopped = threading.Event()
+
+    def serve_forever(self) -> None:
+        self._stopped.clear()
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self._stopped.set()
+
+    def shutdown(self) -> None:
+        self._shutdown_requested = True
+        loop = self._loop
+        if loop is not None and self._stopping is not None:
+            loop.call_soon_threadsafe(self._stopping.set)
+        self._stopped.wait()
+
+    def reload_limits(self, config: Config) -> None:
+        self.limiter.configure(config.max_connections, config.max_connections_per_ip, config.accept_queue_size)
+        loop = self._loop
+        if loop is not None and self._slots is not None:
+            asyncio.run_coroutine_threadsafe(self._notify_slots(), loop)
+
+    def server_close(self) -> None:
+        self._socket.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._slots = asyncio.Condition()
+        if self._shutdown_requested:
+            return
+        server = await asyncio.start_server(self._handle_connection, sock=self._socket)
+        try:
+            await self._stopping.wait()
+        finally:
+            server.close()
+            # wait_closed() also waits for open connections, and idle phones
+            # keep theirs open indefinitely, so end them first.
+            for task in list(self._connections):
+                task.cancel()
+            await asyncio.gather(*self._connections, return_exceptions=True)
+            await server.wait_closed()
+
+    async def _notify_slots(self) -> None:
+        async with self._slots:
+            self._slots.notify_all()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername") or ("unknown", 0)
+        ip = peer[0]
+        if not self.limiter.admit(ip):
+            writer.write(encode_ldap_message(build_notice_of_disconnection(51, "busy")))
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self._connections.add(task)
+        active = False
+        try:
+            # Admitted connections beyond max_connections wait here, unread.
+            async with self._slots:
+                await self._slots.wait_for(self.limiter.try_activate)
+            active = True
+            await self._serve_connection(reader, writer, ip)
+        finally:
+            self._connections.discard(task)
+            self.limiter.release(ip, active=active)
+            if active:
+                async with self._slots:
+                    self._slots.notify()
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, ip: str) -> None:
+        sock = writer.get_extra_info("socket")
+        config = self._live.current
+        if sock is not None:
+            tune_socket(sock, config)
+        session = LDAPSession(self._live, self._cache, ip)
+        operations: asyncio.Queue = asyncio.Queue()
+        # Held while an operation writes its responses, so two operations'
+        # responses never interleave.
+        send_lock = asyncio.Lock()
+        # Same ordering and queueing rules as the threaded engine: one task per
+        # operation allowed to run at once, the rest wait in `operations`.
+        pipeline_limit = max(1, int(config.pipeline_max_outstanding))
+        workers = [
+            asyncio.create_task(self._run_operations(session, operations, send_lock, writer))
+            for _ in range(pipeline_limit)
+        ]
+        refusals: Set[asyncio.Task] = set()
+
+        # Set when the client closed its side cleanly: operations already read
+        # still run and are answered before the connection is closed.
+        drain = False
+        try:
+            while True:
+                wait, reason = session.read_timeout()
+                if wait is not None and wait <= 0:
+                    self._logger.info("Closing connection from %s: %s timeout", ip, reason)
+                    self.limiter.record_close(reason)
+                    return
+                try:
+                    data = await asyncio.wait_for(reader.read(4096), wait)
+                except asyncio.TimeoutError:
+                    continue
+                if not data:
+                    drain = True
+                    return
+                try:
+                    messages = session.feed(data)
+                except ValueError:
+                    return
+
+                for message_id, op_bytes in messages:
+                    op_tag = peek_ldap_op_tag(op_bytes)
+                    if op_tag == ABANDON_OP_TAG:
+                        session.abandon(op_bytes)
+                        continue
+                    if op_tag == UNBIND_OP_TAG:
+                        session.unbind()
+                        return
+
+                    if session.in_flight() >= pipeline_limit + MAX_QUEUED_OPERATIONS:
+                        refusal = session.busy(message_id, op_bytes)
+                        if refusal is not None:
+                            # Written once no operation is mid-stream; the
+                            # reader keeps reading meanwhile.
+                            task = asyncio.create_task(self._write_locked(writer, send_lock, refusal))
+                            refusals.add(task)
+                            task.add_done_callback(refusals.discard)
+                        continue
+                    cancel = session.begin(message_id)
+                    if cancel is None:
+                        continue
+                    operations.put_nowait((message_id, op_bytes, cancel))
+        except (ConnectionError, OSError) as exc:
+            self._logger.info("Connection from %s closed: %s", session.client_address, exc)
+        finally:
+            if drain:
+                for _ in workers:
+                    operations.put_nowait(None)
+            else:
+                session.cancel_all()
+                for worker in workers:
+                    worker.cancel()
+            await asyncio.gather(*workers, *refusals, return_exceptions=True)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+    async def _run_operations(
+        self,
+        session: LDAPSession,
+        operations: asyncio.Queue,
+        send_lock: asyncio.Lock,
+        writer: asyncio.StreamWriter,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await operations.get()
+            if item is None:
+                return
+            message_id, op_bytes, cancel = item
+            try:
+                if cancel.is_set():
+                    continue
+                responses = session.responses(message_id, op_bytes, cancel)
+                if peek_ldap_op_tag(op_bytes) != _SEARCH_OP_TAG:
+                    # Bind and the refusal responses never block; answer inline.
+                    async with send_lock:
+                        for data in responses:
+                            writer.write(data)
+                        await self._drain(writer, session, self._write_deadline())
+                    continue
+                # Searches may wait on a cache refresh and do CPU-bound matching
+                # and encoding, so they are advanced on the executor in batches.
+                # Responses are written as they come, so abandon and timeLimit,
+                # checked between entries, stop a search on the wire. Matching
+                # runs before the first batch, outside the send lock.
+                batch = await loop.run_in_executor(self._executor, _next_batch, responses)
+                if not batch:
+                    continue
+                async with send_lock:
+                    deadline = self._write_deadline()
+                    while batch:
+                        for data in batch:
+                            writer.write(data)
+                        await self._drain(writer, session, deadline)
+                        batch = await loop.run_in_executor(self._executor, _next_batch, responses)
+            except (ConnectionError, OSError) as exc:
+                self._logger.info("Connection from %s closed while responding: %s", session.client_address, exc)
+            except Exception:
+                self._logger.exception("Failed to handle message_id=%s from %s", message_id, session.client_address)
+            finally:
+                session.end(message_id)
+
+    async def _write_locked(self, writer: asyncio.StreamWriter, send_lock: asyncio.Lock, data: bytes) -> None:
+        try:
+            async with send_lock:
+                writer.write(data)
+        except (ConnectionError, OSError):
+            pass
+
+    def _write_deadline(self) -> Optional[float]:
+        # Each operation gets `write_timeout_seconds` to hand over all of its
+        # responses, however many drains that takes.
+        timeout = self._live.current.write_timeout_seconds
+        return time.monotonic() + timeout if timeout > 0 else None
+
+    async def _drain(self, writer: asyncio.StreamWriter, session: LDAPSession, deadline: Optional[float]) -> None:
+        try:
+            if deadline is None:
+                await writer.drain()
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                await asyncio.wait_for(writer.drain(), remaining)
+        except asyncio.TimeoutError:
+            if not writer.transport.is_closing():
+                self._logger.info("Closing connection from %s: write timeout", session.client_address)
+                self.limiter.record_close("write_timeout")
+                session.cancel_all()
+                # Aborting also wakes the reader so the connection is torn down.
+                writer.transport.abort()
+            raise ConnectionError("write timeout")
+
+
+def _next_batch(responses: Iterator[bytes]) -> List[bytes]:
+    batch: List[bytes] = []
+    for data in responses:
+        batch.append(data)
+        if len(batch) >= _RESPONSE_BATCH:
+            break
+    return batch
+
+
+def create_async_server(live: LiveConfig, cache: LazyCache) -> AsyncLDAPServer:
+    logger = logging.getLogger("aredn_ldap_bridge.async_server")
+    config = live.current
+    server = AsyncLDAPServer(live, cache)
+    logger.info(
+        "LDAP server (asyncio) listening on %s:%s base_dn=%s",
+        config.listen_address,
+        config.listen_port,
+        config.base_dn,
+    )
+    return server
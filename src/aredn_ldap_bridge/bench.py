@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from .ldap_client import LDAPClient
+from .ldap_protocol import build_or_filter, build_search_request, build_substring_filter
+from .mock_sysinfo import MockSysinfoServer, build_services
+
+_BASE_DN = "dc=local,dc=mesh"
+_STARTUP_TIMEOUT_SECONDS = 15.0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="AREDN LDAP Bridge load benchmark (localhost only)")
+    parser.add_argument("--clients", type=int, default=20, help="Concurrent phone clients")
+    parser.add_argument("--sessions", type=int, default=20, help="Sessions per client")
+    parser.add_argument("--typeahead", type=int, default=3, help="Searches per session (one per keystroke)")
+    parser.add_argument("--client-processes", type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)))
+    parser.add_argument("--services", type=int, default=500, help="Phone services in the mock mesh")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded")
+    parser.add_argument("--worker-processes", type=int, default=1)
+    parser.add_argument("--idle-connections", type=int, default=0, help="Extra connections held open, unused")
+    parser.add_argument("--max-results", type=int, default=20)
+    parser.add_argument("--extra-config", action="append", default=[], help="Additional key=value bridge setting")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text + "\n")
+    else:
+        print(text)
+
+
+def run_benchmark(args: argparse.Namespace) -> Dict:
+    services = build_services(args.services, args.seed)
+    names = [service["name"].rsplit(" [", 1)[0] for service in services]
+    mock = MockSysinfoServer(services)
+    mock.start()
+    port = _free_port()
+    idle: List[socket.socket] = []
+    with tempfile.TemporaryDirectory(prefix="aredn-ldap-bench-") as work_dir:
+        config_path = os.path.join(work_dir, "bench.ini")
+        _write_config(config_path, args, port, mock.address, work_dir)
+        bridge = _start_bridge(config_path, work_dir)
+        try:
+            _wait_for_port(port, bridge)
+            # Prime the cache so the first upstream refresh is not measured.
+            _run_clients("127.0.0.1", port, 1, 1, 1, names, args.seed)
+            for _ in range(max(0, args.idle_connections)):
+                idle.append(socket.create_connection(("127.0.0.1", port)))
+
+            per_process = _split(args.clients, max(1, args.client_processes))
+            cpu_before = _tree_cpu_seconds(bridge.pid)
+            with ProcessPoolExecutor(max_workers=len(per_process)) as pool:
+                list(pool.map(_noop, range(len(per_process))))
+                started = time.perf_counter()
+                futures = [
+                    pool.submit(
+                        _run_clients,
+                        "127.0.0.1",
+                        port,
+                        clients,
+                        args.sessions,
+                        args.typeahead,
+                        names,
+                        args.seed + index + 1,
+                    )
+                    for index, clients in enumerate(per_process)
+                ]
+                results = [future.result() for future in futures]
+                elapsed = time.perf_counter() - started
+            cpu_after = _tree_cpu_seconds(bridge.pid)
+            memory = _tree_memory(bridge.pid)
+        finally:
+            for sock in idle:
+                sock.close()
+            bridge.terminate()
+            try:
+                bridge.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                bridge.kill()
+            mock.close()
+
+    latencies = sorted(latency for result in results for latency in result["latencies"])
+    searches = len(latencies)
+    sessions = sum(result["sessions"] for result in results)
+    cpu_seconds = None
+    if cpu_before is not None and cpu_after is not None:
+        cpu_seconds = round(cpu_after - cpu_before, 3)
+    return {
+        "config": {
+            "clients": args.clients,
+            "sessions_per_client": args.sessions,
+            "typeahead": args.typeahead,
+            "client_processes": len(per_process),
+            "services": args.services,
+            "engine": args.engine,
+            "worker_processes": args.worker_processes,
+            "idle_connections": args.idle_connections,
+            "max_results": args.max_results,
+            "extra_config": args.extra_config,
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "elapsed_seconds": round(elapsed, 3),
+        "sessions": sessions,
+        "searches": searches,
+        "entries": sum(result["entries"] for result in results),
+        "errors": sum(result["errors"] for result in results),
+        "searches_per_second": round(searches / elapsed, 1) if elapsed > 0 else 0.0,
+        "sessions_per_second": round(sessions / elapsed, 1) if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": _percentile_ms(latencies, 0.50),
+            "p95": _percentile_ms(latencies, 0.95),
+            "p99": _percentile_ms(latencies, 0.99),
+            "max": round(latencies[-1] * 1000, 3) if latencies else None,
+            "mean": round(sum(latencies) / searches * 1000, 3) if latencies else None,
+        },
+        "bridge": {
+            "cpu_seconds": cpu_seconds,
+            "cpu_percent": round(cpu_seconds / elapsed * 100, 1) if cpu_seconds is not None and elapsed > 0 else None,
+            **memory,
+        },
+    }
+
+
+def _run_clients(
+    host: str, port: int, clients: int, sessions: int, typeahead: int, names: List[str], seed: int
+) -> Dict:
+    # One thread per simulated phone. Each session mirrors an SPA-514G
+    # directory lookup: connect, anonymous bind, one search per keystroke of
+    # a name, unbind.
+    lock = threading.Lock()
+    totals = {"latencies": [], "sessions": 0, "entries": 0, "errors": 0}
+
+    def _phone(phone_seed: int) -> None:
+        rng = random.Random(phone_seed)
+        latencies: List[float] = []
+        completed = entries = errors = 0
+        for _ in range(sessions):
+            name = rng.choice(names)
+            word = rng.choice(name.split())
+            client: Optional[LDAPClient] = None
+            try:
+                client = LDAPClient(host, port)
+                client.bind()
+                for length in range(1, max(1, typeahead) + 1):
+                    result = client.search(_typeahead_request(word[:length]))
+                    latencies.append(result.latency_seconds)
+                    entries += result.entries
+                    if result.result_code not in (0, 4):
+                        errors += 1
+                completed += 1
+            except (OSError, ValueError):
+                errors += 1
+            finally:
+                if client is not None:
+                    client.unbind()
+        with lock:
+            totals["latencies"].extend(latencies)
+            totals["sessions"] += completed
+            totals["entries"] += entries
+            totals["errors"] += errors
+
+    threads = [threading.Thread(target=_phone, args=(seed * 100003 + index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return totals
+
+
+def _typeahead_request(prefix: str):
+    search_filter = build_or_filter(
+        [build_substring_filter("cn", prefix), build_substring_filter("telephoneNumber", prefix)]
+    )
+    return build_search_request(_BASE_DN, search_filter, attributes=["cn", "telephoneNumber"])
+
+
+def _noop(_: int) -> None:
+    return None
+
+
+def _write_config(path: str, args: argparse.Namespace, port: int, upstream: str, work_dir: str) -> None:
+    lines = [
+        "[aredn_ldap_bridge]",
+        "listen_address = 127.0.0.1",
+        f"listen_port = {port}",
+        f"base_dn = {_BASE_DN}",
+        f"upstream_nodes = {upstream}",
+        "cache_ttl_seconds = 3600",
+        f"max_results = {args.max_results}",
+        "log_level = WARNING",
+        f"server_engine = {args.engine}",
+        f"worker_processes = {args.worker_processes}",
+        f"max_connections = {max(256, args.clients + args.idle_connections + 16)}",
+        "max_connections_per_ip = 0",
+        f"state_dir = {work_dir}",
+    ]
+    for item in args.extra_config:
+        key, _, value = item.partition("=")
+        lines.append(f"{key.strip()} = {value.strip()}")
+    with open(path, "w", encoding="utf-8") as handle:
+        handle.write("\n".join(lines) + "\n")
+
+
+def _start_bridge(config_path: str, work_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src_dir, env.get("PYTHONPATH", "")]))
+    log = open(os.path.join(work_dir, "bridge.log"), "wb")
+    return subprocess.Popen(
+        [sys.executable, "-m", "aredn_ldap_bridge", "--config", config_path],
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+def _wait_for_port(port: int, bridge: subprocess.Popen) -> None:
+    deadline = time.monotonic() + _STARTUP_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if bridge.poll() is not None:
+            raise RuntimeError(f"bridge exited during startup with code {bridge.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("bridge did not start listening")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _split(total: int, parts: int) -> List[int]:
+    parts = max(1, min(parts, total))
+    return [total // parts + (1 if index < total % parts else 0) for index in range(parts)]
+
+
+def _percentile_ms(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return round(values[index] * 1000, 3)
+
+
+def _process_tree(pid: int) -> List[int]:
+    # The bridge plus any pre-fork workers, from /proc (Linux only).
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as handle:
+                fields = handle.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(entry))
+    tree = [pid]
+    for current in tree:
+        tree.extend(children.get(current, []))
+    return tree
+
+
+def _tree_cpu_seconds(pid: int) -> Optional[float]:
+    if not os.path.isdir("/proc"):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for member in _process_tree(pid):
+        try:
+            with open(f"/proc/{member}/stat", "r") as handle:
+                fields = handle.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def _tree_memory(pid: int) -> Dict[str, Optional[int]]:
+    if not os.path.isdir("/proc"):
+        return {"rss_bytes": None, "peak_rss_bytes": None, "processes": None}
+    rss = peak = 0
+    members = _process_tree(pid)
+    for member in members:
+        try:
+            with open(f"/proc/{member}/status", "r") as handle:
+                for line in handle:
+                    if line.startswith("VmRSS:"):
+                        rss += int(line.split()[1]) * 1024
+                    elif line.startswith("VmHWM:"):
+                        peak += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return {"rss_bytes": rss, "peak_rss_bytes": peak, "processes": len(members)}
+
+
+if __name__ == "__main__":
+    main()
@@ -3,77 +3,353 @@ from __future__ import annotations
 import logging
 import threading
 import time
-from typing import Callable, List
+from typing import Dict, List, Optional, Sequence, Tuple
 
-from .model import DirectoryEntry, entries_from_services
+from .config import ViewConfig
+from .matcher import forget_narrowing
+from .metrics import CACHE_REFRESHES, CACHE_REQUESTS, REFRESH_SECONDS
+from .model import DirectoryEntry, entries_from_services, index_by_uid, services_for_protocol
+from .overlay import StaticOverlay
 from .upstream import UpstreamClient
 
+# View key (normalized base DN) -> that view's entries. Replaced, never
+# mutated, so a reader can keep using the dict it was handed.
+Views = Dict[str, List[DirectoryEntry]]
+_NO_ENTRIES: List[DirectoryEntry] = []
+
 
 class LazyCache:
     def __init__(
         self,
         upstream: UpstreamClient,
-        base_dn: str,
+        views: Sequence[ViewConfig],
         ttl_seconds: int,
+        overlay_file: str = "",
+        ttl_max_seconds: int = 0,
     ) -> None:
+        # Every view is built from the same fetch; the first is the main view,
+        # which also carries the overlay.
         self._upstream = upstream
-        self._base_dn = base_dn
+        self._views = tuple(views)
+        # The effective TTL doubles with each refresh that finds upstream
+        # unchanged, up to the maximum, and drops back to `ttl_seconds` as soon
+        # as a refresh sees a change. With no maximum above `ttl_seconds` it
+        # stays fixed.
         self._ttl_seconds = max(1, int(ttl_seconds))
-        self._entries: List[DirectoryEntry] = []
+        self._ttl_max_seconds = max(self._ttl_seconds, int(ttl_max_seconds))
+        self._effective_ttl = self._ttl_seconds
+        self._fingerprint: Optional[int] = None
+        self._unchanged_streak = 0
+        self._changed_refreshes = 0
+        self._unchanged_refreshes = 0
+        self._overlay: Optional[StaticOverlay] = StaticOverlay(overlay_file) if overlay_file else None
+        # Serializes overlay file reads; merging happens under _lock.
+        self._overlay_lock = threading.Lock()
+        self._upstream_entries: Views = {}
+        # The main view is overlay entries followed by upstream entries, built
+        # once per change so searches never look at the overlay separately.
+        self._entries: Views = {}
+        # uid lookup for baseObject searches, built on first use for each
+        # entries dict it describes.
+        self._uid_index: Dict[str, Dict[str, DirectoryEntry]] = {}
+        self._uid_index_views: Optional[Views] = None
         self._last_refresh: float | None = None
+        self._generation = 0
+        self._refreshed_at = 0.0
+        # Bumped when a reload switches upstream source, so a refresh that
+        # started against the old source does not overwrite the new entries.
+        self._source_version = 0
         self._lock = threading.Lock()
         self._refreshing = False
         self._refresh_done = threading.Condition(self._lock)
         self._logger = logging.getLogger("aredn_ldap_bridge.cache")
 
-    def get_entries(self) -> List[DirectoryEntry]:
+    def get_entries(self, view_key: str) -> List[DirectoryEntry]:
+        # The list is shared and must not be modified; a refresh replaces it.
+        return self.get_views().get(view_key, _NO_ENTRIES)
+
+    def get_entries_generation(self, view_key: str) -> Tuple[List[DirectoryEntry], int]:
+        # The entries together with the generation they belong to.
+        self.get_views()
+        with self._lock:
+            return self._entries.get(view_key, _NO_ENTRIES), self._generation
+
+    def get_entry(self, view_key: str, uid: str) -> Optional[DirectoryEntry]:
+        views = self.get_views()
+        with self._lock:
+            if self._uid_index_views is not views:
+                self._uid_index = index_by_uid(views)
+                self._uid_index_views = views
+            index = self._uid_index
+        return index.get(view_key, {}).get(uid)
+
+    def get_views(self) -> Views:
         with self._lock:
             if self._is_fresh_locked():
-                return list(self._entries)
+                CACHE_REQUESTS.inc("hit")
+                return self._entries
 
             if self._refreshing:
+                CACHE_REQUESTS.inc("wait")
                 self._logger.info("Cache refresh in-flight; waiting")
                 self._refresh_done.wait(timeout=self._ttl_seconds)
-                return list(self._entries)
+                return self._entries
 
             self._refreshing = True
 
+        CACHE_REQUESTS.inc("miss")
         try:
-            refreshed = self._refresh()
+            return self._refresh()
         finally:
             with self._lock:
                 self._refreshing = False
                 self._refresh_done.notify_all()
 
-        return list(refreshed)
+    def reload_settings(
+        self,
+        upstream: UpstreamClient,
+        views: Sequence[ViewConfig],
+        ttl_seconds: int,
+        refetch: bool,
+        ttl_max_seconds: int = 0,
+    ) -> bool:
+        # Without `refetch` the cached entries stay valid and only the TTL and
+        # upstream client change. With it, the new source is fetched first
+        # while searches keep getting the current entries, and everything is
+        # swapped in together. Returns False if that pre-warm failed, in which
+        # case the cache is left stale so the next search refreshes.
+        if not refetch:
+            with self._lock:
+                self._upstream = upstream
+                self._set_ttl_locked(ttl_seconds, ttl_max_seconds)
+            return True
 
-    def reload_settings(self, upstream: UpstreamClient, base_dn: str, ttl_seconds: int) -> None:
         with self._lock:
+            self._source_version += 1
+            version = self._source_version
+        views = tuple(views)
+        self._reload_overlay(views[0].base_dn)
+        started = time.monotonic()
+        try:
+            entries = _build_views(upstream.fetch_services(), views)
+            fingerprint = _fingerprint(entries)
+        except Exception as exc:
+            self._logger.warning("Cache pre-warm failed; next search will refresh: %s", exc)
+            entries = None
+        finally:
+            REFRESH_SECONDS.observe(time.monotonic() - started)
+        with self._lock:
+            if version != self._source_version:
+                return False
             self._upstream = upstream
-            self._base_dn = base_dn
-            self._ttl_seconds = max(1, int(ttl_seconds))
+            self._views = views
+            self._set_ttl_locked(ttl_seconds, ttl_max_seconds)
+            # A new source starts over at the minimum TTL.
+            self._fingerprint = None
+            if entries is None:
+                self._last_refresh = None
+                return False
+            self._store_locked(entries, fingerprint)
+        self._logger.info("Cache pre-warmed from the new source: %s", _format_counts(entries))
+        return True
+
+    def set_overlay_file(self, overlay_file: str) -> bool:
+        # Called on config reload: switches to a new overlay path, or re-reads
+        # the current file if it changed. Returns True when the entries changed.
+        with self._lock:
+            current = self._overlay
+            base_dn = self._views[0].base_dn
+        if current is None and not overlay_file:
+            return False
+        if current is not None and current.path == overlay_file:
+            return self._reload_overlay(base_dn)
+        overlay = StaticOverlay(overlay_file) if overlay_file else None
+        if overlay is not None:
+            with self._overlay_lock:
+                overlay.reload(base_dn)
+        with self._lock:
+            self._overlay = overlay
+            self._merge_locked()
+            self._generation += 1
+        return True
+
+    def snapshot_info(self) -> Tuple[int, float]:
+        # Generation increments whenever the served entries change; refreshed_at
+        # is the wall-clock time of the last successful refresh, so it can be
+        # compared across processes.
+        with self._lock:
+            return self._generation, self._refreshed_at
+
+    def ttl_info(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "ttl_seconds": self._effective_ttl,
+                "ttl_min_seconds": self._ttl_seconds,
+                "ttl_max_seconds": self._ttl_max_seconds,
+                "unchanged_streak": self._unchanged_streak,
+                "changed_refreshes": self._changed_refreshes,
+                "unchanged_refreshes": self._unchanged_refreshes,
+            }
+
+    def node_status(self) -> Dict[str, float]:
+        with self._lock:
+            upstream = self._upstream
+        return upstream.node_status()
+
+    def current_views(self) -> Views:
+        # The entries searches see right now, without checking freshness.
+        with self._lock:
+            return self._entries
+
+    def force_refresh(self) -> Views:
+        # Treats the cache as expired; if a refresh is already running this
+        # waits for it instead of starting another.
+        with self._lock:
             self._last_refresh = None
+        return self.get_views()
+
+    def drop_caches(self) -> Dict[str, int]:
+        # Drops derived lookup state so it is rebuilt from scratch: the uid
+        # index on the next baseObject search, the overlay on the next refresh.
+        with self._lock:
+            dropped = {"uid_index": sum(len(index) for index in self._uid_index.values())}
+            self._uid_index = {}
+            self._uid_index_views = None
+            overlay = self._overlay
+        if overlay is not None:
+            with self._overlay_lock:
+                dropped["overlay_rows"] = overlay.forget()
+        return dropped
+
+    def status(self) -> Dict[str, object]:
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "generation": self._generation,
+                "refreshed_at": self._refreshed_at,
+                "age_seconds": round(now - self._last_refresh, 3) if self._last_refresh is not None else None,
+                "fresh": self._is_fresh_locked(),
+                "refreshing": self._refreshing,
+                "entries": sum(len(view) for view in self._entries.values()),
+                "views": {key: len(view) for key, view in self._entries.items()},
+                "overlay_entries": len(self._overlay.entries()) if self._overlay is not None else 0,
+                "uid_index": {key: len(index) for key, index in self._uid_index.items()},
+                "ttl": {
+                    "ttl_seconds": self._effective_ttl,
+                    "ttl_min_seconds": self._ttl_seconds,
+                    "ttl_max_seconds": self._ttl_max_seconds,
+                    "unchanged_streak": self._unchanged_streak,
+                },
+            }
 
     def _is_fresh_locked(self) -> bool:
         if self._last_refresh is None:
             return False
         age = time.monotonic() - self._last_refresh
-        return age < self._ttl_seconds
+        return age < self._effective_ttl
 
-    def _refresh(self) -> List[DirectoryEntry]:
+    def _refresh(self) -> Views:
         self._logger.info("Refreshing cache from upstream")
+        started = time.monotonic()
+        with self._lock:
+            upstream, views, version = self._upstream, self._views, self._source_version
+        # The overlay is only re-read when its file changed, so checking it
+        # with every refresh is a stat call. It is merged even if upstream
+        # then fails, so overlay entries are served while upstream is down.
+        self._reload_overlay(views[0].base_dn)
         try:
-            services = self._upstream.fetch_services()
-            entries = entries_from_services(services, self._base_dn)
+            entries = _build_views(upstream.fetch_services(), views)
+            fingerprint = _fingerprint(entries)
             with self._lock:
-                self._entries = entries
-                self._last_refresh = time.monotonic()
-            self._logger.info("Cache refresh succeeded with %s entries", len(entries))
-            return entries
+                if version != self._source_version:
+                    # A reload switched source mid-fetch; these entries are
+                    # from the old one.
+                    return self._entries
+                changed = self._store_locked(entries, fingerprint)
+                merged = self._entries
+                ttl, streak = self._effective_ttl, self._unchanged_streak
+            self._logger.info(
+                "Cache refresh succeeded with %s changed=%s ttl=%ss unchanged_streak=%s",
+                _format_counts(entries),
+                "yes" if changed else "no",
+                ttl,
+                streak,
+            )
+            return merged
         except Exception as exc:
             self._logger.warning("Cache refresh failed: %s", exc)
             with self._lock:
-                if self._entries:
-                    self._logger.info("Serving last-known-good cache (%s entries)", len(self._entries))
-                    return list(self._entries)
-            return []
+                if any(self._entries.values()):
+                    self._logger.info("Serving last-known-good cache: %s", _format_counts(self._entries))
+                return self._entries
+        finally:
+            REFRESH_SECONDS.observe(time.monotonic() - started)
+
+    def _reload_overlay(self, base_dn: str) -> bool:
+        with self._lock:
+            overlay = self._overlay
+        if overlay is None:
+            return False
+        with self._overlay_lock:
+            changed = overlay.reload(base_dn)
+        if changed:
+            with self._lock:
+                if overlay is self._overlay:
+                    self._merge_locked()
+                    self._generation += 1
+        return changed
+
+    def _merge_locked(self) -> None:
+        entries = dict(self._upstream_entries)
+        if self._overlay is not None:
+            main = self._views[0].key
+            entries[main] = self._overlay.entries() + entries.get(main, [])
+        self._entries = entries
+        forget_narrowing()
+
+    def _store_locked(self, entries: Views, fingerprint: int) -> bool:
+        # An unchanged refresh keeps the current lists and generation, so
+        # everything keyed on them (uid index, coalesced searches, typeahead
+        # memory, worker snapshots) stays valid; only freshness moves.
+        changed = fingerprint != self._fingerprint
+        self._fingerprint = fingerprint
+        if changed:
+            self._unchanged_streak = 0
+            self._changed_refreshes += 1
+            self._effective_ttl = self._ttl_seconds
+            self._upstream_entries = entries
+            self._merge_locked()
+            self._generation += 1
+        else:
+            self._unchanged_streak += 1
+            self._unchanged_refreshes += 1
+            self._effective_ttl = min(self._ttl_max_seconds, self._effective_ttl * 2)
+        CACHE_REFRESHES.inc("changed" if changed else "unchanged")
+        self._last_refresh = time.monotonic()
+        self._refreshed_at = time.time()
+        return changed
+
+    def _set_ttl_locked(self, ttl_seconds: int, ttl_max_seconds: int) -> None:
+        self._ttl_seconds = max(1, int(ttl_seconds))
+        self._ttl_max_seconds = max(self._ttl_seconds, int(ttl_max_seconds))
+        self._effective_ttl = max(self._ttl_seconds, min(self._effective_ttl, self._ttl_max_seconds))
+
+
+def _build_views(services: List[dict], views: Tuple[ViewConfig, ...]) -> Views:
+    return {
+        view.key: entries_from_services(services_for_protocol(services, view.protocol_filter), view.base_dn)
+        for view in views
+    }
+
+
+def _fingerprint(entries: Views) -> int:
+    # Order-independent, so a node listing the same services in another order
+    # does not count as a change.
+    return hash(frozenset(entry for view in entries.values() for entry in view))
+
+
+def _format_counts(entries: Views) -> str:
+    total = sum(len(view) for view in entries.values())
+    if len(entries) < 2:
+        return f"{total} entries"
+    return f"{total} entries (" + "; ".join(f"{key}: {len(view)}" for key, view in entries.items()) + ")"
@@ -1,15 +1,32 @@
 from __future__ import annotations
 
 import argparse
+from dataclasses import fields
+import json
 import logging
 import signal
+import sys
 import threading
 from typing import Optional
 
-from .config import load_config
+from .admin import AdminServer, build_commands, send_command
+from .async_server import AsyncLDAPServer, create_async_server
+from .config import (
+    Config,
+    LiveConfig,
+    load_config,
+    merge_reload,
+    resolve_state_dir,
+    source_changed,
+    upstream_client_changed,
+)
 from .cache import LazyCache
 from .ldap_server import create_server
-from .logging_setup import configure_logging
+from .logging_setup import configure_logging, dropped_log_records
+from .metrics import REGISTRY, register_cache_gauges, start_metrics_server
+from .peer import PeerSnapshotStore, PeerSyncClient, build_upstream, peer_store, start_peer_server
+from .prefork import run_prefork
+from .profiler import Profiler
 from .upstream import UpstreamClient
 
 
@@ -20,94 +37,236 @@ def build_parser() -> argparse.ArgumentParser:
         required=False,
         help="Path to INI config file (optional)",
     )
+    subparsers = parser.add_subparsers(dest="command")
+    ctl = subparsers.add_parser("ctl", help="Send a command to a running bridge's admin socket")
+    ctl.add_argument("action", choices=("stats", "refresh", "drop-caches", "dump"))
+    ctl.add_argument(
+        "--config",
+        default=argparse.SUPPRESS,
+        help="Path to INI config file; its admin_socket is used unless --socket is given",
+    )
+    ctl.add_argument("--socket", help="Path to the admin socket")
+    ctl.add_argument("--output", help="Write the response to this file instead of stdout")
+    ctl.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for a response")
     return parser
 
 
 def main() -> None:
     parser = build_parser()
     args = parser.parse_args()
+    if args.command == "ctl":
+        sys.exit(run_ctl(parser, args))
 
     config_path: Optional[str] = args.config
     config = load_config(config_path)
-    configure_logging(config.log_level)
+    configure_logging(config.log_level, config.log_queue_size)
 
-    upstream = UpstreamClient(
-        nodes=config.upstream_nodes,
-        timeout_seconds=config.upstream_timeout_seconds,
-        protocol_filter=config.protocol_filter,
-    )
-    cache = LazyCache(
-        upstream=upstream,
-        base_dn=config.base_dn,
-        ttl_seconds=config.cache_ttl_seconds,
-    )
     logger = logging.getLogger("aredn_ldap_bridge.cli")
     logger.info(
-        "Startup config listen=%s:%s base_dn=%s upstream_nodes=%s ttl=%s max_results=%s protocol_filter=%s",
+        "Startup config engine=%s workers=%s listen=%s:%s base_dn=%s upstream_nodes=%s upstream_mode=%s peer_nodes=%s peer_port=%s overlay=%s ttl=%s ttl_max=%s max_results=%s protocol_filter=%s views=%s",
+        config.server_engine,
+        config.worker_processes,
         config.listen_address,
         config.listen_port,
         config.base_dn,
         ",".join(config.upstream_nodes),
+        config.upstream_mode,
+        ",".join(config.peer_nodes) or "-",
+        config.peer_listen_port,
+        config.overlay_file or "-",
         config.cache_ttl_seconds,
+        config.cache_ttl_max_seconds,
         config.max_results,
         config.protocol_filter,
+        _format_views(config),
     )
 
-    server = create_server(config, cache)
+    if config.worker_processes > 1:
+        run_prefork(
+            config, config_path, lambda worker_config, cache: serve(worker_config, config_path, cache, is_worker=True)
+        )
+        return
+
+    store = peer_store(config)
+    upstream = build_upstream(config, store)
+    cache = LazyCache(
+        upstream=upstream,
+        views=config.all_views,
+        ttl_seconds=config.cache_ttl_seconds,
+        overlay_file=config.overlay_file,
+        ttl_max_seconds=config.cache_ttl_max_seconds,
+    )
+    serve(config, config_path, cache, store=store, upstream=upstream)
+
+
+def run_ctl(parser: argparse.ArgumentParser, args: argparse.Namespace) -> int:
+    path = args.socket or load_config(args.config).admin_socket
+    if not path:
+        parser.error("no admin socket: pass --socket or a config file that sets admin_socket")
+    try:
+        response = send_command(path, args.action, args.timeout)
+    except (OSError, ValueError) as exc:
+        print(f"admin socket {path}: {exc}", file=sys.stderr)
+        return 1
+    if not response.get("ok"):
+        print(f"{args.action} failed: {response.get('error')}", file=sys.stderr)
+        return 1
+    text = json.dumps(response["result"], indent=2, sort_keys=True) + "\n"
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as handle:
+            handle.write(text)
+    else:
+        sys.stdout.write(text)
+    return 0
+
+
+def serve(
+    config: Config,
+    config_path: Optional[str],
+    cache: LazyCache,
+    is_worker: bool = False,
+    store: Optional[PeerSnapshotStore] = None,
+    upstream: Optional[UpstreamClient | PeerSyncClient] = None,
+) -> None:
+    logger = logging.getLogger("aredn_ldap_bridge.cli")
+    # Peer sharing state and the upstream client the cache fetches through;
+    # never set in pre-fork workers, which do not fetch.
+    peers = {"store": store, "upstream": upstream}
+
+    live = LiveConfig(config)
+    if config.server_engine == "asyncio":
+        server = create_async_server(live, cache)
+    else:
+        server = create_server(live, cache)
+
+    metrics_server = None
+    if config.metrics_port > 0:
+        REGISTRY.gauge(
+            "aredn_ldap_connections_active", "Connections being served.", lambda: server.limiter.stats()["active"]
+        )
+        REGISTRY.gauge(
+            "aredn_ldap_connections_queued",
+            "Admitted connections waiting for a free slot.",
+            lambda: server.limiter.stats()["queued"],
+        )
+        REGISTRY.gauge("aredn_ldap_log_records_dropped", "Log records dropped on a full queue.", dropped_log_records)
+        register_cache_gauges(cache)
+        metrics_server = start_metrics_server(config.metrics_listen_address, config.metrics_port)
+
+    admin_server = None
+    if config.admin_socket and not is_worker:
+        # In pre-fork mode the supervisor serves the admin socket.
+        admin_server = AdminServer(
+            config.admin_socket, build_commands(cache, lambda: {"connections": server.limiter.stats()})
+        )
+        admin_server.start()
+
+    peer_server = None
+    if store is not None and config.peer_listen_port > 0:
+        peer_server = start_peer_server(
+            config.peer_listen_address, config.peer_listen_port, store, cache.get_views
+        )
+
+    profiler = Profiler(
+        resolve_state_dir(config),
+        config.profile_window_seconds,
+        config.profile_sample_interval_ms / 1000.0,
+    )
+    if config.server_engine == "asyncio":
+        profiler.register_stage("send", AsyncLDAPServer._drain)
+    else:
+        profiler.register_stage("send", server.RequestHandlerClass._send)
 
     def _handle_signal(signum, frame) -> None:
         logger.info("Received signal %s; shutting down", signum)
         threading.Thread(target=server.shutdown, daemon=True).start()
 
+    reload_lock = threading.Lock()
+
+    def _reload() -> None:
+        with reload_lock:
+            current = live.current
+            try:
+                reloaded = load_config(config_path)
+            except Exception as exc:
+                logger.error("Config reload failed; keeping current config: %s", exc)
+                return
+            new_config, ignored = merge_reload(current, reloaded)
+            if not is_worker:
+                for name in ignored:
+                    logger.warning("%s changed; restart required to apply", name)
+            refetch = source_changed(current, new_config)
+            new_upstream = peers["upstream"]
+            if not is_worker and (new_upstream is None or upstream_client_changed(current, new_config)):
+                if peers["store"] is None and new_config.peer_nodes:
+                    peers["store"] = peer_store(new_config)
+                new_upstream = build_upstream(new_config, peers["store"])
+                peers["upstream"] = new_upstream
+            # Re-read on every reload, so editing the file and sending SIGHUP
+            # applies it without waiting for the next refresh.
+            cache.set_overlay_file(new_config.overlay_file)
+            # Pre-warms before returning when the source changed, so the swap
+            # below never leaves searches waiting on upstream.
+            cache.reload_settings(
+                new_upstream,
+                new_config.all_views,
+                new_config.cache_ttl_seconds,
+                refetch,
+                new_config.cache_ttl_max_seconds,
+            )
+            live.current = new_config
+            server.reload_limits(new_config)
+            profiler.configure(
+                resolve_state_dir(new_config),
+                new_config.profile_window_seconds,
+                new_config.profile_sample_interval_ms / 1000.0,
+            )
+            if new_config.log_level != current.log_level:
+                logging.getLogger().setLevel(new_config.log_level)
+            changed = [
+                field.name for field in fields(Config) if getattr(new_config, field.name) != getattr(current, field.name)
+            ]
+            logger.info(
+                "Reloaded config changed=%s source=%s base_dn=%s upstream_nodes=%s upstream_mode=%s ttl=%s max_results=%s protocol_filter=%s views=%s",
+                ",".join(changed) or "-",
+                "changed" if refetch else "kept",
+                new_config.base_dn,
+                ",".join(new_config.upstream_nodes),
+                new_config.upstream_mode,
+                new_config.cache_ttl_seconds,
+                new_config.max_results,
+                new_config.protocol_filter,
+                _format_views(new_config),
+            )
+            logger.info("Connection stats %s", _format_stats(server.limiter.stats()))
+
     def _handle_reload(signum, frame) -> None:
+        # Loading, pre-warming and swapping happen off the signal handler.
         logger.info("Received signal %s; reloading config", signum)
-        new_config = load_config(config_path)
-        if new_config.listen_address != config.listen_address:
-            logger.warning("Listen address changed; restart required to apply")
-        if new_config.listen_port != config.listen_port:
-            logger.warning("Listen port changed; restart required to apply")
-        new_upstream = UpstreamClient(
-            nodes=new_config.upstream_nodes,
-            timeout_seconds=new_config.upstream_timeout_seconds,
-            protocol_filter=new_config.protocol_filter,
-        )
-        cache.reload_settings(new_upstream, new_config.base_dn, new_config.cache_ttl_seconds)
-        if new_config.max_results != config.max_results:
-            logger.info("Applied max_results=%s", new_config.max_results)
-        if new_config.protocol_filter != config.protocol_filter:
-            logger.info("Applied protocol_filter=%s", new_config.protocol_filter)
-        if new_config.allow_anonymous_bind != config.allow_anonymous_bind:
-            logger.info("Applied allow_anonymous_bind=%s", new_config.allow_anonymous_bind)
-        if new_config.allow_simple_bind_any_creds != config.allow_simple_bind_any_creds:
-            logger.info("Applied allow_simple_bind_any_creds=%s", new_config.allow_simple_bind_any_creds)
-        if new_config.log_level != config.log_level:
-            logging.getLogger().setLevel(new_config.log_level)
-            logger.info("Applied log_level=%s", new_config.log_level)
-        config.listen_address = new_config.listen_address
-        config.listen_port = new_config.listen_port
-        config.base_dn = new_config.base_dn
-        config.upstream_nodes = list(new_config.upstream_nodes)
-        config.upstream_timeout_seconds = new_config.upstream_timeout_seconds
-        config.cache_ttl_seconds = new_config.cache_ttl_seconds
-        config.max_results = new_config.max_results
-        config.protocol_filter = new_config.protocol_filter
-        config.allow_anonymous_bind = new_config.allow_anonymous_bind
-        config.allow_simple_bind_any_creds = new_config.allow_simple_bind_any_creds
-        config.log_level = new_config.log_level
-        logger.info(
-            "Reloaded config base_dn=%s upstream_nodes=%s ttl=%s max_results=%s protocol_filter=%s",
-            new_config.base_dn,
-            ",".join(new_config.upstream_nodes),
-            new_config.cache_ttl_seconds,
-            new_config.max_results,
-            new_config.protocol_filter,
-        )
+        threading.Thread(target=_reload, name="config-reload", daemon=True).start()
 
     signal.signal(signal.SIGTERM, _handle_signal)
     signal.signal(signal.SIGINT, _handle_signal)
     signal.signal(signal.SIGHUP, _handle_reload)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.start("sampling"))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.start("cprofile"))
 
     try:
         server.serve_forever()
     finally:
         server.server_close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if admin_server is not None:
+            admin_server.close()
+        if peer_server is not None:
+            peer_server.close()
+        logger.info("Connection stats %s", _format_stats(server.limiter.stats()))
+
+
+def _format_views(config: Config) -> str:
+    return ";".join(f"{view.name}:{view.protocol_filter}@{view.base_dn}" for view in config.views) or "-"
+
+
+def _format_stats(stats: dict) -> str:
+    return " ".join(f"{key}={value}" for key, value in stats.items())
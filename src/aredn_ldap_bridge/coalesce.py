@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import threading
+import time
+from typing import Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# How often a waiting search re-checks its own abandon flag and time limit.
+_WAIT_POLL_SECONDS = 0.05
+
+
+class _Flight(Generic[T]):
+    __slots__ = ("done", "result", "followers")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Optional[T] = None
+        self.followers = 0
+
+
+class SearchCoalescer(Generic[T]):
+    # Single-flight: while one caller computes the result for a key, callers
+    # with the same key wait and share it. Nothing is kept once the flight
+    # lands, so this only merges searches that overlap in time, such as the
+    # burst released when a cache refresh finishes.
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight[T]] = {}
+
+    def run(
+        self,
+        key: Hashable,
+        compute: Callable[[Callable[[], bool]], Optional[T]],
+        cancel: threading.Event,
+        deadline: Optional[float] = None,
+    ) -> Tuple[Optional[T], bool]:
+        # Returns (result, shared). `compute` is passed a callable telling it
+        # whether other searches are waiting on this flight right now, so it
+        # only does work for them when there are any. A None result (the
+        # computing search was abandoned) is not shared; each waiter then
+        # computes its own. A waiter that is abandoned, or whose deadline
+        # passes, stops waiting and gets (None, False).
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.followers += 1
+        if not leader:
+            while not flight.done.wait(_WAIT_POLL_SECONDS):
+                if cancel.is_set() or (deadline is not None and time.monotonic() >= deadline):
+                    with self._lock:
+                        flight.followers -= 1
+                    return None, False
+            if flight.result is not None:
+                return flight.result, True
+            return compute(lambda: False), False
+
+        def has_followers() -> bool:
+            with self._lock:
+                return flight.followers > 0
+
+        try:
+            flight.result = compute(has_followers)
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+        return flight.result, False
@@ -1,31 +1,143 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
+from functools import cached_property
 import os
-from typing import List
+import tempfile
+from typing import Dict, List, Tuple
 
 import configparser
 
+from .model import normalize_dn, root_dse_attributes
 
-@dataclass
+
+@dataclass(frozen=True)
+class ViewConfig:
+    # One directory served under its own base DN, built from the shared
+    # upstream fetch by protocol.
+    name: str
+    base_dn: str
+    protocol_filter: str
+    max_results: int
+
+    @property
+    def key(self) -> str:
+        return normalize_dn(self.base_dn)
+
+
+@dataclass(frozen=True)
 class Config:
     listen_address: str = "0.0.0.0"
     listen_port: int = 389
     base_dn: str = "dc=local,dc=mesh"
-    upstream_nodes: List[str] = None
+    upstream_nodes: Tuple[str, ...] = ("localnode.local.mesh",)
     upstream_timeout_seconds: int = 3
+    upstream_mode: str = "failover"
+    # Other bridges to sync snapshots from before falling back to upstream.
+    peer_nodes: Tuple[str, ...] = ()
+    peer_max_age_seconds: int = 300
+    peer_listen_address: str = "127.0.0.1"
+    peer_listen_port: int = 0
+    overlay_file: str = ""
     cache_ttl_seconds: int = 60
+    cache_ttl_max_seconds: int = 0
     max_results: int = 20
+    report_admin_limit: bool = False
     protocol_filter: str = "phone"
+    strict_search_base: bool = False
     allow_anonymous_bind: bool = True
     allow_simple_bind_any_creds: bool = True
     log_level: str = "INFO"
+    log_queue_size: int = 0
+    request_log_sample_every: int = 1
+    pipeline_max_outstanding: int = 1
+    server_engine: str = "threaded"
+    max_connections: int = 256
+    max_connections_per_ip: int = 16
+    accept_queue_size: int = 64
+    idle_timeout_seconds: int = 300
+    write_timeout_seconds: int = 10
+    max_connection_lifetime_seconds: int = 0
+    tcp_keepalive: bool = True
+    tcp_keepalive_idle_seconds: int = 60
+    tcp_keepalive_interval_seconds: int = 15
+    tcp_keepalive_count: int = 4
+    worker_processes: int = 1
+    metrics_listen_address: str = "127.0.0.1"
+    metrics_port: int = 0
+    state_dir: str = ""
+    admin_socket: str = ""
+    profile_window_seconds: int = 30
+    profile_sample_interval_ms: int = 5
+    # Views from [view:NAME] sections, served alongside the main one.
+    views: Tuple[ViewConfig, ...] = ()
+
+    @cached_property
+    def all_views(self) -> Tuple[ViewConfig, ...]:
+        # The main section's base DN and protocol filter are always the first view.
+        main = ViewConfig("default", self.base_dn, self.protocol_filter, self.max_results)
+        return (main,) + self.views
+
+    @cached_property
+    def view_routes(self) -> Dict[str, ViewConfig]:
+        return {view.key: view for view in self.all_views}
+
+    @cached_property
+    def root_dse(self) -> List[Tuple[str, List[str]]]:
+        return root_dse_attributes(view.base_dn for view in self.all_views)
+
+
+SERVER_ENGINES = ("threaded", "asyncio")
+UPSTREAM_MODES = ("failover", "union")
+
+# Settings that only take effect at startup; a reload keeps the running values.
+RESTART_ONLY_FIELDS = (
+    "listen_address",
+    "listen_port",
+    "server_engine",
+    "worker_processes",
+    "metrics_listen_address",
+    "metrics_port",
+    "admin_socket",
+    "peer_listen_address",
+    "peer_listen_port",
+    "log_queue_size",
+)
+# Settings that change which entries the cache holds.
+SOURCE_FIELDS = ("upstream_nodes", "upstream_mode", "protocol_filter", "base_dn", "views")
+# Settings the upstream client is built from; a reload that leaves them alone
+# keeps the client, with its per-node health and peer sync state.
+UPSTREAM_CLIENT_FIELDS = (
+    "upstream_nodes",
+    "upstream_mode",
+    "upstream_timeout_seconds",
+    "peer_nodes",
+    "peer_max_age_seconds",
+)
+
 
-    def __post_init__(self) -> None:
-        # Avoid a shared mutable default list across instances.
-        # A fresh list per instance keeps Config safe to mutate.
-        if self.upstream_nodes is None:
-            self.upstream_nodes = ["localnode.local.mesh"]
+class LiveConfig:
+    # The config every connection reads. Config is immutable and a reload
+    # replaces `current` in one assignment, so a reader sees the old or the
+    # new settings, never a mix.
+
+    def __init__(self, config: Config) -> None:
+        self.current = config
+
+
+def merge_reload(current: Config, reloaded: Config) -> Tuple[Config, List[str]]:
+    # Returns the config to swap in and the restart-only settings that were
+    # changed in the file but not applied.
+    ignored = [name for name in RESTART_ONLY_FIELDS if getattr(reloaded, name) != getattr(current, name)]
+    return replace(reloaded, **{name: getattr(current, name) for name in RESTART_ONLY_FIELDS}), ignored
+
+
+def source_changed(current: Config, new: Config) -> bool:
+    return any(getattr(current, name) != getattr(new, name) for name in SOURCE_FIELDS)
+
+
+def upstream_client_changed(current: Config, new: Config) -> bool:
+    return any(getattr(current, name) != getattr(new, name) for name in UPSTREAM_CLIENT_FIELDS)
 
 
 def load_config(path: str | None) -> Config:
@@ -48,7 +160,7 @@ def load_config(path: str | None) -> Config:
                 tokens.append(item)
         return tokens
 
-    config = Config()
+    values = {}
 
     def _has_option(key: str) -> bool:
         if parser.has_section(section):
@@ -56,26 +168,121 @@ def load_config(path: str | None) -> Config:
         return parser.has_option("DEFAULT", key)
 
     if _has_option("listen_address"):
-        config.listen_address = config_section.get("listen_address")
+        values["listen_address"] = config_section.get("listen_address")
     if _has_option("listen_port"):
-        config.listen_port = config_section.getint("listen_port")
+        values["listen_port"] = config_section.getint("listen_port")
     if _has_option("base_dn"):
-        config.base_dn = config_section.get("base_dn")
+        values["base_dn"] = config_section.get("base_dn")
     if _has_option("upstream_nodes"):
-        config.upstream_nodes = _get_list("upstream_nodes")
+        values["upstream_nodes"] = tuple(_get_list("upstream_nodes"))
     if _has_option("upstream_timeout_seconds"):
-        config.upstream_timeout_seconds = config_section.getint("upstream_timeout_seconds")
+        values["upstream_timeout_seconds"] = config_section.getint("upstream_timeout_seconds")
+    if _has_option("upstream_mode"):
+        values["upstream_mode"] = config_section.get("upstream_mode").strip().lower()
+        if values["upstream_mode"] not in UPSTREAM_MODES:
+            raise ValueError(
+                f"upstream_mode must be one of {', '.join(UPSTREAM_MODES)}, not {values['upstream_mode']!r}"
+            )
+    if _has_option("peer_nodes"):
+        values["peer_nodes"] = tuple(_get_list("peer_nodes"))
+    if _has_option("peer_max_age_seconds"):
+        values["peer_max_age_seconds"] = config_section.getint("peer_max_age_seconds")
+    if _has_option("peer_listen_address"):
+        values["peer_listen_address"] = config_section.get("peer_listen_address").strip()
+    if _has_option("peer_listen_port"):
+        values["peer_listen_port"] = config_section.getint("peer_listen_port")
+    if _has_option("overlay_file"):
+        values["overlay_file"] = config_section.get("overlay_file").strip()
     if _has_option("cache_ttl_seconds"):
-        config.cache_ttl_seconds = config_section.getint("cache_ttl_seconds")
+        values["cache_ttl_seconds"] = config_section.getint("cache_ttl_seconds")
+    if _has_option("cache_ttl_max_seconds"):
+        values["cache_ttl_max_seconds"] = config_section.getint("cache_ttl_max_seconds")
     if _has_option("max_results"):
-        config.max_results = config_section.getint("max_results")
+        values["max_results"] = config_section.getint("max_results")
+    if _has_option("report_admin_limit"):
+        values["report_admin_limit"] = config_section.getboolean("report_admin_limit")
     if _has_option("protocol_filter"):
-        config.protocol_filter = config_section.get("protocol_filter")
+        values["protocol_filter"] = config_section.get("protocol_filter")
+    if _has_option("strict_search_base"):
+        values["strict_search_base"] = config_section.getboolean("strict_search_base")
     if _has_option("allow_anonymous_bind"):
-        config.allow_anonymous_bind = config_section.getboolean("allow_anonymous_bind")
+        values["allow_anonymous_bind"] = config_section.getboolean("allow_anonymous_bind")
     if _has_option("allow_simple_bind_any_creds"):
-        config.allow_simple_bind_any_creds = config_section.getboolean("allow_simple_bind_any_creds")
+        values["allow_simple_bind_any_creds"] = config_section.getboolean("allow_simple_bind_any_creds")
     if _has_option("log_level"):
-        config.log_level = config_section.get("log_level")
+        values["log_level"] = config_section.get("log_level")
+    if _has_option("log_queue_size"):
+        values["log_queue_size"] = config_section.getint("log_queue_size")
+    if _has_option("request_log_sample_every"):
+        values["request_log_sample_every"] = config_section.getint("request_log_sample_every")
+    if _has_option("pipeline_max_outstanding"):
+        values["pipeline_max_outstanding"] = config_section.getint("pipeline_max_outstanding")
+    if _has_option("server_engine"):
+        values["server_engine"] = config_section.get("server_engine").strip().lower()
+        if values["server_engine"] not in SERVER_ENGINES:
+            raise ValueError(
+                f"server_engine must be one of {', '.join(SERVER_ENGINES)}, not {values['server_engine']!r}"
+            )
+    if _has_option("max_connections"):
+        values["max_connections"] = config_section.getint("max_connections")
+    if _has_option("max_connections_per_ip"):
+        values["max_connections_per_ip"] = config_section.getint("max_connections_per_ip")
+    if _has_option("accept_queue_size"):
+        values["accept_queue_size"] = config_section.getint("accept_queue_size")
+    if _has_option("idle_timeout_seconds"):
+        values["idle_timeout_seconds"] = config_section.getint("idle_timeout_seconds")
+    if _has_option("write_timeout_seconds"):
+        values["write_timeout_seconds"] = config_section.getint("write_timeout_seconds")
+    if _has_option("max_connection_lifetime_seconds"):
+        values["max_connection_lifetime_seconds"] = config_section.getint("max_connection_lifetime_seconds")
+    if _has_option("tcp_keepalive"):
+        values["tcp_keepalive"] = config_section.getboolean("tcp_keepalive")
+    if _has_option("tcp_keepalive_idle_seconds"):
+        values["tcp_keepalive_idle_seconds"] = config_section.getint("tcp_keepalive_idle_seconds")
+    if _has_option("tcp_keepalive_interval_seconds"):
+        values["tcp_keepalive_interval_seconds"] = config_section.getint("tcp_keepalive_interval_seconds")
+    if _has_option("tcp_keepalive_count"):
+        values["tcp_keepalive_count"] = config_section.getint("tcp_keepalive_count")
+    if _has_option("worker_processes"):
+        values["worker_processes"] = config_section.getint("worker_processes")
+    if _has_option("metrics_listen_address"):
+        values["metrics_listen_address"] = config_section.get("metrics_listen_address")
+    if _has_option("metrics_port"):
+        values["metrics_port"] = config_section.getint("metrics_port")
+    if _has_option("state_dir"):
+        values["state_dir"] = config_section.get("state_dir").strip()
+    if _has_option("admin_socket"):
+        values["admin_socket"] = config_section.get("admin_socket").strip()
+    if _has_option("profile_window_seconds"):
+        values["profile_window_seconds"] = config_section.getint("profile_window_seconds")
+    if _has_option("profile_sample_interval_ms"):
+        values["profile_sample_interval_ms"] = config_section.getint("profile_sample_interval_ms")
+
+    views: List[ViewConfig] = []
+    seen = {normalize_dn(values.get("base_dn", Config.base_dn))}
+    for name in parser.sections():
+        if not name.startswith("view:"):
+            continue
+        view_section = parser[name]
+        view_name = name[len("view:") :].strip()
+        base_dn = view_section.get("base_dn", fallback="").strip()
+        if not view_name or not base_dn:
+            raise ValueError(f"[{name}] needs a name and a base_dn")
+        if normalize_dn(base_dn) in seen:
+            raise ValueError(f"[{name}] base_dn {base_dn} is already served by another view")
+        seen.add(normalize_dn(base_dn))
+        views.append(
+            ViewConfig(
+                name=view_name,
+                base_dn=base_dn,
+                protocol_filter=view_section.get("protocol_filter", fallback=view_name).strip(),
+                max_results=view_section.getint("max_results", fallback=values.get("max_results", Config.max_results)),
+            )
+        )
+    values["views"] = tuple(views)
+
+    return Config(**values)
+
 
-    return config
+def resolve_state_dir(config: Config) -> str:
+    return config.state_dir or os.path.join(tempfile.gettempdir(), "aredn-ldap-bridge")
@@ -0,0 +1,171 @@
+from __future__ import annotations
+
+import argparse
+import json
+import socket
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List
+
+from pyasn1.error import SubstrateUnderrunError
+from pyasn1.type import univ
+
+from .ldap_protocol import (
+    SearchRequestMessage,
+    build_abandon_request,
+    build_bind_request,
+    build_search_request,
+    build_substring_filter,
+    build_unbind_request,
+    decode_ldap_message,
+    decode_ldap_result_code,
+    encode_request_message,
+    peek_ldap_op_tag,
+)
+
+
+@dataclass
+class SearchResult:
+    message_id: int
+    result_code: int = -1
+    entries: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def latency_seconds(self) -> float:
+        return self.finished - self.started
+
+
+class LDAPClient:
+    # Minimal blocking LDAP client for smoke tests and load generation against
+    # the bridge; it only understands the responses the bridge itself sends.
+
+    def __init__(self, host: str, port: int, timeout_seconds: float = 10.0) -> None:
+        self._sock = socket.create_connection((host, port), timeout=timeout_seconds)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = b""
+        self._next_id = 1
+
+    def close(self) -> None:
+        try:
+            self._sock.close()
+        except OSError:
+            pass
+
+    def send(self, op_value: univ.Asn1Item) -> int:
+        message_id = self._next_id
+        self._next_id += 1
+        self._sock.sendall(encode_request_message(message_id, op_value))
+        return message_id
+
+    def read_message(self) -> tuple[int, bytes]:
+        while True:
+            if self._buffer:
+                try:
+                    message_id, op_bytes, rest = decode_ldap_message(self._buffer)
+                    self._buffer = bytes(rest)
+                    return message_id, op_bytes
+                except SubstrateUnderrunError:
+                    pass
+            data = self._sock.recv(65536)
+            if not data:
+                raise ConnectionError("connection closed by server")
+            self._buffer += data
+
+    def bind(self, name: str = "", password: str = "") -> int:
+        message_id = self.send(build_bind_request(name, password))
+        while True:
+            response_id, op_bytes = self.read_message()
+            if response_id == message_id:
+                return decode_ldap_result_code(op_bytes)
+
+    def search(self, request: SearchRequestMessage) -> SearchResult:
+        return self.search_pipelined([request], depth=1)[0]
+
+    def search_pipelined(self, requests: Iterable[SearchRequestMessage], depth: int) -> List[SearchResult]:
+        # Keep up to `depth` searches outstanding, issuing the next one as soon
+        # as any outstanding search completes.
+        pending = iter(requests)
+        in_flight: Dict[int, SearchResult] = {}
+        completed: List[SearchResult] = []
+        exhausted = False
+
+        while True:
+            while not exhausted and len(in_flight) < max(1, depth):
+                request = next(pending, None)
+                if request is None:
+                    exhausted = True
+                    break
+                started = time.perf_counter()
+                message_id = self.send(request)
+                in_flight[message_id] = SearchResult(message_id=message_id, started=started)
+            if not in_flight:
+                return completed
+
+            message_id, op_bytes = self.read_message()
+            result = in_flight.get(message_id)
+            if result is None:
+                continue
+            op_tag = peek_ldap_op_tag(op_bytes)
+            if op_tag == "1:1:4":  # searchResEntry
+                result.entries += 1
+            elif op_tag == "1:1:5":  # searchResDone
+                result.result_code = decode_ldap_result_code(op_bytes)
+                result.finished = time.perf_counter()
+                completed.append(in_flight.pop(message_id))
+
+    def abandon(self, message_id: int) -> None:
+        self.send(build_abandon_request(message_id))
+
+    def unbind(self) -> None:
+        try:
+            self.send(build_unbind_request())
+        except OSError:
+            pass
+        self.close()
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="AREDN LDAP Bridge pipelined search client")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=389)
+    parser.add_argument("--base-dn", default="dc=local,dc=mesh")
+    parser.add_argument("--attribute", default="cn", help="Attribute used in the substring filter")
+    parser.add_argument("--value", default="a", help="Substring value searched for")
+    parser.add_argument("--searches", type=int, default=1000, help="Total searches to issue")
+    parser.add_argument("--depth", type=int, default=8, help="Outstanding searches per connection")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    client = LDAPClient(args.host, args.port)
+    try:
+        client.bind()
+        search_filter = build_substring_filter(args.attribute, args.value)
+        requests = (
+            build_search_request(args.base_dn, search_filter, attributes=["cn", "telephoneNumber"])
+            for _ in range(max(0, args.searches))
+        )
+        started = time.perf_counter()
+        results = client.search_pipelined(requests, args.depth)
+        elapsed = time.perf_counter() - started
+    finally:
+        client.unbind()
+
+    latencies = sorted(result.latency_seconds for result in results)
+    report = {
+        "searches": len(results),
+        "depth": args.depth,
+        "elapsed_seconds": round(elapsed, 4),
+        "searches_per_second": round(len(results) / elapsed, 1) if elapsed > 0 else 0.0,
+        "entries": sum(result.entries for result in results),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3) if latencies else 0.0,
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
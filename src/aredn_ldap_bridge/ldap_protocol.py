@@ -300,6 +300,12 @@ class SearchRequestMessage(SearchRequest):
     )
 
 
+class AbandonRequestMessage(MessageID):
+    tagSet = MessageID.tagSet.tagImplicitly(
+        tag.Tag(tag.tagClassApplication, tag.tagFormatSimple, 16)
+    )
+
+
 class AttributeValue(univ.OctetString):
     pass
 
@@ -479,6 +485,11 @@ def decode_ldap_message(data: bytes):
     return message_id, _any_to_bytes(op_any), rest
 
 
+def decode_abandon_request(op_bytes: bytes) -> int:
+    abandon_id, _ = decoder.decode(op_bytes, asn1Spec=AbandonRequestMessage())
+    return int(abandon_id)
+
+
 def peek_ldap_op_tag(data: bytes) -> str:
     if len(data) < 1:
         return "unknown"
@@ -532,6 +543,30 @@ def build_search_result_entry(
     dn: str,
     attributes: list[tuple[str, list[str]]],
 ) -> LDAPMessage:
+    return make_ldap_message(message_id, "searchResEntry", _search_result_entry(dn, attributes))
+
+
+def encode_search_result_entry_op(dn: str, attributes: list[tuple[str, list[str]]]) -> bytes:
+    # Just the protocolOp, to be framed per messageID with frame_ldap_message.
+    return encoder.encode(_search_result_entry(dn, attributes))
+
+
+def frame_ldap_message(message_id: int, op_bytes: bytes) -> bytes:
+    # The LDAPMessage envelope around an already-encoded protocolOp; the same
+    # bytes encode_ldap_message produces for the whole message.
+    id_bytes = message_id.to_bytes(message_id.bit_length() // 8 + 1, "big")
+    body = b"\x02" + _ber_length(len(id_bytes)) + id_bytes + op_bytes
+    return b"\x30" + _ber_length(len(body)) + body
+
+
+def _ber_length(length: int) -> bytes:
+    if length < 0x80:
+        return bytes((length,))
+    size = (length.bit_length() + 7) // 8
+    return bytes((0x80 | size,)) + length.to_bytes(size, "big")
+
+
+def _search_result_entry(dn: str, attributes: list[tuple[str, list[str]]]) -> SearchResultEntryMessage:
     entry = SearchResultEntryMessage()
     entry.setComponentByName("objectName", dn)
 
@@ -546,13 +581,13 @@ def build_search_result_entry(
         attr_list.append(partial)
 
     entry.setComponentByName("attributes", attr_list)
-    return make_ldap_message(message_id, "searchResEntry", entry)
+    return entry
 
 
-def build_search_result_done(message_id: int, result_code: int = 0) -> LDAPMessage:
+def build_search_result_done(message_id: int, result_code: int = 0, matched_dn: str = "") -> LDAPMessage:
     done = SearchResultDoneMessage()
     done.setComponentByName("resultCode", result_code)
-    done.setComponentByName("matchedDN", b"")
+    done.setComponentByName("matchedDN", matched_dn.encode("utf-8"))
     done.setComponentByName("diagnosticMessage", b"")
     return make_ldap_message(message_id, "searchResDone", done)
 
@@ -565,6 +600,20 @@ def build_extended_response(message_id: int, result_code: int) -> LDAPMessage:
     return make_ldap_message(message_id, "extendedResponse", response)
 
 
+NOTICE_OF_DISCONNECTION_OID = "1.3.6.1.4.1.1466.20036"
+
+
+def build_notice_of_disconnection(result_code: int, message: str = "") -> LDAPMessage:
+    # Unsolicited notification (messageID 0) sent just before the server
+    # drops a connection, e.g. with resultCode busy when shedding load.
+    response = ExtendedResponseMessage()
+    response.setComponentByName("resultCode", result_code)
+    response.setComponentByName("matchedDN", b"")
+    response.setComponentByName("diagnosticMessage", message)
+    response.setComponentByName("responseName", NOTICE_OF_DISCONNECTION_OID)
+    return make_ldap_message(0, "extendedResponse", response)
+
+
 def build_ldap_result_response(message_id: int, op_name: str, result_code: int) -> LDAPMessage:
     response_map = {
         "modifyResponse": ModifyResponseMessage,
@@ -579,3 +628,84 @@ def build_ldap_result_response(message_id: int, op_name: str, result_code: int)
     response.setComponentByName("matchedDN", b"")
     response.setComponentByName("diagnosticMessage", b"")
     return make_ldap_message(message_id, op_name, response)
+
+
+def encode_request_message(message_id: int, op_value: univ.Asn1Item) -> bytes:
+    message = LDAPMessageRaw()
+    message.setComponentByName("messageID", message_id)
+    message.setComponentByName("protocolOp", univ.Any(encoder.encode(op_value)))
+    return encoder.encode(message)
+
+
+def build_bind_request(name: str = "", password: str = "") -> BindRequestMessage:
+    request = BindRequestMessage()
+    request.setComponentByName("version", 3)
+    request.setComponentByName("name", name)
+    request.getComponentByName("authentication").setComponentByName("simple", password.encode("utf-8"))
+    return request
+
+
+def build_unbind_request() -> univ.Null:
+    return univ.Null("").subtype(
+        implicitTag=tag.Tag(tag.tagClassApplication, tag.tagFormatSimple, 2)
+    )
+
+
+def build_abandon_request(message_id: int) -> AbandonRequestMessage:
+    return AbandonRequestMessage(message_id)
+
+
+def build_substring_filter(attribute: str, value: str) -> Filter:
+    substring = Substring()
+    substring.setComponentByName("any", value.encode("utf-8"))
+    search_filter = Filter()
+    substring_filter = search_filter.getComponentByName("substrings")
+    substring_filter.setComponentByName("type", attribute)
+    substring_filter.getComponentByName("substrings").append(substring)
+    return search_filter
+
+
+def build_present_filter(attribute: str = "objectClass") -> Filter:
+    search_filter = Filter()
+    search_filter.setComponentByName("present", attribute)
+    return search_filter
+
+
+def build_or_filter(children: list[Filter]) -> Filter:
+    search_filter = Filter()
+    filter_set = search_filter.getComponentByName("or_")
+    for child in children:
+        filter_set.append(child)
+    return search_filter
+
+
+def build_search_request(
+    base_dn: str,
+    search_filter: Filter,
+    attributes: list[str] | None = None,
+    size_limit: int = 0,
+    time_limit: int = 0,
+    scope: int = 2,
+    types_only: bool = False,
+) -> SearchRequestMessage:
+    request = SearchRequestMessage()
+    request.setComponentByName("baseObject", base_dn)
+    request.setComponentByName("scope", scope)
+    request.setComponentByName("derefAliases", 0)
+    request.setComponentByName("sizeLimit", size_limit)
+    request.setComponentByName("timeLimit", time_limit)
+    request.setComponentByName("typesOnly", types_only)
+    request.setComponentByName("filter", search_filter)
+    selection = request.getComponentByName("attributes")
+    for name in attributes or []:
+        selection.append(name)
+    return request
+
+
+def decode_ldap_result_code(op_bytes: bytes) -> int:
+    # Works for any response op that is a plain LDAPResult (bind, searchResDone, ...).
+    result_spec = LDAPResult().subtype(
+        implicitTag=tag.Tag(tag.tagClassApplication, tag.tagFormatConstructed, op_bytes[0] & 0x1F)
+    )
+    result, _ = decoder.decode(op_bytes, asn1Spec=result_spec)
+    return int(result.getComponentByName("resultCode"))
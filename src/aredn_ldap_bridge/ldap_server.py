@@ -1,197 +1,842 @@
 from __future__ import annotations
 
 import logging
+import queue
+import select
+import socket
 import socketserver
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Hashable, Iterator, List, NamedTuple, Optional, Tuple
 
 from pyasn1.codec.ber import decoder
 from pyasn1.error import SubstrateUnderrunError
 
-from .config import Config
+from .config import Config, LiveConfig, ViewConfig
 from .ldap_protocol import (
     BindRequestMessage,
     SearchRequestLooseMessage,
     build_bind_response,
     build_extended_response,
     build_ldap_result_response,
+    build_notice_of_disconnection,
     build_search_result_done,
     build_search_result_entry,
+    decode_abandon_request,
     decode_ldap_message,
     encode_ldap_message,
+    encode_search_result_entry_op,
+    frame_ldap_message,
     peek_ldap_op_tag,
 )
 from .cache import LazyCache
-from .matcher import filter_entries
+from .coalesce import SearchCoalescer
+from .limits import ConnectionLimiter
+from .logging_setup import sample_request_log
+from .matcher import TypeaheadNarrower, filter_tokens, match_entries, parse_filter_bytes
+from .metrics import (
+    COALESCED_SEARCHES,
+    ENCODE_SECONDS,
+    MATCH_SECONDS,
+    NARROWED_SEARCHES,
+    OPERATIONS,
+    SEARCH_RESULTS,
+    SEARCH_SECONDS,
+)
+from .model import DirectoryEntry, entry_attributes, normalize_dn, select_attributes, select_root_dse
 
 
-def create_server(config: Config, cache: LazyCache) -> socketserver.ThreadingTCPServer:
-    logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+# A pool thread with nothing to do for this long exits.
+_IDLE_WORKER_SECONDS = 60.0
+
+
+class _WorkerPool:
+    # Threads are started as work arrives, up to `limit`, and exit after idling;
+    # work beyond the limit waits in the queue for the next free thread.
+
+    def __init__(self, name: str, limit: int) -> None:
+        self._name = name
+        self._limit = max(1, limit)
+        self._queue: queue.Queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = 0
+        self._idle = 0
+        self._closed = False
+
+    def resize(self, limit: int) -> None:
+        # Threads over a lowered limit exit once their current work is done.
+        with self._lock:
+            self._limit = max(1, limit)
+
+    def submit(self, function: Callable[..., None], *args) -> None:
+        # Still runs after close() (a connection draining at shutdown); such a
+        # thread exits once the queue is empty.
+        self._queue.put((function, args))
+        with self._lock:
+            if self._threads >= self._limit or self._queue.qsize() <= self._idle:
+                return
+            self._threads += 1
+        threading.Thread(target=self._run, name=self._name, daemon=True).start()
+
+    def close(self) -> None:
+        # Queued work still runs; each thread then takes a sentinel and exits.
+        with self._lock:
+            self._closed = True
+            threads = self._threads
+        for _ in range(threads):
+            self._queue.put(None)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                item = self._queue.get(timeout=_IDLE_WORKER_SECONDS)
+            except queue.Empty:
+                item = None
+            with self._lock:
+                self._idle -= 1
+                # An idle timeout that races a submit stays for the new work.
+                if item is None and (self._closed or self._queue.empty()):
+                    self._threads -= 1
+                    return
+            if item is None:
+                continue
+            function, args = item
+            try:
+                function(*args)
+            except Exception:
+                logging.getLogger("aredn_ldap_bridge.ldap_server").exception("Pool task failed")
+            with self._lock:
+                if self._threads > self._limit or (self._closed and self._queue.empty()):
+                    self._threads -= 1
+                    return
+
+
+class PooledLDAPServer(socketserver.TCPServer):
+    # Serves each connection on a thread from `connections`, started when the
+    # connection arrives and capped at max_connections. Admitted connections
+    # beyond that wait in its queue; anything past the limits gets a busy
+    # notice. Operations run on `operations`, one pool shared by every
+    # connection, so each connection's thread is free to read abandons.
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, limiter: ConnectionLimiter, reuse_port: bool = False) -> None:
+        self.limiter = limiter
+        # Pre-fork workers each bind the same port and let the kernel spread
+        # incoming connections across them.
+        self.allow_reuse_port = reuse_port
+        self.connections = _WorkerPool("ldap-conn", limiter.max_connections)
+        self.operations = _WorkerPool("ldap-op", limiter.max_connections)
+        super().__init__(server_address, handler_class)
 
-    handler_class = _make_handler(config, cache)
+    def reload_limits(self, config: Config) -> None:
+        self.limiter.configure(config.max_connections, config.max_connections_per_ip, config.accept_queue_size)
+        self.connections.resize(config.max_connections)
+        self.operations.resize(config.max_connections)
 
-    class ThreadingLDAPServer(socketserver.ThreadingTCPServer):
-        allow_reuse_address = True
-        daemon_threads = True
+    def process_request(self, request, client_address) -> None:
+        if not self.limiter.admit(client_address[0]):
+            _send_busy_notice(request)
+            self.shutdown_request(request)
+            return
+        self.connections.submit(self._serve_connection, request, client_address)
 
-    server = ThreadingLDAPServer((config.listen_address, config.listen_port), handler_class)
+    def server_close(self) -> None:
+        super().server_close()
+        self.connections.close()
+        self.operations.close()
+
+    def _serve_connection(self, request, client_address) -> None:
+        self.limiter.activate()
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.limiter.release(client_address[0])
+
+
+def _send_busy_notice(request: socket.socket) -> None:
+    try:
+        request.sendall(encode_ldap_message(build_notice_of_disconnection(51, "busy")))
+    except OSError:
+        pass
+
+
+def create_server(live: LiveConfig, cache: LazyCache) -> PooledLDAPServer:
+    logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+
+    config = live.current
+    handler_class = _make_handler(live, cache)
+    limiter = ConnectionLimiter(config.max_connections, config.max_connections_per_ip, config.accept_queue_size)
+
+    server = PooledLDAPServer(
+        (config.listen_address, config.listen_port),
+        handler_class,
+        limiter,
+        reuse_port=config.worker_processes > 1,
+    )
     logger.info(
-        "LDAP server listening on %s:%s base_dn=%s",
+        "LDAP server listening on %s:%s base_dn=%s max_connections=%s",
         config.listen_address,
         config.listen_port,
         config.base_dn,
+        config.max_connections,
     )
     return server
 
 
 def run_server(config: Config, cache: LazyCache) -> None:
-    server = create_server(config, cache)
+    server = create_server(LiveConfig(config), cache)
     try:
         server.serve_forever()
     finally:
         server.server_close()
 
 
-def _make_handler(config: Config, cache: LazyCache):
-    def _to_text(value) -> str:
-        try:
-            raw = bytes(value)
-        except Exception:
-            return str(value)
-        text = raw.decode("utf-8", errors="replace")
-        return text.replace("\r", " ").replace("\n", " ")
+_MAX_MESSAGE_BYTES = 64 * 1024
+MAX_QUEUED_OPERATIONS = 16
+# While an operation is running an expired idle/lifetime timer is re-checked at this interval.
+_BUSY_POLL_SECONDS = 1.0
+UNBIND_OP_TAG = "1:0:2"
+ABANDON_OP_TAG = "1:0:16"
+_OP_TAG_NAMES = {
+    "1:1:0": "bindRequest",
+    "1:1:3": "searchRequest",
+    "1:0:2": "unbindRequest",
+    "1:1:6": "modifyRequest",
+    "1:1:8": "addRequest",
+    "1:0:10": "delRequest",
+    "1:1:12": "modifyDNRequest",
+    "1:1:14": "compareRequest",
+    "1:0:16": "abandonRequest",
+    "1:1:23": "extendedRequest",
+}
+# Write operations, all refused, and the response each is answered with.
+_RESULT_RESPONSE_NAMES = {
+    "1:1:6": "modifyResponse",
+    "1:1:8": "addResponse",
+    "1:0:10": "delResponse",
+    "1:1:12": "modifyDNResponse",
+    "1:1:14": "compareResponse",
+}
 
-    class LDAPRequestHandler(socketserver.BaseRequestHandler):
-        _MAX_MESSAGE_BYTES = 64 * 1024
-        _OP_TAG_NAMES = {
-            "1:1:0": "bindRequest",
-            "1:1:3": "searchRequest",
-            "1:0:2": "unbindRequest",
-            "1:1:6": "modifyRequest",
-            "1:1:8": "addRequest",
-            "1:0:10": "delRequest",
-            "1:1:12": "modifyDNRequest",
-            "1:1:14": "compareRequest",
-            "1:0:16": "abandonRequest",
-            "1:1:23": "extendedRequest",
-        }
 
-        def handle(self) -> None:
-            logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
-            buffer = b""
+def tune_socket(sock: socket.socket, config: Config) -> None:
+    # Responses are many small messages; don't let Nagle hold them back.
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if not config.tcp_keepalive:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in (
+        ("TCP_KEEPIDLE", config.tcp_keepalive_idle_seconds),
+        ("TCP_KEEPINTVL", config.tcp_keepalive_interval_seconds),
+        ("TCP_KEEPCNT", config.tcp_keepalive_count),
+    ):
+        option = getattr(socket, name, None)
+        if option is not None and value > 0:
+            sock.setsockopt(socket.IPPROTO_TCP, option, int(value))
 
-            while True:
-                data = self.request.recv(4096)
-                if not data:
-                    return
-                buffer += data
-                if len(buffer) > self._MAX_MESSAGE_BYTES:
-                    logger.warning("Closing connection: LDAP message exceeds %s bytes", self._MAX_MESSAGE_BYTES)
-                    return
 
-                while buffer:
-                    try:
-                        message_id, op_bytes, rest = decode_ldap_message(buffer)
-                    except SubstrateUnderrunError:
-                        break
-                    except Exception as exc:
-                        op_tag = peek_ldap_op_tag(buffer)
-                        logger.warning("Failed to decode LDAP message op_tag=%s err=%s", op_tag, exc)
-                        return
+def _to_text(value) -> str:
+    try:
+        raw = bytes(value)
+    except Exception:
+        return str(value)
+    text = raw.decode("utf-8", errors="replace")
+    return text.replace("\r", " ").replace("\n", " ")
 
-                    buffer = rest
-                    self._handle_message(message_id, op_bytes)
 
-        def _handle_message(self, message_id: int, op_bytes: bytes) -> None:
-            logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
-            op_tag = peek_ldap_op_tag(op_bytes)
-            op_name = self._OP_TAG_NAMES.get(op_tag, "unknown")
+class LDAPSession:
+    # Per-connection protocol state shared by the threaded and asyncio engines:
+    # message framing, the messageID -> cancel map used by abandon, and the
+    # operation handlers, which yield encoded response messages.
 
-            if op_tag == "1:1:0":
-                try:
-                    bind_request, _ = decoder.decode(op_bytes, asn1Spec=BindRequestMessage())
-                except Exception as exc:
-                    logger.warning("Failed to decode bind request err=%s", exc)
-                    return
-                bind_dn = _to_text(bind_request.getComponentByName("name"))
-                logger.info("Bind request from %s dn=%s", self.client_address[0], bind_dn)
+    def __init__(self, live: LiveConfig, cache: LazyCache, client_address: str) -> None:
+        self.client_address = client_address
+        self._live = live
+        self._cache = cache
+        self._buffer = b""
+        self._operations: Dict[int, threading.Event] = {}
+        self._operations_lock = threading.Lock()
+        self._opened_at = time.monotonic()
+        self._last_activity = self._opened_at
+        self._narrower = TypeaheadNarrower()
 
-                response = build_bind_response(message_id, result_code=0)
-                self.request.sendall(encode_ldap_message(response))
+    def read_timeout(self) -> Tuple[float | None, str]:
+        # How long the reader may wait for data: (None, "") without timers,
+        # (0.0, reason) once the connection should be closed for `reason`.
+        config = self._live.current
+        deadlines = []
+        if config.idle_timeout_seconds > 0:
+            deadlines.append((self._last_activity + config.idle_timeout_seconds, "idle"))
+        if config.max_connection_lifetime_seconds > 0:
+            deadlines.append((self._opened_at + config.max_connection_lifetime_seconds, "lifetime"))
+        if not deadlines:
+            return None, ""
+        deadline, reason = min(deadlines)
+        now = time.monotonic()
+        if deadline > now:
+            return deadline - now, ""
+        with self._operations_lock:
+            if self._operations:
+                return _BUSY_POLL_SECONDS, ""
+        return 0.0, reason
+
+    def feed(self, data: bytes) -> List[Tuple[int, bytes]]:
+        # Raises ValueError when the connection should be closed.
+        logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+        self._last_activity = time.monotonic()
+        self._buffer += data
+        if len(self._buffer) > _MAX_MESSAGE_BYTES:
+            logger.warning("Closing connection: LDAP message exceeds %s bytes", _MAX_MESSAGE_BYTES)
+            raise ValueError("message too large")
+
+        messages: List[Tuple[int, bytes]] = []
+        while self._buffer:
+            try:
+                message_id, op_bytes, rest = decode_ldap_message(self._buffer)
+            except SubstrateUnderrunError:
+                break
+            except Exception as exc:
+                op_tag = peek_ldap_op_tag(self._buffer)
+                logger.warning("Failed to decode LDAP message op_tag=%s err=%s", op_tag, exc)
+                raise ValueError("undecodable message") from exc
+            self._buffer = rest
+            messages.append((message_id, op_bytes))
+        return messages
+
+    def begin(self, message_id: int) -> Optional[threading.Event]:
+        # None if `message_id` is still in flight: a client must not reuse it
+        # until the operation completes, and the duplicate is ignored.
+        cancel = threading.Event()
+        with self._operations_lock:
+            if message_id in self._operations:
+                cancel = None
+            else:
+                self._operations[message_id] = cancel
+        if cancel is None:
+            logging.getLogger("aredn_ldap_bridge.ldap_server").warning(
+                "Ignoring request from %s: message_id=%s is already in flight", self.client_address, message_id
+            )
+        return cancel
+
+    def in_flight(self) -> int:
+        with self._operations_lock:
+            return len(self._operations)
+
+    def busy(self, message_id: int, op_bytes: bytes) -> Optional[bytes]:
+        # The busy (51) answer for an operation refused because too many are
+        # outstanding on this connection; None for an unknown operation.
+        op_tag = peek_ldap_op_tag(op_bytes)
+        logging.getLogger("aredn_ldap_bridge.ldap_server").info(
+            "Refusing op=%s message_id=%s from %s: too many outstanding operations",
+            _OP_TAG_NAMES.get(op_tag, "unknown"),
+            message_id,
+            self.client_address,
+        )
+        if op_tag == "1:1:0":
+            return encode_ldap_message(build_bind_response(message_id, result_code=51))
+        if op_tag == "1:1:3":
+            return encode_ldap_message(build_search_result_done(message_id=message_id, result_code=51))
+        if op_tag == "1:1:23":
+            return encode_ldap_message(build_extended_response(message_id, result_code=51))
+        if op_tag in _RESULT_RESPONSE_NAMES:
+            return encode_ldap_message(
+                build_ldap_result_response(message_id, _RESULT_RESPONSE_NAMES[op_tag], result_code=51)
+            )
+        return None
+
+    def end(self, message_id: int) -> None:
+        with self._operations_lock:
+            self._operations.pop(message_id, None)
+        self._last_activity = time.monotonic()
+
+    def cancel_all(self) -> None:
+        with self._operations_lock:
+            for cancel in self._operations.values():
+                cancel.set()
+
+    def unbind(self) -> None:
+        logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+        OPERATIONS.inc("unbindRequest")
+        logger.info("Unbind request from %s", self.client_address)
+
+    def abandon(self, op_bytes: bytes) -> None:
+        logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+        OPERATIONS.inc("abandonRequest")
+        try:
+            abandon_id = decode_abandon_request(op_bytes)
+        except Exception as exc:
+            logger.warning("Failed to decode abandon request err=%s", exc)
+            return
+        with self._operations_lock:
+            cancel = self._operations.get(abandon_id)
+        if cancel is None:
+            logger.info("Abandon request from %s message_id=%s (not in flight)", self.client_address, abandon_id)
+            return
+        cancel.set()
+        logger.info("Abandon request from %s message_id=%s", self.client_address, abandon_id)
+
+    def responses(self, message_id: int, op_bytes: bytes, cancel: threading.Event) -> Iterator[bytes]:
+        logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+        op_tag = peek_ldap_op_tag(op_bytes)
+        op_name = _OP_TAG_NAMES.get(op_tag, "unknown")
+        OPERATIONS.inc(op_name)
+        # One config for the whole operation, even if a reload lands mid-search.
+        config = self._live.current
+
+        if op_tag == "1:1:0":
+            try:
+                bind_request, _ = decoder.decode(op_bytes, asn1Spec=BindRequestMessage())
+            except Exception as exc:
+                logger.warning("Failed to decode bind request err=%s", exc)
                 return
+            if logger.isEnabledFor(logging.INFO) and sample_request_log(config.request_log_sample_every):
+                bind_dn = _to_text(bind_request.getComponentByName("name"))
+                logger.info("Bind request from %s dn=%s", self.client_address, bind_dn)
 
-            if op_tag == "1:1:3":
-                try:
-                    search_request, _ = decoder.decode(op_bytes, asn1Spec=SearchRequestLooseMessage())
-                except Exception as exc:
-                    logger.warning("Failed to decode search request err=%s", exc)
-                    return
-                base_dn = _to_text(search_request.getComponentByName("baseObject"))
-                filter_value = search_request.getComponentByName("filter")
-                try:
-                    filter_bytes = bytes(filter_value.asOctets())
-                except Exception:
-                    filter_bytes = bytes(filter_value)
+            response = build_bind_response(message_id, result_code=0)
+            yield encode_ldap_message(response)
+            return
+
+        if op_tag == "1:1:3":
+            try:
+                search_request, _ = decoder.decode(op_bytes, asn1Spec=SearchRequestLooseMessage())
+            except Exception as exc:
+                logger.warning("Failed to decode search request err=%s", exc)
+                return
+            received_at = time.monotonic()
+            base_dn = _to_text(search_request.getComponentByName("baseObject"))
+            scope = int(search_request.getComponentByName("scope"))
+            size_limit = int(search_request.getComponentByName("sizeLimit"))
+            time_limit = int(search_request.getComponentByName("timeLimit"))
+            filter_value = search_request.getComponentByName("filter")
+            try:
+                filter_bytes = bytes(filter_value.asOctets())
+            except Exception:
+                filter_bytes = bytes(filter_value)
+            requested = [_to_text(name) for name in search_request.getComponentByName("attributes")]
+            selection = select_attributes(requested)
+            types_only = bool(search_request.getComponentByName("typesOnly"))
+            filter_node = parse_filter_bytes(filter_bytes)
 
+            # Request and result lines are sampled together so they stay paired.
+            log_request = logger.isEnabledFor(logging.INFO) and sample_request_log(
+                config.request_log_sample_every
+            )
+            if log_request:
                 logger.info(
-                    "Search request from %s base_dn=%s filter_len=%s",
-                    self.client_address[0],
+                    "Search request from %s message_id=%s base_dn=%s scope=%s tokens=%s attrs=%s types_only=%s size_limit=%s time_limit=%s",
+                    self.client_address,
+                    message_id,
                     base_dn,
-                    len(filter_bytes),
+                    scope,
+                    ",".join(filter_tokens(filter_node)) or "-",
+                    ",".join(selection) or "-",
+                    types_only,
+                    size_limit,
+                    time_limit,
                 )
 
-                entries = cache.get_entries()
-                max_results = max(1, int(config.max_results))
-                matched = filter_entries(entries, filter_bytes, max_results)
-                logger.info("Search results count=%s", len(matched))
-                for entry in matched:
-                    attributes = [
-                        ("uid", [entry.uid]),
-                        ("cn", [entry.cn]),
-                        ("telephoneNumber", [entry.telephone_number]),
-                        ("objectClass", list(entry.object_classes)),
-                    ]
-                    entry_msg = build_search_result_entry(
-                        message_id=message_id,
-                        dn=entry.dn,
-                        attributes=attributes,
-                    )
-                    self.request.sendall(encode_ldap_message(entry_msg))
-
-                done_msg = build_search_result_done(message_id=message_id, result_code=0)
-                self.request.sendall(encode_ldap_message(done_msg))
+            route = _route_search(config, base_dn, scope)
+            if route.kind == "root_dse":
+                attributes = select_root_dse(config.root_dse, requested, types_only)
+                yield encode_ldap_message(build_search_result_entry(message_id, "", attributes))
+                SEARCH_RESULTS.inc()
+                yield self._search_done(message_id, 0, 1, received_at, log_request)
                 return
-
-            if op_tag == "1:0:2":
-                logger.info("Unbind request from %s", self.client_address[0])
+            if route.kind == "empty":
+                yield self._search_done(message_id, 0, 0, received_at, log_request)
                 return
-
-            if op_tag == "1:1:23":
-                logger.info("Extended request from %s (responding not authorized)", self.client_address[0])
-                response = build_extended_response(message_id, result_code=50)
-                self.request.sendall(encode_ldap_message(response))
+            if route.kind == "no_such_object":
+                matched_dn = route.view.base_dn if route.view is not None else ""
+                yield self._search_done(message_id, 32, 0, received_at, log_request, matched_dn)
                 return
 
-            if op_tag in {"1:1:6", "1:1:8", "1:0:10", "1:1:12", "1:1:14"}:
-                response_name = {
-                    "1:1:6": "modifyResponse",
-                    "1:1:8": "addResponse",
-                    "1:0:10": "delResponse",
-                    "1:1:12": "modifyDNResponse",
-                    "1:1:14": "compareResponse",
-                }[op_tag]
-                logger.info(
-                    "Request op=%s op_tag=%s from %s (responding not authorized)",
-                    op_name,
-                    op_tag,
-                    self.client_address[0],
+            view = route.view
+            # A zero client limit means "no limit"; the server limit always applies.
+            # sizeLimitExceeded is only for the client's own limit; hitting the
+            # server's is success unless report_admin_limit asks for code 11.
+            max_results = max(1, int(view.max_results))
+            truncated_code = 11 if config.report_admin_limit else 0  # adminLimitExceeded
+            if 0 < size_limit <= max_results:
+                max_results = size_limit
+                truncated_code = 4  # sizeLimitExceeded
+            deadline = received_at + time_limit if time_limit > 0 else None
+
+            if route.kind == "entry":
+                entry = self._cache.get_entry(view.key, route.uid)
+                if entry is None:
+                    yield self._search_done(message_id, 32, 0, received_at, log_request, view.base_dn)
+                    return
+                result = self._match_results(
+                    [entry], filter_node, max_results, truncated_code, deadline, cancel, selection, types_only, None
                 )
-                response = build_ldap_result_response(message_id, response_name, result_code=50)
-                self.request.sendall(encode_ldap_message(response))
+            else:
+                entries, generation = self._cache.get_entries_generation(view.key)
+                # Identical searches against the same entries list (one per
+                # refresh and view) while one is being answered share its
+                # matches, and its encoded entries if they were already waiting
+                # when it finished matching; only the messageID framing is per
+                # search.
+                key = (id(entries), filter_bytes, max_results, truncated_code, time_limit, selection, types_only)
+                result, shared = _COALESCER.run(
+                    key,
+                    lambda has_followers: self._match_results(
+                        entries,
+                        filter_node,
+                        max_results,
+                        truncated_code,
+                        deadline,
+                        cancel,
+                        selection,
+                        types_only,
+                        (view.key, generation),
+                        has_followers,
+                    ),
+                    cancel,
+                    deadline,
+                )
+                if shared:
+                    COALESCED_SEARCHES.inc()
+            if cancel.is_set():
+                logger.info("Search message_id=%s abandoned during matching", message_id)
+                return
+            if result is None:
+                # The time limit passed while waiting on an identical search.
+                yield self._search_done(message_id, 3, 0, received_at, log_request)
                 return
 
-            if op_tag == "1:0:16":
-                logger.info("Abandon request from %s (ignored)", self.client_address[0])
+            result_code = result.result_code
+            sent = 0
+            if result.ops is not None:
+                # Encoded within the time limit, so sent in full.
+                for op in result.ops:
+                    if cancel.is_set():
+                        logger.info("Search message_id=%s abandoned after %s entries", message_id, sent)
+                        return
+                    yield frame_ldap_message(message_id, op)
+                    sent += 1
+            else:
+                # Entries matched before the time limit are all sent; otherwise
+                # encoding stops at the limit.
+                encode_deadline = deadline if result_code != 3 else None
+                encode_seconds = 0.0
+                for entry in result.matched:
+                    if cancel.is_set():
+                        logger.info("Search message_id=%s abandoned after %s entries", message_id, sent)
+                        return
+                    started = time.monotonic()
+                    if encode_deadline is not None and started >= encode_deadline:
+                        result_code = 3  # timeLimitExceeded
+                        break
+                    op = encode_search_result_entry_op(entry.dn, entry_attributes(entry, selection, types_only))
+                    encode_seconds += time.monotonic() - started
+                    yield frame_ldap_message(message_id, op)
+                    sent += 1
+                ENCODE_SECONDS.observe(encode_seconds)
+            SEARCH_RESULTS.inc(amount=sent)
+            yield self._search_done(message_id, result_code, sent, received_at, log_request)
+            return
+
+        if op_tag == "1:1:23":
+            logger.info("Extended request from %s (responding not authorized)", self.client_address)
+            response = build_extended_response(message_id, result_code=50)
+            yield encode_ldap_message(response)
+            return
+
+        if op_tag in _RESULT_RESPONSE_NAMES:
+            response_name = _RESULT_RESPONSE_NAMES[op_tag]
+            logger.info(
+                "Request op=%s op_tag=%s from %s (responding not authorized)",
+                op_name,
+                op_tag,
+                self.client_address,
+            )
+            response = build_ldap_result_response(message_id, response_name, result_code=50)
+            yield encode_ldap_message(response)
+            return
+
+        logger.info("Ignoring unsupported protocol op=%s op_tag=%s", op_name, op_tag)
+
+    def _match_results(
+        self,
+        entries: List[DirectoryEntry],
+        filter_node,
+        max_results: int,
+        truncated_code: int,
+        deadline: Optional[float],
+        cancel: threading.Event,
+        selection: Tuple[str, ...],
+        types_only: bool,
+        source: Optional[Hashable],
+        has_followers: Callable[[], bool] = lambda: False,
+    ) -> Optional[_SearchResult]:
+        # Returns None if the search was abandoned. Matches one extra entry so
+        # a truncated result can be told from an exact fit; a truncated result
+        # carries `truncated_code`. Entries are only encoded here when
+        # identical searches are waiting to share them; otherwise each one is
+        # encoded as it is sent. `source` names the view and cache generation
+        # the entries came from, so typeahead narrowing never reuses matches
+        # from other entries; None disables narrowing.
+        match_started = time.monotonic()
+        if source is not None:
+            matched, narrowed = self._narrower.match(entries, source, filter_node, max_results + 1, deadline, cancel)
+            if narrowed:
+                NARROWED_SEARCHES.inc()
+        else:
+            matched = match_entries(entries, filter_node, max_results + 1, deadline, cancel)
+        MATCH_SECONDS.observe(time.monotonic() - match_started)
+        if cancel.is_set():
+            return None
+        result_code = 0
+        if len(matched) > max_results:
+            matched = matched[:max_results]
+            result_code = truncated_code
+        elif deadline is not None and time.monotonic() >= deadline:
+            result_code = 3  # timeLimitExceeded
+        if not has_followers():
+            return _SearchResult(tuple(matched), None, result_code)
+
+        ops: List[bytes] = []
+        encode_started = time.monotonic()
+        for entry in matched:
+            if cancel.is_set():
+                return None
+            if deadline is not None and time.monotonic() >= deadline:
+                result_code = 3  # timeLimitExceeded
+                break
+            ops.append(encode_search_result_entry_op(entry.dn, entry_attributes(entry, selection, types_only)))
+        ENCODE_SECONDS.observe(time.monotonic() - encode_started)
+        return _SearchResult(tuple(matched), tuple(ops), result_code)
+
+    def _search_done(
+        self, message_id: int, result_code: int, sent: int, received_at: float, log_request: bool, matched_dn: str = ""
+    ) -> bytes:
+        if log_request:
+            logging.getLogger("aredn_ldap_bridge.ldap_server").info(
+                "Search results message_id=%s count=%s result_code=%s elapsed_ms=%.1f",
+                message_id,
+                sent,
+                result_code,
+                (time.monotonic() - received_at) * 1000,
+            )
+        done_msg = build_search_result_done(message_id=message_id, result_code=result_code, matched_dn=matched_dn)
+        data = encode_ldap_message(done_msg)
+        SEARCH_SECONDS.observe(time.monotonic() - received_at)
+        return data
+
+
+class _SearchResult(NamedTuple):
+    # The matched entries and, when the match was shared while in progress,
+    # their encoded searchResEntry protocolOps (framed per search by messageID).
+    matched: Tuple[DirectoryEntry, ...]
+    ops: Optional[Tuple[bytes, ...]]
+    result_code: int
+
+
+# Shared by every connection in the process.
+_COALESCER: SearchCoalescer[_SearchResult] = SearchCoalescer()
+
+
+class _SearchRoute(NamedTuple):
+    # kind: root_dse, view (match against the view), entry (one uid in the
+    # view), empty (success, nothing to return) or no_such_object.
+    kind: str
+    view: Optional[ViewConfig] = None
+    uid: str = ""
+
+
+_SCOPE_BASE_OBJECT = 0
+_SCOPE_SINGLE_LEVEL = 1
+
+
+def _route_search(config: Config, base_dn: str, scope: int) -> _SearchRoute:
+    # Resolves the search base with dict lookups only, before any entry is
+    # looked at. Entries sit directly below their view's base DN and the base
+    # entry itself is not served.
+    key = normalize_dn(base_dn)
+    view: Optional[ViewConfig] = None
+    if not key:
+        if scope == _SCOPE_BASE_OBJECT:
+            return _SearchRoute("root_dse")
+    else:
+        view = config.view_routes.get(key)
+        if view is not None:
+            if scope != _SCOPE_BASE_OBJECT or not config.strict_search_base:
+                return _SearchRoute("view", view)
+            return _SearchRoute("empty", view)
+        rdn, _, parent = key.partition(",")
+        view = config.view_routes.get(parent)
+        if view is not None and rdn.startswith("uid="):
+            if scope == _SCOPE_SINGLE_LEVEL:
+                return _SearchRoute("empty", view)
+            return _SearchRoute("entry", view, rdn[len("uid=") :])
+    if config.strict_search_base:
+        return _SearchRoute("no_such_object", view)
+    # Lenient: anything else searches the main view, as before routing.
+    return _SearchRoute("view", config.all_views[0])
+
+
+def _make_handler(live: LiveConfig, cache: LazyCache):
+    class LDAPRequestHandler(socketserver.BaseRequestHandler):
+        def setup(self) -> None:
+            # Socket and pipelining settings are fixed when the connection opens.
+            config = live.current
+            tune_socket(self.request, config)
+            # Each operation gets `write_timeout_seconds` to hand over all of its
+            # responses; `_send` sets the socket timeout to what is left of it.
+            # Reads wait in select().
+            self._write_timeout = config.write_timeout_seconds
+            self.request.settimeout(self._write_timeout if self._write_timeout > 0 else None)
+            self._session = LDAPSession(live, cache, self.client_address[0])
+            # Held while an operation streams its responses, so two operations'
+            # responses never interleave. Reentrant, since `_send` takes it too.
+            self._send_lock = threading.RLock()
+            self._write_timed_out = threading.Event()
+            # Set when the client closed its side cleanly: operations already
+            # read still run and are answered before the socket is shut down.
+            self._drain = False
+            # Up to `_limit` operations run at once on the server's shared pool
+            # (one, in arrival order, without pipelining); later ones wait in
+            # `_waiting`. `_idle` is notified whenever one finishes.
+            self._limit = max(1, int(config.pipeline_max_outstanding))
+            self._lock = threading.Lock()
+            self._idle = threading.Condition(self._lock)
+            self._running = 0
+            self._waiting: Deque[Tuple[int, bytes, threading.Event]] = deque()
+
+        def finish(self) -> None:
+            if not self._drain:
+                self._session.cancel_all()
+                try:
+                    # Unblock an operation stuck in sendall() to a client that went away.
+                    self.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            with self._idle:
+                while self._running or self._waiting:
+                    self._idle.wait()
+
+        def handle(self) -> None:
+            # This thread only reads, so abandon/unbind are seen at once even
+            # while an operation waits on the cache, matches or streams.
+            logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+            while True:
+                wait, reason = self._session.read_timeout()
+                if wait is not None and wait <= 0:
+                    logger.info("Closing connection from %s: %s timeout", self.client_address[0], reason)
+                    self.server.limiter.record_close(reason)
+                    return
+                readable, _, _ = select.select([self.request], [], [], wait)
+                if not readable:
+                    continue
+                try:
+                    data = self.request.recv(4096)
+                except OSError:
+                    return
+                if not data:
+                    # A write timeout shuts the socket down too; that is no EOF.
+                    self._drain = not self._write_timed_out.is_set()
+                    return
+                try:
+                    messages = self._session.feed(data)
+                except ValueError:
+                    return
+
+                for message_id, op_bytes in messages:
+                    op_tag = peek_ldap_op_tag(op_bytes)
+                    if op_tag == ABANDON_OP_TAG:
+                        self._session.abandon(op_bytes)
+                        continue
+                    if op_tag == UNBIND_OP_TAG:
+                        self._session.unbind()
+                        return
+                    if self._session.in_flight() >= self._limit + MAX_QUEUED_OPERATIONS:
+                        self._refuse(message_id, op_bytes)
+                        continue
+                    cancel = self._session.begin(message_id)
+                    if cancel is None:
+                        continue
+                    with self._lock:
+                        self._waiting.append((message_id, op_bytes, cancel))
+                        self._dispatch()
+
+        def _dispatch(self) -> None:
+            # Called with `_lock` held.
+            while self._running < self._limit and self._waiting:
+                self._running += 1
+                self.server.operations.submit(self._run_operation, *self._waiting.popleft())
+
+        def _run_operation(self, message_id: int, op_bytes: bytes, cancel: threading.Event) -> None:
+            logger = logging.getLogger("aredn_ldap_bridge.ldap_server")
+            try:
+                if not cancel.is_set():
+                    self._stream(self._session.responses(message_id, op_bytes, cancel))
+            except TimeoutError:
+                if not self._write_timed_out.is_set():
+                    self._write_timed_out.set()
+                    logger.info("Closing connection from %s: write timeout", self.client_address[0])
+                    self.server.limiter.record_close("write_timeout")
+                self._session.cancel_all()
+                try:
+                    # Wake the reader so the connection is torn down.
+                    self.request.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            except OSError as exc:
+                logger.info("Connection from %s closed while responding: %s", self.client_address[0], exc)
+            except Exception:
+                logger.exception("Failed to handle message_id=%s from %s", message_id, self.client_address[0])
+            finally:
+                self._session.end(message_id)
+                with self._lock:
+                    self._running -= 1
+                    self._dispatch()
+                    self._idle.notify_all()
+
+        def _stream(self, responses: Iterator[bytes]) -> None:
+            # Responses are sent as they are produced, so abandon and timeLimit,
+            # checked between entries, stop a search on the wire. Matching runs
+            # before the first response, outside the send lock.
+            try:
+                data = next(responses, None)
+                if data is None:
+                    return
+                with self._send_lock:
+                    deadline = self._write_deadline()
+                    while data is not None:
+                        self._send(data, deadline)
+                        data = next(responses, None)
+            finally:
+                responses.close()
+
+        def _refuse(self, message_id: int, op_bytes: bytes) -> None:
+            data = self._session.busy(message_id, op_bytes)
+            if data is None:
                 return
+            try:
+                self._send(data, self._write_deadline())
+            except OSError:
+                pass
+
+        def _write_deadline(self) -> Optional[float]:
+            if self._write_timeout <= 0:
+                return None
+            return time.monotonic() + self._write_timeout
 
-            logger.info("Ignoring unsupported protocol op=%s op_tag=%s", op_name, op_tag)
+        def _send(self, data: bytes, deadline: Optional[float]) -> None:
+            with self._send_lock:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("write timeout")
+                    self.request.settimeout(remaining)
+                self.request.sendall(data)
 
     return LDAPRequestHandler
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import logging
+import threading
+from typing import Dict
+
+
+class ConnectionLimiter:
+    # Admission control shared by both server engines. A connection is first
+    # admitted (counted against the per-IP limit and the accept queue), then
+    # activated once a worker slot is free, then released when it closes.
+
+    def __init__(self, max_connections: int, max_connections_per_ip: int, accept_queue_size: int) -> None:
+        self._lock = threading.Lock()
+        self._per_ip: Dict[str, int] = {}
+        self._active = 0
+        self._queued = 0
+        self._accepted_total = 0
+        self._rejected_per_ip = 0
+        self._rejected_queue_full = 0
+        self._closed: Dict[str, int] = {"idle": 0, "lifetime": 0, "write_timeout": 0}
+        self._logger = logging.getLogger("aredn_ldap_bridge.limits")
+        self.configure(max_connections, max_connections_per_ip, accept_queue_size)
+
+    @property
+    def max_connections(self) -> int:
+        return self._max_connections
+
+    def configure(self, max_connections: int, max_connections_per_ip: int, accept_queue_size: int) -> None:
+        with self._lock:
+            self._max_connections = max(1, int(max_connections))
+            # Zero disables the per-IP limit.
+            self._max_connections_per_ip = max(0, int(max_connections_per_ip))
+            self._accept_queue_size = max(0, int(accept_queue_size))
+
+    def admit(self, ip: str) -> bool:
+        with self._lock:
+            per_ip = self._per_ip.get(ip, 0)
+            if self._max_connections_per_ip and per_ip >= self._max_connections_per_ip:
+                self._rejected_per_ip += 1
+                reason = "per-ip limit %s" % self._max_connections_per_ip
+            elif self._active + self._queued >= self._max_connections + self._accept_queue_size:
+                self._rejected_queue_full += 1
+                reason = "accept queue full (%s active, %s queued)" % (self._active, self._queued)
+            else:
+                self._per_ip[ip] = per_ip + 1
+                self._queued += 1
+                self._accepted_total += 1
+                return True
+        self._logger.warning("Rejecting connection from %s: %s", ip, reason)
+        return False
+
+    def try_activate(self) -> bool:
+        with self._lock:
+            if self._active >= self._max_connections:
+                return False
+            self._queued -= 1
+            self._active += 1
+            return True
+
+    def activate(self) -> None:
+        with self._lock:
+            self._queued -= 1
+            self._active += 1
+
+    def release(self, ip: str, active: bool = True) -> None:
+        with self._lock:
+            if active:
+                self._active -= 1
+            else:
+                self._queued -= 1
+            remaining = self._per_ip.get(ip, 0) - 1
+            if remaining > 0:
+                self._per_ip[ip] = remaining
+            else:
+                self._per_ip.pop(ip, None)
+
+    def record_close(self, reason: str) -> None:
+        with self._lock:
+            self._closed[reason] = self._closed.get(reason, 0) + 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            closed = {f"closed_{reason}": count for reason, count in self._closed.items()}
+            return {
+                "max_connections": self._max_connections,
+                "max_connections_per_ip": self._max_connections_per_ip,
+                "accept_queue_size": self._accept_queue_size,
+                "active": self._active,
+                "queued": self._queued,
+                "clients": len(self._per_ip),
+                "accepted_total": self._accepted_total,
+                "rejected_per_ip": self._rejected_per_ip,
+                "rejected_queue_full": self._rejected_queue_full,
+                **closed,
+            }
@@ -1,11 +1,114 @@
 from __future__ import annotations
 
+import atexit
+import itertools
 import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
+_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
 
-def configure_logging(level: str) -> None:
+_listener: Optional[QueueListener] = None
+_queue_handler: Optional["_DroppingQueueHandler"] = None
+_request_counter = itertools.count()
+
+
+class _DroppingQueueHandler(QueueHandler):
+    # Never blocks the logging thread: when the queue is full the record is
+    # dropped and counted, and the count is reported once there is room again.
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Leave msg % args to the listener thread.
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        # Handler.handle holds the handler lock here, so the counters are safe.
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+            return
+        if self._unreported:
+            notice = logging.makeLogRecord(
+                {
+                    "name": "aredn_ldap_bridge.logging",
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": "Dropped %s log records (queue full, %s total)",
+                    "args": (self._unreported, self.dropped),
+                }
+            )
+            try:
+                self.queue.put_nowait(notice)
+                self._unreported = 0
+            except queue.Full:
+                pass
+
+
+class _BlockingStopListener(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # The listener is still draining, so waiting for room is safe.
+        self.queue.put(self._sentinel)
+
+
+def configure_logging(level: str, queue_size: int = 0) -> None:
     logging.basicConfig(
         level=level,
-        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+        format=_FORMAT,
     )
     logging.getLogger("pyasn1").setLevel(logging.WARNING)
+    if queue_size > 0:
+        _start_queue_logging(queue_size)
+
+
+def stop_logging() -> None:
+    # Flushes records still queued for the listener thread.
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def dropped_log_records() -> int:
+    return _queue_handler.dropped if _queue_handler is not None else 0
+
+
+def sample_request_log(every: int) -> bool:
+    # Per-request logs are kept for one request in `every`.
+    if every <= 1:
+        return True
+    return next(_request_counter) % every == 0
+
+
+def _start_queue_logging(queue_size: int) -> None:
+    global _listener, _queue_handler
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for handler in handlers:
+        root.removeHandler(handler)
+    _queue_handler = _DroppingQueueHandler(queue.Queue(queue_size))
+    root.addHandler(_queue_handler)
+    _listener = _BlockingStopListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    os.register_at_fork(after_in_child=_restart_after_fork)
+
+
+def _restart_after_fork() -> None:
+    # The listener thread does not survive fork; give the child its own queue
+    # and listener so queued records never land in a queue nobody drains.
+    global _listener
+    if _listener is None or _queue_handler is None:
+        return
+    log_queue: queue.Queue = queue.Queue(_queue_handler.queue.maxsize)
+    _queue_handler.queue = log_queue
+    _listener = _BlockingStopListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
@@ -1,6 +1,9 @@
 from __future__ import annotations
 
-from typing import Iterable, List
+import threading
+import time
+import weakref
+from typing import Hashable, Iterable, List, NamedTuple, Optional, Tuple
 
 from .model import DirectoryEntry
 
@@ -9,10 +12,26 @@ def filter_entries(
     entries: Iterable[DirectoryEntry],
     filter_bytes: bytes,
     max_results: int,
+    deadline: float | None = None,
+    cancel: threading.Event | None = None,
+) -> List[DirectoryEntry]:
+    return match_entries(entries, parse_filter_bytes(filter_bytes), max_results, deadline, cancel)
+
+
+def match_entries(
+    entries: Iterable[DirectoryEntry],
+    filter_node: "FilterNode",
+    max_results: int,
+    deadline: float | None = None,
+    cancel: threading.Event | None = None,
 ) -> List[DirectoryEntry]:
-    filter_node = parse_filter_bytes(filter_bytes)
     matched: List[DirectoryEntry] = []
-    for entry in entries:
+    for index, entry in enumerate(entries):
+        if index % _CHUNK_SIZE == 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if cancel is not None and cancel.is_set():
+                break
         if _match_filter(entry, filter_node):
             matched.append(entry)
             if len(matched) >= max_results:
@@ -20,14 +39,175 @@ def filter_entries(
     return matched
 
 
+class _Narrowing(NamedTuple):
+    # (view key, cache generation) the search ran against.
+    source: Hashable
+    node: "FilterNode"
+    # Every entry of entries[:scanned] that matches `node`, in order.
+    matched: List[DirectoryEntry]
+    scanned: int
+    narrowable: bool
+
+
+# Every live narrower, so a cache refresh can drop what they remember.
+_NARROWERS: "weakref.WeakSet[TypeaheadNarrower]" = weakref.WeakSet()
+_NARROWERS_LOCK = threading.Lock()
+
+
+class TypeaheadNarrower:
+    # Per-connection memory of the last search. Phone typeahead sends chains
+    # like "*a*", "*ab*", "*abc*" on one connection; when a filter provably
+    # narrows the previous one, only the previous matches are rechecked and
+    # the scan resumes where the previous one stopped, so a search whose
+    # predecessor scanned the whole directory costs O(previous results).
+    # Only the matches are kept, not the entry list, so an idle connection
+    # never holds an old snapshot alive; the state is tied to the cache
+    # generation and dropped on refresh.
+
+    def __init__(self) -> None:
+        self._last: Optional[_Narrowing] = None
+        with _NARROWERS_LOCK:
+            _NARROWERS.add(self)
+
+    def forget(self) -> None:
+        self._last = None
+
+    def match(
+        self,
+        entries: List[DirectoryEntry],
+        source: Hashable,
+        filter_node: "FilterNode",
+        max_results: int,
+        deadline: float | None = None,
+        cancel: threading.Event | None = None,
+    ) -> Tuple[List[DirectoryEntry], bool]:
+        # Returns up to `max_results` matches and whether narrowing applied.
+        # `source` identifies `entries`: the same source must always mean the
+        # same list.
+        last = self._last
+        narrowable = _node_count(filter_node) <= _MAX_NARROWING_NODES
+        narrowed = (
+            last is not None
+            and last.source == source
+            and narrowable
+            and last.narrowable
+            and narrows(filter_node, last.node)
+        )
+        if narrowed:
+            matched = [entry for entry in last.matched if _match_filter(entry, filter_node)]
+            scanned = last.scanned
+        else:
+            matched = []
+            scanned = 0
+        if len(matched) < max_results:
+            scanned = _scan(entries, filter_node, matched, scanned, max_results, deadline, cancel)
+        self._last = _Narrowing(source, filter_node, matched, scanned, narrowable)
+        return matched[:max_results], narrowed
+
+
+def forget_narrowing() -> None:
+    # Called when the cache replaces its entries.
+    with _NARROWERS_LOCK:
+        narrowers = list(_NARROWERS)
+    for narrower in narrowers:
+        narrower.forget()
+
+
+def narrows(new: "FilterNode", old: "FilterNode") -> bool:
+    # True only if every entry matching `new` also matches `old`; False when
+    # that cannot be shown from the filter structure alone.
+    if _matches_all(old):
+        return True
+    if new.op == "or":
+        return all(narrows(child, old) for child in new.children)
+    if old.op == "and":
+        return all(narrows(new, child) for child in old.children)
+    if new.op == "and" and any(narrows(child, old) for child in new.children):
+        return True
+    if old.op == "or":
+        return any(narrows(new, child) for child in old.children)
+    if new.op == "tokens" and old.op == "tokens":
+        # Each old token inside some new token: the new tokens being in the
+        # search blob puts the old ones there too.
+        new_tokens = _normalized_tokens(new)
+        return all(any(token in longer for longer in new_tokens) for token in _normalized_tokens(old))
+    if new.op == "not" and old.op == "not" and new.children and old.children:
+        return narrows(old.children[0], new.children[0])
+    return False
+
+
+def _matches_all(node: "FilterNode") -> bool:
+    if node.op == "tokens":
+        return not _normalized_tokens(node)
+    if node.op == "and":
+        return all(_matches_all(child) for child in node.children)
+    if node.op == "or":
+        return any(_matches_all(child) for child in node.children)
+    if node.op == "not":
+        return not node.children
+    return True
+
+
+def _normalized_tokens(node: "FilterNode") -> List[str]:
+    # Same normalization as _token_matches.
+    return [token for token in (raw.strip().lower() for raw in node.tokens) if token]
+
+
+def _node_count(node: "FilterNode") -> int:
+    return 1 + sum(_node_count(child) for child in node.children)
+
+
+def _scan(
+    entries: List[DirectoryEntry],
+    filter_node: "FilterNode",
+    matched: List[DirectoryEntry],
+    start: int,
+    max_results: int,
+    deadline: float | None,
+    cancel: threading.Event | None,
+) -> int:
+    # Appends matches from entries[start:] until `matched` holds max_results;
+    # returns the index scanning stopped at.
+    index = start
+    total = len(entries)
+    while index < total:
+        if (index - start) % _CHUNK_SIZE == 0:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if cancel is not None and cancel.is_set():
+                break
+        entry = entries[index]
+        index += 1
+        if _match_filter(entry, filter_node):
+            matched.append(entry)
+            if len(matched) >= max_results:
+                break
+    return index
+
+
 class FilterNode:
     def __init__(self, op: str, tokens: List[str] | None = None, children: List["FilterNode"] | None = None):
         self.op = op
         self.tokens = tokens or []
         self.children = children or []
 
+
+def filter_tokens(node: FilterNode) -> List[str]:
+    if node.op == "tokens":
+        return list(node.tokens)
+    tokens: List[str] = []
+    for child in node.children:
+        tokens.extend(filter_tokens(child))
+    return tokens
+
+
 _MAX_FILTER_DEPTH = 20
 _MAX_FILTER_NODES = 200
+# Deadline and cancellation are checked once per chunk of entries.
+_CHUNK_SIZE = 256
+# Narrowing is only tried on filters this small; typeahead filters have a
+# handful of nodes.
+_MAX_NARROWING_NODES = 32
 
 
 def _match_filter(entry: DirectoryEntry, node: FilterNode) -> bool:
@@ -0,0 +1,294 @@
+from __future__ import annotations
+
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple
+
+_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Shards:
+    # Each thread updates its own list of slots, so recording never takes a
+    # lock. Reads sum every shard; shards of exited threads are folded into
+    # `_retired` so per-connection threads do not accumulate.
+
+    def __init__(self, size: int) -> None:
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[Tuple[threading.Thread, List[float]]] = []
+        self._retired = [0.0] * size
+
+    def slots(self) -> List[float]:
+        try:
+            return self._local.slots
+        except AttributeError:
+            return self._register()
+
+    def totals(self) -> List[float]:
+        with self._lock:
+            self._fold_locked()
+            totals = list(self._retired)
+            for _, slots in self._shards:
+                for index, value in enumerate(slots):
+                    totals[index] += value
+        return totals
+
+    def _register(self) -> List[float]:
+        slots = [0.0] * self._size
+        with self._lock:
+            self._fold_locked()
+            self._shards.append((threading.current_thread(), slots))
+        self._local.slots = slots
+        return slots
+
+    def _fold_locked(self) -> None:
+        live = []
+        for thread, slots in self._shards:
+            if thread.is_alive():
+                live.append((thread, slots))
+                continue
+            for index, value in enumerate(slots):
+                self._retired[index] += value
+        self._shards = live
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children: Dict[Tuple[str, ...], _Shards] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        shards = self._children.get(labels)
+        if shards is None:
+            with self._lock:
+                shards = self._children.setdefault(labels, _Shards(1))
+        shards.slots()[0] += amount
+
+    def reset(self) -> None:
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for labels, shards in children:
+            lines.append(f"{self.name}{_format_labels(self._labelnames, labels)} {_format_value(shards.totals()[0])}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float] = _LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.help_text = help_text
+        self._bounds = tuple(buckets)
+        # One slot per bucket, one for +Inf, then the running sum.
+        self._shards = _Shards(len(self._bounds) + 2)
+
+    def observe(self, value: float) -> None:
+        slots = self._shards.slots()
+        slots[bisect.bisect_left(self._bounds, value)] += 1
+        slots[-1] += value
+
+    def reset(self) -> None:
+        self._shards = _Shards(len(self._bounds) + 2)
+
+    def render(self) -> List[str]:
+        totals = self._shards.totals()
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0.0
+        for bound, count in zip(self._bounds, totals):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {_format_value(cumulative)}')
+        cumulative += totals[len(self._bounds)]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {_format_value(cumulative)}')
+        lines.append(f"{self.name}_sum {_format_value(totals[-1])}")
+        lines.append(f"{self.name}_count {_format_value(cumulative)}")
+        return lines
+
+
+class _CallbackGauge:
+    # With a label name, `read` returns {label value: gauge value}.
+
+    def __init__(self, name: str, help_text: str, read: Callable, labelname: str = "") -> None:
+        self.name = name
+        self.help_text = help_text
+        self._read = read
+        self._labelname = labelname
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        if not self._labelname:
+            lines.append(f"{self.name} {_format_value(self._read())}")
+            return lines
+        for label, value in sorted(self._read().items()):
+            lines.append(f"{self.name}{_format_labels((self._labelname,), (label,))} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._metrics: List = []
+        self._gauges: Dict[str, _CallbackGauge] = {}
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = _LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help_text: str, read: Callable, labelname: str = "") -> None:
+        # Gauges are read only when scraped; registering a name again replaces it.
+        with self._lock:
+            self._gauges[name] = _CallbackGauge(name, help_text, read, labelname)
+
+    def reset(self) -> None:
+        # A forked child starts from zero rather than inheriting the parent's
+        # counts and its possibly-held locks.
+        self._lock = threading.Lock()
+        self._gauges = {}
+        for metric in self._metrics:
+            metric.reset()
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        with self._lock:
+            gauges = list(self._gauges.values())
+        for gauge in gauges:
+            try:
+                lines.extend(gauge.render())
+            except Exception as exc:
+                logging.getLogger("aredn_ldap_bridge.metrics").warning("Gauge %s failed: %s", gauge.name, exc)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+os.register_at_fork(after_in_child=REGISTRY.reset)
+
+SEARCH_SECONDS = REGISTRY.histogram(
+    "aredn_ldap_search_duration_seconds", "Time from search request to searchResDone."
+)
+MATCH_SECONDS = REGISTRY.histogram("aredn_ldap_match_duration_seconds", "Time spent matching the filter.")
+ENCODE_SECONDS = REGISTRY.histogram(
+    "aredn_ldap_encode_duration_seconds", "Time spent building and encoding result messages per search."
+)
+REFRESH_SECONDS = REGISTRY.histogram("aredn_ldap_refresh_duration_seconds", "Time spent refreshing from upstream.")
+OPERATIONS = REGISTRY.counter("aredn_ldap_operations_total", "LDAP operations received.", ("op",))
+SEARCH_RESULTS = REGISTRY.counter("aredn_ldap_search_results_total", "Search result entries returned.")
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "aredn_ldap_upstream_requests_total", "Upstream sysinfo requests by node.", ("node", "outcome")
+)
+PEER_SYNCS = REGISTRY.counter(
+    "aredn_ldap_peer_syncs_total", "Snapshot syncs from peer bridges by peer and outcome.", ("peer", "outcome")
+)
+PEER_REQUESTS = REGISTRY.counter(
+    "aredn_ldap_peer_requests_total", "Snapshot requests served to peer bridges.", ("kind",)
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "aredn_ldap_cache_requests_total", "Directory lookups served fresh (hit), after waiting (wait) or refreshed (miss).", ("result",)
+)
+NARROWED_SEARCHES = REGISTRY.counter(
+    "aredn_ldap_search_narrowed_total", "Searches matched against the connection's previous results only."
+)
+COALESCED_SEARCHES = REGISTRY.counter(
+    "aredn_ldap_search_coalesced_total", "Searches answered with the result of an identical concurrent search."
+)
+CACHE_REFRESHES = REGISTRY.counter(
+    "aredn_ldap_cache_refreshes_total", "Successful refreshes by whether upstream had changed.", ("result",)
+)
+
+
+class MetricsServer:
+    def __init__(self, address: str, port: int) -> None:
+        self._server = ThreadingHTTPServer((address, port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def close_socket(self) -> None:
+        # For a forked child, which has the listening socket but no serving thread.
+        self._server.server_close()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", _CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def start_metrics_server(address: str, port: int) -> MetricsServer:
+    server = MetricsServer(address, port)
+    server.start()
+    logging.getLogger("aredn_ldap_bridge.metrics").info("Metrics listening on http://%s:%s/metrics", address, port)
+    return server
+
+
+def register_cache_gauges(cache) -> None:
+    def _age() -> float:
+        _, refreshed_at = cache.snapshot_info()
+        return time.time() - refreshed_at if refreshed_at else float("nan")
+
+    REGISTRY.gauge("aredn_ldap_cache_age_seconds", "Seconds since the last successful refresh.", _age)
+    REGISTRY.gauge(
+        "aredn_ldap_cache_generation", "Times the served entries changed so far.", lambda: cache.snapshot_info()[0]
+    )
+    REGISTRY.gauge(
+        "aredn_ldap_cache_ttl_seconds", "Effective cache TTL.", lambda: cache.ttl_info()["ttl_seconds"]
+    )
+    if hasattr(cache, "node_status"):
+        REGISTRY.gauge(
+            "aredn_ldap_upstream_age_seconds",
+            "Seconds since each upstream node last answered (NaN if never).",
+            cache.node_status,
+            "node",
+        )
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value != value:
+        return "NaN"
+    return str(int(value)) if value.is_integer() else repr(value)
@@ -0,0 +1,311 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import timeit
+import tracemalloc
+from typing import Callable, Dict, List, Tuple
+
+from .ldap_protocol import build_search_result_entry, encode_ldap_message
+from .matcher import TypeaheadNarrower, filter_entries, match_entries, parse_filter_bytes
+from .mock_sysinfo import build_services
+from .model import entries_from_services, entry_attributes
+
+_BASE_DN = "dc=local,dc=mesh"
+_DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "bench", "microbench-baseline.json"
+)
+_MIN_REPEAT_SECONDS = 0.05
+# Repeated runs of one tree on one machine moved the normalized medians by up
+# to about 25%; the default threshold leaves headroom above that.
+_DEFAULT_THRESHOLD = 0.4
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="AREDN LDAP Bridge component micro-benchmarks")
+    parser.add_argument("--baseline", default=_DEFAULT_BASELINE, help="Baseline JSON to compare against")
+    parser.add_argument("--record", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=_DEFAULT_THRESHOLD,
+        help="Allowed slowdown against baseline (0.4 = 40%%)",
+    )
+    parser.add_argument("--only", action="append", default=[], help="Run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=15, help="Timed rounds per benchmark; the median is kept")
+    parser.add_argument("--output", help="Also write the results JSON here")
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    mismatches = _check_narrowing()
+    if mismatches:
+        print(f"Typeahead narrowing differs from a full search: {', '.join(mismatches)}")
+        sys.exit(1)
+    results: Dict[str, Dict[str, float]] = {}
+    calibrations: List[float] = []
+    for name, function in _benchmarks(args.only):
+        seconds, calibration, normalized = _time_normalized(function, args.repeat)
+        calibrations.append(calibration)
+        results[name] = {"seconds": seconds, "normalized": normalized}
+    for name, function in _memory_benchmarks(args.only):
+        results[name] = {"bytes": _retained_bytes(function)}
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "calibration_seconds": statistics.median(calibrations) if calibrations else 0.0,
+        "results": results,
+    }
+    if args.output:
+        _write_json(args.output, report)
+    if args.record:
+        _write_json(args.baseline, report)
+        print(f"Recorded baseline {args.baseline}")
+
+    baseline = {}
+    if not args.record and os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as handle:
+            recorded = json.load(handle)
+        # Timings shift between interpreter versions by more than any threshold
+        # worth gating on, so only compare against a baseline from the same one.
+        if _major_minor(recorded.get("python", "")) == _major_minor(report["python"]):
+            baseline = recorded.get("results", {})
+        else:
+            print(
+                f"Baseline {args.baseline} was recorded on Python {recorded.get('python', 'unknown')}, "
+                f"this is {report['python']}; not comparing. Re-record it with --record."
+            )
+
+    regressions = []
+    print(f"{'benchmark':44} {'per call':>12} {'normalized':>11} {'vs base':>8}")
+    for name, result in results.items():
+        change = ""
+        base = baseline.get(name)
+        key = "bytes" if "bytes" in result else "normalized"
+        if base and base.get(key):
+            ratio = result[key] / base[key]
+            change = f"{(ratio - 1) * 100:+.1f}%"
+            if ratio > 1 + args.threshold:
+                regressions.append(name)
+                change += " !"
+        if key == "bytes":
+            print(f"{name:44} {result['bytes']:>10} B {'':>11} {change:>8}")
+        else:
+            print(f"{name:44} {_format_seconds(result['seconds']):>12} {result['normalized']:>11.4f} {change:>8}")
+
+    if regressions:
+        print(f"Regressed beyond {args.threshold * 100:.0f}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+def _benchmarks(only: List[str]) -> List[Tuple[str, Callable[[], object]]]:
+    benchmarks: List[Tuple[str, Callable[[], object]]] = []
+
+    def add(name: str, function: Callable[[], object]) -> None:
+        if not only or any(part in name for part in only):
+            benchmarks.append((name, function))
+
+    for name, data in _filters().items():
+        add(f"parse_filter_bytes[{name}]", lambda data=data: parse_filter_bytes(data))
+
+    typeahead = _or(_substring("cn", "k6"), _substring("telephoneNumber", "k6"))
+    miss = _substring("cn", "zzqx")
+    for size in (1_000, 10_000, 100_000):
+        entries = entries_from_services(build_services(size, seed=size), _BASE_DN)
+        add(f"filter_entries[{size // 1000}k,typeahead]", lambda e=entries: filter_entries(e, typeahead, 21))
+        add(f"filter_entries[{size // 1000}k,full_scan]", lambda e=entries: filter_entries(e, miss, 21))
+        if size == 10_000:
+            # A typeahead step after a full scan: only the previous results are rechecked.
+            narrower = TypeaheadNarrower()
+            narrower.match(entries, "bench", parse_filter_bytes(miss), 21)
+            narrowed = parse_filter_bytes(_substring("cn", "zzqxy"))
+            add("typeahead_narrowing[10k]", lambda e=entries: narrower.match(e, "bench", narrowed, 21))
+
+    for size in (1_000, 10_000):
+        services = build_services(size, seed=size)
+        add(f"entries_from_services[{size // 1000}k]", lambda s=services: entries_from_services(s, _BASE_DN))
+
+    page = entries_from_services(build_services(20), _BASE_DN)
+    add("encode_search_entries[20]", lambda: _encode_page(page))
+    return benchmarks
+
+
+def _memory_benchmarks(only: List[str]) -> List[Tuple[str, Callable[[], object]]]:
+    services = build_services(10_000, seed=1)
+    benchmarks = [("entries_memory[10k]", lambda: entries_from_services(services, _BASE_DN))]
+    return [(name, function) for name, function in benchmarks if not only or any(part in name for part in only)]
+
+
+def _check_narrowing() -> List[str]:
+    # Replays typeahead chains through one narrower, the way a connection
+    # would, and compares each answer with a full search. The chains cover
+    # growing tokens, added AND terms, backspaces, results cut off by the
+    # limit (the scan resumes) and a refresh to different entries.
+    first = entries_from_services(build_services(10_000, seed=7), _BASE_DN)
+    second = entries_from_services(build_services(10_000, seed=8), _BASE_DN)
+    chains = [
+        [_substring("cn", token) for token in ("k", "k6", "k6a", "k6ab", "k6a", "k")],
+        [_or(_substring("cn", token), _substring("telephoneNumber", token)) for token in ("1", "12", "123", "1234")],
+        [
+            _substring("cn", "a"),
+            _and(_substring("cn", "a"), _present("objectClass")),
+            _and(_substring("cn", "ab"), _present("objectClass")),
+            _and(_substring("cn", "ab"), _present("objectClass"), _substring("telephoneNumber", "1")),
+        ],
+        [_substring("cn", token) for token in ("zz", "zzq", "zzqx")],
+    ]
+    mismatches = []
+    narrower = TypeaheadNarrower()
+    for source, entries in (("first", first), ("first", first), ("second", second)):
+        for chain in chains:
+            for data in chain:
+                for max_results in (21, 10_001):
+                    node = parse_filter_bytes(data)
+                    matched, _ = narrower.match(entries, source, node, max_results)
+                    if matched != match_entries(entries, node, max_results):
+                        mismatches.append(f"{source}:{data.hex()}:{max_results}")
+    return mismatches
+
+
+def _retained_bytes(function: Callable[[], object]) -> int:
+    # Bytes still allocated while the result is alive.
+    tracemalloc.start()
+    try:
+        result = function()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained
+
+
+def _encode_page(entries) -> int:
+    total = 0
+    for message_id, entry in enumerate(entries, start=1):
+        message = build_search_result_entry(message_id=message_id, dn=entry.dn, attributes=entry_attributes(entry))
+        total += len(encode_ldap_message(message))
+    return total
+
+
+def _filters() -> Dict[str, bytes]:
+    # Representative phone filters plus adversarial shapes near the parser's limits.
+    return {
+        "substring": _substring("cn", "jo"),
+        "spa_typeahead": _or(_substring("cn", "jo"), _substring("telephoneNumber", "jo")),
+        "equality": _equality("cn", "KJ6ABC Shack"),
+        "and_of_ors": _and(
+            _or(_substring("cn", "k6"), _substring("telephoneNumber", "k6")),
+            _or(_substring("cn", "eoc"), _substring("telephoneNumber", "eoc")),
+            _present("objectClass"),
+        ),
+        "deep_not_19": _nested_not(_substring("cn", "a"), 19),
+        "too_deep_40": _nested_not(_substring("cn", "a"), 40),
+        "wide_or_199": _or(*[_substring("cn", f"t{index}") for index in range(199)]),
+        "too_wide_or_400": _or(*[_substring("cn", f"t{index}") for index in range(400)]),
+        "long_token_4k": _substring("cn", "x" * 4096),
+    }
+
+
+def _tlv(tag: int, payload: bytes) -> bytes:
+    length = len(payload)
+    if length < 0x80:
+        return bytes([tag, length]) + payload
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([tag, 0x80 | len(encoded)]) + encoded + payload
+
+
+def _octets(value: str) -> bytes:
+    return _tlv(0x04, value.encode("utf-8"))
+
+
+def _substring(attribute: str, value: str) -> bytes:
+    return _tlv(0xA4, _octets(attribute) + _tlv(0x30, _tlv(0x81, value.encode("utf-8"))))
+
+
+def _equality(attribute: str, value: str) -> bytes:
+    return _tlv(0xA3, _octets(attribute) + _octets(value))
+
+
+def _present(attribute: str) -> bytes:
+    return _tlv(0x87, attribute.encode("utf-8"))
+
+
+def _and(*children: bytes) -> bytes:
+    return _tlv(0xA0, b"".join(children))
+
+
+def _or(*children: bytes) -> bytes:
+    return _tlv(0xA1, b"".join(children))
+
+
+def _nested_not(child: bytes, depth: int) -> bytes:
+    for _ in range(depth):
+        child = _tlv(0xA2, child)
+    return child
+
+
+def _calibration_loop() -> int:
+    words = [f"KJ6ABC {index} Shack" for index in range(5000)]
+    hits = 0
+    for word in words:
+        if "ab" in word.lower():
+            hits += 1
+    return hits
+
+
+def _time_normalized(function: Callable[[], object], repeat: int) -> Tuple[float, float, float]:
+    # Each round times the calibration loop right before the benchmark, so a
+    # change in machine speed during the run moves both alike. Returns the
+    # medians of the benchmark time, the calibration time and their ratio
+    # (normalized to a fixed pure-Python loop so baselines recorded on one
+    # machine stay meaningful on another).
+    bench_timer, bench_number = _timer(function)
+    calibration_timer, calibration_number = _timer(_calibration_loop)
+    seconds: List[float] = []
+    calibrations: List[float] = []
+    ratios: List[float] = []
+    for _ in range(max(1, repeat)):
+        calibration = calibration_timer.timeit(calibration_number) / calibration_number
+        elapsed = bench_timer.timeit(bench_number) / bench_number
+        calibrations.append(calibration)
+        seconds.append(elapsed)
+        ratios.append(elapsed / calibration)
+    return statistics.median(seconds), statistics.median(calibrations), statistics.median(ratios)
+
+
+def _timer(function: Callable[[], object]) -> Tuple[timeit.Timer, int]:
+    # Calls per round, enough for a round to last _MIN_REPEAT_SECONDS.
+    timer = timeit.Timer(function)
+    number, elapsed = timer.autorange()
+    if elapsed < _MIN_REPEAT_SECONDS:
+        number = max(1, int(number * _MIN_REPEAT_SECONDS / max(elapsed, 1e-9)))
+    return timer, number
+
+
+def _major_minor(version: str) -> str:
+    return ".".join(version.split(".")[:2])
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.2f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds:.3f} s"
+
+
+def _write_json(path: str, data: Dict) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as handle:
+        json.dump(data, handle, indent=2, sort_keys=True)
+        handle.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import random
+import socket
+import string
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+_CALLSIGN_PREFIXES = ("K", "W", "N", "AB", "KD", "KI", "KJ", "KK", "WB", "N0")
+_LOCATIONS = (
+    "Shack",
+    "Office",
+    "EOC",
+    "Tower",
+    "Net Control",
+    "Hospital",
+    "Fire Station",
+    "Red Cross",
+    "Command Post",
+    "Base Camp",
+)
+_TACTICAL = ("Dispatch", "Logistics", "Medical", "Shelter", "Staging", "Comms", "Planning", "Triage", "Supply")
+NAME_STYLES = ("callsign", "tactical", "mixed")
+FAULT_KINDS = ("ok", "latency", "drip", "truncate", "error", "reset")
+_DRIP_CHUNKS = 20
+logger = logging.getLogger("aredn_ldap_bridge.mock_sysinfo")
+
+
+def build_services(
+    count: int,
+    seed: int = 0,
+    name_style: str = "callsign",
+    callsigns: int = 0,
+    protocols: Optional[Dict[str, float]] = None,
+) -> List[dict]:
+    # Synthetic services shaped like AREDN sysinfo output: callsign plus
+    # location names, one address per node, about a third with a SIP link.
+    # `callsigns` > 0 draws names from that many operators, so several
+    # services share a prefix; `protocols` maps protocol to relative weight.
+    if name_style not in NAME_STYLES:
+        raise ValueError(f"name_style must be one of {', '.join(NAME_STYLES)}")
+    rng = random.Random(seed)
+    operators = [_callsign(rng) for _ in range(callsigns)] if callsigns > 0 else []
+    mix = sorted(protocols.items()) if protocols else []
+    services: List[dict] = []
+    for index in range(count):
+        callsign = rng.choice(operators) if operators else _callsign(rng)
+        style = name_style if name_style != "mixed" else rng.choice(("callsign", "tactical"))
+        if style == "tactical":
+            label = f"{rng.choice(_LOCATIONS)} {rng.choice(_TACTICAL)} {callsign}"
+        else:
+            label = f"{callsign} {rng.choice(_LOCATIONS)}"
+        protocol = _weighted(rng, mix) if len(mix) > 1 else (mix[0][0] if mix else "phone")
+        ip = f"10.{(index >> 16) & 0xFF}.{(index >> 8) & 0xFF}.{index & 0xFF}"
+        if protocol == "phone":
+            link = f"sip:{ip}" if rng.random() < 0.3 else ""
+        else:
+            link = f"{protocol}://{ip}/"
+        services.append({"name": f"{label} [{protocol}]", "protocol": protocol, "ip": ip, "link": link})
+    return services
+
+
+def parse_protocol_mix(text: str) -> Dict[str, float]:
+    # "phone:70,http:25,ssh:5"
+    mix: Dict[str, float] = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        name, _, weight = item.partition(":")
+        mix[name.strip().lower()] = float(weight) if weight.strip() else 1.0
+    if not mix or any(weight < 0 for weight in mix.values()) or sum(mix.values()) <= 0:
+        raise ValueError(f"Invalid protocol mix: {text!r}")
+    return mix
+
+
+def _callsign(rng: random.Random) -> str:
+    callsign = rng.choice(_CALLSIGN_PREFIXES) + str(rng.randint(0, 9))
+    return callsign + "".join(rng.choice(string.ascii_uppercase) for _ in range(rng.randint(2, 3)))
+
+
+def _weighted(rng: random.Random, mix: List[Tuple[str, float]]) -> str:
+    point = rng.random() * sum(weight for _, weight in mix)
+    for name, weight in mix:
+        point -= weight
+        if point < 0:
+            return name
+    return mix[-1][0]
+
+
+class FaultSchedule:
+    # A cyclic list of per-request behaviours, e.g.
+    # "ok,ok,latency:2,drip:1,truncate:0.5,error:503,reset". Each request to
+    # the mock takes the next step.
+
+    def __init__(self, spec: str = "ok") -> None:
+        self.steps = _parse_faults(spec)
+        self._lock = threading.Lock()
+        self._position = 0
+
+    def next(self) -> Tuple[str, float]:
+        with self._lock:
+            step = self.steps[self._position % len(self.steps)]
+            self._position += 1
+        return step
+
+
+def _parse_faults(spec: str) -> List[Tuple[str, float]]:
+    defaults = {"ok": 0.0, "latency": 1.0, "drip": 1.0, "truncate": 0.5, "error": 500.0, "reset": 0.0}
+    steps: List[Tuple[str, float]] = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        kind, _, argument = item.strip().partition(":")
+        kind = kind.lower()
+        if kind not in defaults:
+            raise ValueError(f"Unknown fault {kind!r}; expected one of {', '.join(FAULT_KINDS)}")
+        steps.append((kind, float(argument) if argument else defaults[kind]))
+    return steps or [("ok", 0.0)]
+
+
+class MockSysinfoServer:
+    # Local stand-in for an AREDN node's /a/sysinfo?services=1 endpoint.
+
+    def __init__(
+        self, services: List[dict], host: str = "127.0.0.1", port: int = 0, faults: str = "ok"
+    ) -> None:
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.faults_injected: Dict[str, int] = {}
+        self.set_services(services)
+        self.set_faults(faults)
+        self._server = ThreadingHTTPServer((host, port), _SysinfoHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="mock-sysinfo", daemon=True)
+
+    @property
+    def address(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"{host}:{port}"
+
+    def set_services(self, services: List[dict]) -> None:
+        body = json.dumps({"services": services}).encode("utf-8")
+        with self._lock:
+            self.services = services
+            self._body = body
+
+    def set_faults(self, spec: str) -> None:
+        schedule = FaultSchedule(spec)
+        with self._lock:
+            self._faults = schedule
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def close(self) -> None:
+        if self._thread.is_alive():
+            self._server.shutdown()
+        self._server.server_close()
+
+    def _next_response(self) -> Tuple[bytes, str, float]:
+        with self._lock:
+            body = self._body
+            schedule = self._faults
+            self.requests += 1
+        kind, argument = schedule.next()
+        if kind != "ok":
+            with self._lock:
+                self.faults_injected[kind] = self.faults_injected.get(kind, 0) + 1
+        return body, kind, argument
+
+
+class _SysinfoHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if not self.path.startswith("/a/sysinfo"):
+            self.send_error(404)
+            return
+        body, kind, argument = self.server.mock._next_response()
+        if kind == "reset":
+            # SO_LINGER with a zero timeout makes close() send an RST.
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return
+        if kind == "error":
+            self.send_error(int(argument))
+            return
+        if kind == "latency":
+            time.sleep(argument)
+        if kind == "truncate":
+            # Valid HTTP framing around JSON cut short.
+            body = body[: int(len(body) * min(max(argument, 0.0), 1.0))]
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if kind != "drip":
+            self.wfile.write(body)
+            return
+        chunk = max(1, -(-len(body) // _DRIP_CHUNKS))
+        for offset in range(0, len(body), chunk):
+            self.wfile.write(body[offset : offset + chunk])
+            self.wfile.flush()
+            time.sleep(argument / _DRIP_CHUNKS)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Mock AREDN sysinfo server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--services", type=int, default=200, help="Number of services")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--names", choices=NAME_STYLES, default="callsign", help="Service name style")
+    parser.add_argument("--callsigns", type=int, default=0, help="Distinct operators (0 = one per service)")
+    parser.add_argument("--protocols", default="phone", help="Protocol mix, e.g. phone:70,http:25,ssh:5")
+    parser.add_argument(
+        "--faults", default="ok", help="Cyclic per-request schedule, e.g. ok,latency:2,drip:1,truncate,error:503,reset"
+    )
+    return parser
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    logging.basicConfig(level="INFO", format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    services = build_services(
+        args.services, args.seed, args.names, args.callsigns, parse_protocol_mix(args.protocols)
+    )
+    server = MockSysinfoServer(services, args.host, args.port, args.faults)
+    logger.info(
+        "Mock sysinfo serving %s services on http://%s/a/sysinfo?services=1 faults=%s",
+        args.services,
+        server.address,
+        args.faults,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -2,39 +2,103 @@ from __future__ import annotations
 
 from dataclasses import dataclass
 import re
-from typing import Tuple, List, Iterable
+from typing import Dict, Tuple, List, Iterable
 
 from .util import stable_uid
 
 
-@dataclass(frozen=True)
+OBJECT_CLASSES: Tuple[str, ...] = ("top", "inetOrgPerson")
+
+
+@dataclass(frozen=True, slots=True)
 class DirectoryEntry:
+    # Slotted, and the DN is built on demand from the base DN string every
+    # entry of a refresh shares, so a large mesh costs only the per-entry
+    # values.
     uid: str
     cn: str
     telephone_number: str
-    dn: str
+    base_dn: str
     link: str = ""
-    object_classes: Tuple[str, ...] = ("top", "inetOrgPerson")
-
-
-def build_static_entries(base_dn: str) -> List[DirectoryEntry]:
-    entries = [
-        DirectoryEntry(
-            uid="static-001",
-            cn="AREDN Echo Test",
-            telephone_number="sip:10.0.0.10",
-            dn=f"uid=static-001,{base_dn}",
-            link="",
-        ),
-        DirectoryEntry(
-            uid="static-002",
-            cn="AREDN Radio Room",
-            telephone_number="sip:10.0.0.20",
-            dn=f"uid=static-002,{base_dn}",
-            link="",
-        ),
+    object_classes: Tuple[str, ...] = OBJECT_CLASSES
+
+    @property
+    def dn(self) -> str:
+        return f"uid={self.uid},{self.base_dn}"
+
+
+USER_ATTRIBUTES: Tuple[str, ...] = ("uid", "cn", "telephoneNumber", "objectClass")
+_USER_ATTRIBUTE_NAMES = {name.lower(): name for name in USER_ATTRIBUTES}
+
+
+def select_attributes(requested: Iterable[str]) -> Tuple[str, ...]:
+    # Normalize a SearchRequest attribute list into a hashable selection so it
+    # can be used directly as part of an encoding or response cache key.
+    names = [name.strip().lower() for name in requested if name and name.strip()]
+    if not names or "*" in names:
+        return USER_ATTRIBUTES
+    wanted = {_USER_ATTRIBUTE_NAMES[name] for name in names if name in _USER_ATTRIBUTE_NAMES}
+    # "1.1" (no attributes) and "+" (operational only) select nothing we serve.
+    return tuple(name for name in USER_ATTRIBUTES if name in wanted)
+
+
+ROOT_DSE_ATTRIBUTES: Tuple[str, ...] = ("objectClass", "namingContexts", "supportedLDAPVersion", "vendorName")
+
+
+def root_dse_attributes(naming_contexts: Iterable[str]) -> List[Tuple[str, List[str]]]:
+    return [
+        ("objectClass", ["top"]),
+        ("namingContexts", list(naming_contexts)),
+        ("supportedLDAPVersion", ["3"]),
+        ("vendorName", ["aredn-ldap-bridge"]),
     ]
-    return entries
+
+
+def select_root_dse(
+    attributes: List[Tuple[str, List[str]]], requested: Iterable[str], types_only: bool = False
+) -> List[Tuple[str, List[str]]]:
+    # Root DSE attributes are operational, but clients probing it often ask
+    # for nothing in particular, so no list, "*" and "+" all return everything.
+    names = {name.strip().lower() for name in requested if name and name.strip()}
+    if names and not names & {"*", "+"}:
+        attributes = [(name, values) for name, values in attributes if name.lower() in names]
+    if types_only:
+        return [(name, []) for name, _ in attributes]
+    return attributes
+
+
+def entry_attributes(
+    entry: DirectoryEntry,
+    selection: Tuple[str, ...] = USER_ATTRIBUTES,
+    types_only: bool = False,
+) -> List[Tuple[str, List[str]]]:
+    attributes: List[Tuple[str, List[str]]] = []
+    for name in selection:
+        if types_only:
+            attributes.append((name, []))
+        elif name == "uid":
+            attributes.append((name, [entry.uid]))
+        elif name == "cn":
+            attributes.append((name, [entry.cn]))
+        elif name == "telephoneNumber":
+            attributes.append((name, [entry.telephone_number]))
+        elif name == "objectClass":
+            attributes.append((name, list(entry.object_classes)))
+    return attributes
+
+
+def static_entry(name: str, telephone_number: str, base_dn: str, link: str = "") -> DirectoryEntry:
+    # Overlay entries get their own uid namespace so they never collide with
+    # an upstream service of the same name.
+    if "." in telephone_number and ":" not in telephone_number:
+        telephone_number = f"sip:{telephone_number}"
+    return DirectoryEntry(
+        uid=f"static-{stable_uid(telephone_number, name)}",
+        cn=name,
+        telephone_number=telephone_number,
+        base_dn=base_dn,
+        link=link,
+    )
 
 
 def _telephone_number(ip: str, link: str) -> str:
@@ -49,8 +113,32 @@ def _display_name(name: str) -> str:
     return re.sub(r"\s*\[[^\]]+\]\s*$", "", name).strip()
 
 
+def normalize_dn(dn: str) -> str:
+    # Case and spacing around separators do not distinguish DNs; this is the
+    # form views are routed by.
+    return ",".join("=".join(part.strip() for part in rdn.split("=", 1)) for rdn in dn.split(",")).lower()
+
+
+def index_by_uid(views: Dict[str, List[DirectoryEntry]]) -> Dict[str, Dict[str, DirectoryEntry]]:
+    # view key -> uid -> entry, for answering baseObject searches on an entry DN.
+    return {key: {entry.uid.lower(): entry for entry in entries} for key, entries in views.items()}
+
+
+def services_for_protocol(services: Iterable[dict], protocol_filter: str) -> List[dict]:
+    # A service belongs to a protocol if it advertises it or carries a
+    # "[protocol]" tag in its name.
+    protocol_filter = protocol_filter.lower()
+    tag = f"[{protocol_filter}]"
+    return [
+        service
+        for service in services
+        if str(service.get("protocol", "")).lower() == protocol_filter or tag in str(service.get("name", "")).lower()
+    ]
+
+
 def entries_from_services(services: Iterable[dict], base_dn: str) -> List[DirectoryEntry]:
     results: List[DirectoryEntry] = []
+    shared = Interner()
     for service in services:
         name = str(service.get("name", "")).strip()
         ip = str(service.get("ip", "")).strip()
@@ -61,10 +149,19 @@ def entries_from_services(services: Iterable[dict], base_dn: str) -> List[Direct
         results.append(
             DirectoryEntry(
                 uid=uid,
-                cn=_display_name(name),
+                cn=shared(_display_name(name)),
                 telephone_number=_telephone_number(ip, link),
-                dn=f"uid={uid},{base_dn}",
-                link=link,
+                base_dn=base_dn,
+                link=shared(link),
             )
         )
     return results
+
+
+class Interner(dict):
+    # Per-refresh string sharing: names and links repeated across services
+    # (one operator's several phones, nodes advertising the same service) are
+    # stored once. Unlike sys.intern the table goes away with the refresh.
+
+    def __call__(self, value: str) -> str:
+        return self.setdefault(value, value)
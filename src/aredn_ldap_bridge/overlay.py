@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import csv
+import json
+import logging
+import os
+from typing import Dict, List, Optional, Tuple
+
+from .model import DirectoryEntry, static_entry
+
+
+class StaticOverlay:
+    # Site-local entries (radio room, EOC, gateway trunks) from a CSV or JSON
+    # file, served alongside upstream entries and whether or not upstream is
+    # reachable. The file is re-read only when its mtime or size changes, and
+    # rows that did not change reuse their previous entry.
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._signature: Optional[Tuple[int, int]] = None
+        self._base_dn = ""
+        self._rows: Dict[Tuple[str, ...], DirectoryEntry] = {}
+        self._entries: List[DirectoryEntry] = []
+        self._missing = False
+        self._logger = logging.getLogger("aredn_ldap_bridge.overlay")
+
+    def entries(self) -> List[DirectoryEntry]:
+        return self._entries
+
+    def forget(self) -> int:
+        # Drops the parsed rows so the next reload re-reads and rebuilds every
+        # entry; the current entries are served until then.
+        dropped = len(self._rows)
+        self._signature = None
+        self._rows = {}
+        return dropped
+
+    def reload(self, base_dn: str) -> bool:
+        # Returns True when the entries changed.
+        try:
+            stat = os.stat(self.path)
+        except OSError as exc:
+            if not self._missing:
+                self._logger.warning("Overlay %s unavailable; serving no overlay entries: %s", self.path, exc)
+                self._missing = True
+            self._signature = None
+            changed = bool(self._entries)
+            self._rows = {}
+            self._entries = []
+            return changed
+        self._missing = False
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature and base_dn == self._base_dn:
+            return False
+        if base_dn != self._base_dn:
+            self._rows = {}
+        try:
+            rows = self._read_rows()
+        except (OSError, ValueError, csv.Error) as exc:
+            # Keep serving the previous entries until the file is fixed.
+            self._logger.warning("Overlay %s unreadable; keeping previous entries: %s", self.path, exc)
+            self._signature = signature
+            return False
+
+        previous = self._rows
+        current: Dict[Tuple[str, ...], DirectoryEntry] = {}
+        entries: List[DirectoryEntry] = []
+        parsed = 0
+        for row in rows:
+            if row in current:
+                continue
+            entry = previous.get(row)
+            if entry is None:
+                entry = static_entry(row[0], row[1], base_dn, row[2])
+                parsed += 1
+            current[row] = entry
+            entries.append(entry)
+        self._signature = signature
+        self._base_dn = base_dn
+        self._rows = current
+        self._entries = entries
+        self._logger.info("Overlay %s loaded %s entries (%s new or changed)", self.path, len(entries), parsed)
+        return True
+
+    def _read_rows(self) -> List[Tuple[str, str, str]]:
+        with open(self.path, "r", encoding="utf-8", newline="") as handle:
+            if self.path.lower().endswith(".json"):
+                return _json_rows(json.load(handle))
+            return _csv_rows(handle)
+
+
+def _csv_rows(handle) -> List[Tuple[str, str, str]]:
+    # name,telephone[,link]; blank lines, "#" comments and a header row are skipped.
+    rows: List[Tuple[str, str, str]] = []
+    for fields in csv.reader(handle):
+        if not fields or not fields[0].strip() or fields[0].lstrip().startswith("#"):
+            continue
+        if fields[0].strip().lower() == "name":
+            continue
+        if len(fields) < 2 or not fields[1].strip():
+            raise ValueError(f"line {len(rows) + 1}: expected name,telephone[,link]")
+        link = fields[2].strip() if len(fields) > 2 else ""
+        rows.append((fields[0].strip(), fields[1].strip(), link))
+    return rows
+
+
+def _json_rows(payload) -> List[Tuple[str, str, str]]:
+    # [{"name": ..., "telephone": ..., "link": ...}, ...]
+    items = payload.get("entries", []) if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        raise ValueError("expected a list of entries")
+    rows: List[Tuple[str, str, str]] = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError(f"entry {len(rows) + 1}: expected an object")
+        name = str(item.get("name", "")).strip()
+        telephone = str(item.get("telephone", "") or item.get("telephoneNumber", "")).strip()
+        if not name or not telephone:
+            raise ValueError(f"entry {len(rows) + 1}: name and telephone are required")
+        rows.append((name, telephone, str(item.get("link", "") or "").strip()))
+    return rows
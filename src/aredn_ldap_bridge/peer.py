@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import Request, urlopen
+
+from .metrics import PEER_REQUESTS, PEER_SYNCS
+from .upstream import FETCH_ERRORS, UpstreamClient, read_body
+
+# A peer answering with a malformed payload is treated like an unreachable one.
+_SYNC_ERRORS = FETCH_ERRORS + (KeyError, TypeError, zlib.error)
+# Versions kept for delta responses; a peer further behind gets a full copy.
+_HISTORY = 4
+_PEER_PREFIX = "peer:"
+
+
+class PeerSnapshotStore:
+    # The services this bridge last fetched, from upstream or a peer, served to
+    # other bridges. A version is a distinct set of services, so a refresh that
+    # finds nothing new only moves `refreshed_at`. `refreshed_at` is when the
+    # data left AREDN upstream, however many bridges it passed through, so
+    # staleness is judged against the original fetch.
+
+    def __init__(self) -> None:
+        # Versions restart with the process; the instance id tells a peer its
+        # delta base is from an earlier run.
+        self.instance = os.urandom(8).hex()
+        self._lock = threading.Lock()
+        self._version = 0
+        self._refreshed_at = 0.0
+        self._services: Dict[str, dict] = {}
+        self._history: List[Tuple[int, frozenset]] = []
+
+    def record(self, services: List[dict], refreshed_at: float) -> None:
+        current = {_canonical(service): service for service in services}
+        with self._lock:
+            self._refreshed_at = max(self._refreshed_at, refreshed_at)
+            if current.keys() == self._services.keys():
+                return
+            self._version += 1
+            self._services = current
+            self._history = (self._history + [(self._version, frozenset(current))])[-_HISTORY:]
+
+    def response(self, instance: str, since: int) -> Optional[dict]:
+        # None until something has been recorded.
+        with self._lock:
+            if not self._version:
+                return None
+            payload = {"instance": self.instance, "version": self._version, "refreshed_at": self._refreshed_at}
+            current = self._history[-1][1]
+            base = None
+            if instance == self.instance:
+                base = next((keys for version, keys in self._history if version == since), None)
+            if base is None:
+                payload["services"] = list(self._services.values())
+                return payload
+            payload["base"] = since
+            payload["added"] = [self._services[key] for key in current - base]
+            payload["removed"] = [json.loads(key) for key in base - current]
+            return payload
+
+
+class PeerSyncClient:
+    # Stands in for UpstreamClient: tries peers in order and takes the first
+    # whose data is no older than `max_age_seconds`, falling back to upstream
+    # when none is. Every result is recorded in `store` for our own peers.
+    # With no peers it only records what upstream returned.
+
+    def __init__(
+        self,
+        upstream: UpstreamClient,
+        peers: List[str],
+        max_age_seconds: int,
+        timeout_seconds: int,
+        store: PeerSnapshotStore,
+    ) -> None:
+        self._upstream = upstream
+        self._peers = list(peers)
+        self._max_age_seconds = max_age_seconds
+        self._timeout_seconds = timeout_seconds
+        self._store = store
+        self._logger = logging.getLogger("aredn_ldap_bridge.peer")
+        self._lock = threading.Lock()
+        self._last_success: Dict[str, float] = {}
+        # Per peer: (instance, version, services by canonical key) of the last
+        # copy received, the base for asking for a delta.
+        self._synced: Dict[str, Tuple[str, int, Dict[str, dict]]] = {}
+
+    def fetch_services(self) -> List[dict]:
+        for peer in self._peers:
+            try:
+                services, refreshed_at = self._sync_peer(peer)
+            except _SYNC_ERRORS as exc:
+                PEER_SYNCS.inc(peer, "error")
+                self._logger.warning("Peer %s failed: %s", peer, exc)
+                continue
+            age = time.time() - refreshed_at
+            if age > self._max_age_seconds:
+                PEER_SYNCS.inc(peer, "stale")
+                self._logger.warning("Peer %s data is %.0fs old; not using it", peer, age)
+                continue
+            self._store.record(services, refreshed_at)
+            return services
+        if self._peers:
+            self._logger.info("No peer had fresh data; fetching from upstream")
+        services = self._upstream.fetch_services()
+        self._store.record(services, time.time())
+        return services
+
+    def node_status(self) -> Dict[str, float]:
+        now = time.time()
+        with self._lock:
+            last_success = dict(self._last_success)
+        status = {
+            _PEER_PREFIX + peer: now - last_success[peer] if peer in last_success else float("nan")
+            for peer in self._peers
+        }
+        status.update(self._upstream.node_status())
+        return status
+
+    def _sync_peer(self, peer: str) -> Tuple[List[dict], float]:
+        synced = self._synced.get(peer)
+        url = f"http://{peer}/snapshot"
+        if synced is not None:
+            url += f"?instance={synced[0]}&since={synced[1]}"
+        self._logger.info("Syncing from peer %s", url)
+        request = Request(url, headers={"Accept-Encoding": "deflate"})
+        deadline = time.monotonic() + self._timeout_seconds
+        with urlopen(request, timeout=self._timeout_seconds) as response:
+            raw = read_body(response, deadline)
+            received = len(raw)
+            if response.headers.get("Content-Encoding") == "deflate":
+                raw = zlib.decompress(raw)
+        payload = json.loads(raw.decode("utf-8"))
+        instance, version = str(payload["instance"]), int(payload["version"])
+        if "services" in payload:
+            services = {_canonical(service): service for service in payload["services"]}
+            outcome = "full"
+        else:
+            if synced is None or synced[0] != instance or int(payload["base"]) != synced[1]:
+                raise ValueError("delta does not apply to the last synced version")
+            services = dict(synced[2])
+            for service in payload["removed"]:
+                services.pop(_canonical(service), None)
+            for service in payload["added"]:
+                services[_canonical(service)] = service
+            outcome = "delta" if payload["added"] or payload["removed"] else "unchanged"
+        self._synced[peer] = (instance, version, services)
+        PEER_SYNCS.inc(peer, outcome)
+        with self._lock:
+            self._last_success[peer] = time.time()
+        self._logger.info(
+            "Peer %s returned version %s (%s, %s services, %s bytes)", peer, version, outcome, len(services), received
+        )
+        return list(services.values()), float(payload["refreshed_at"])
+
+
+class PeerServer:
+    # `refresh` is the cache's get_views: a peer asking counts as demand, so a
+    # bridge whose own phones are idle still refreshes once its TTL is up.
+
+    def __init__(self, address: str, port: int, store: PeerSnapshotStore, refresh: Callable[[], object]) -> None:
+        self._server = ThreadingHTTPServer((address, port), _PeerHandler)
+        self._server.daemon_threads = True
+        self._server.store = store
+        self._server.refresh = refresh
+        self._thread = threading.Thread(target=self._server.serve_forever, name="peer", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def close_socket(self) -> None:
+        # For a forked child, which has the listening socket but no serving thread.
+        self._server.server_close()
+
+
+class _PeerHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/snapshot":
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        try:
+            since = int(query.get("since", ["0"])[0])
+        except ValueError:
+            self.send_error(400)
+            return
+        self.server.refresh()
+        payload = self.server.store.response(query.get("instance", [""])[0], since)
+        if payload is None:
+            PEER_REQUESTS.inc("unavailable")
+            self.send_error(503, "no snapshot yet")
+            return
+        PEER_REQUESTS.inc("full" if "services" in payload else "delta")
+        body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "deflate" in self.headers.get("Accept-Encoding", ""):
+            body = zlib.compress(body)
+            self.send_header("Content-Encoding", "deflate")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def peer_store(config) -> Optional[PeerSnapshotStore]:
+    if config.peer_nodes or config.peer_listen_port > 0:
+        return PeerSnapshotStore()
+    return None
+
+
+def build_upstream(config, store: Optional[PeerSnapshotStore]) -> UpstreamClient | PeerSyncClient:
+    # The client LazyCache fetches through: plain upstream, or wrapped for
+    # peer sharing when this bridge serves or syncs snapshots.
+    upstream = UpstreamClient(
+        nodes=config.upstream_nodes,
+        timeout_seconds=config.upstream_timeout_seconds,
+        mode=config.upstream_mode,
+    )
+    if store is None:
+        return upstream
+    return PeerSyncClient(
+        upstream, config.peer_nodes, config.peer_max_age_seconds, config.upstream_timeout_seconds, store
+    )
+
+
+def start_peer_server(
+    address: str, port: int, store: PeerSnapshotStore, refresh: Callable[[], object]
+) -> PeerServer:
+    server = PeerServer(address, port, store, refresh)
+    server.start()
+    logging.getLogger("aredn_ldap_bridge.peer").info("Peer snapshots listening on http://%s:%s/snapshot", address, port)
+    return server
+
+
+def _canonical(service: dict) -> str:
+    return json.dumps(service, sort_keys=True, separators=(",", ":"))
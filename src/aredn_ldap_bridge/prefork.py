@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+import dataclasses
+import logging
+import os
+import select
+import signal
+import time
+from typing import Callable, Dict
+
+from .admin import AdminServer, build_commands
+from .cache import LazyCache
+from .config import Config, load_config, merge_reload, resolve_state_dir, source_changed, upstream_client_changed
+from .logging_setup import stop_logging
+from .metrics import MetricsServer, register_cache_gauges, start_metrics_server
+from .peer import PeerServer, build_upstream, peer_store, start_peer_server
+from .snapshot import SharedSnapshotCache, SnapshotPublisher, snapshot_path
+
+_SUPERVISOR_POLL_SECONDS = 1.0
+_RESPAWN_DELAY_SECONDS = 1.0
+
+
+def run_prefork(
+    config: Config,
+    config_path: str | None,
+    serve_worker: Callable[[Config, SharedSnapshotCache], None],
+) -> None:
+    # The supervisor never serves LDAP. It forks `worker_processes` workers that
+    # each bind the listen port with SO_REUSEPORT, and it alone talks to
+    # upstream: workers ask for a refresh over a pipe and pick up the result
+    # from the published snapshot file.
+    logger = logging.getLogger("aredn_ldap_bridge.prefork")
+    path = snapshot_path(resolve_state_dir(config), config.listen_port)
+    publisher = SnapshotPublisher(path)
+    store = peer_store(config)
+    upstream = build_upstream(config, store)
+    cache = LazyCache(
+        upstream=upstream,
+        views=config.all_views,
+        ttl_seconds=config.cache_ttl_seconds,
+        overlay_file=config.overlay_file,
+        ttl_max_seconds=config.cache_ttl_max_seconds,
+    )
+    request_read, request_write = os.pipe()
+    os.set_blocking(request_read, False)
+    workers: Dict[int, int] = {}
+    metrics_server: MetricsServer | None = None
+    admin_server: AdminServer | None = None
+    peer_server: PeerServer | None = None
+    state = {"stop": False, "reload": False, "config": config, "store": store, "upstream": upstream}
+
+    def _spawn(slot: int) -> None:
+        pid = os.fork()
+        if pid:
+            workers[pid] = slot
+            return
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, signal.SIG_DFL)
+        # The worker installs its profiler handlers once serving; until then a
+        # forwarded SIGUSR1/2 must not kill it.
+        for signum in (signal.SIGUSR1, signal.SIGUSR2):
+            signal.signal(signum, signal.SIG_IGN)
+        os.close(request_read)
+        os.set_blocking(request_write, False)
+        if metrics_server is not None:
+            metrics_server.close_socket()
+        if admin_server is not None:
+            admin_server.close_socket()
+        if peer_server is not None:
+            peer_server.close_socket()
+        exit_code = 0
+        worker_config = state["config"]
+        if worker_config.metrics_port > 0:
+            # The supervisor serves metrics_port; worker N serves metrics_port + 1 + N.
+            worker_config = dataclasses.replace(worker_config, metrics_port=worker_config.metrics_port + 1 + slot)
+        try:
+            wait_seconds = worker_config.upstream_timeout_seconds * max(1, len(worker_config.upstream_nodes)) + 1
+            worker_cache = SharedSnapshotCache(
+                path,
+                worker_config.cache_ttl_seconds,
+                lambda: _request_refresh(request_write),
+                wait_seconds,
+            )
+            serve_worker(worker_config, worker_cache)
+        except Exception:
+            logging.getLogger("aredn_ldap_bridge.prefork").exception("Worker %s failed", slot)
+            exit_code = 1
+        finally:
+            stop_logging()
+            logging.shutdown()
+            os._exit(exit_code)
+
+    for slot in range(config.worker_processes):
+        _spawn(slot)
+    if config.metrics_port > 0:
+        # Upstream and refresh metrics live here, since only the supervisor fetches.
+        register_cache_gauges(cache)
+        metrics_server = start_metrics_server(config.metrics_listen_address, config.metrics_port)
+    if config.admin_socket:
+        # A forced refresh runs on the admin thread; publishing is left to the
+        # supervisor loop, which sees the request on the pipe and publishes the
+        # now-fresh entries.
+        admin_server = AdminServer(
+            config.admin_socket,
+            build_commands(
+                cache,
+                lambda: {"workers": {str(slot): pid for pid, slot in dict(workers).items()}},
+                lambda: _request_refresh(request_write),
+            ),
+        )
+        admin_server.start()
+    if store is not None and config.peer_listen_port > 0:
+        peer_server = start_peer_server(
+            config.peer_listen_address, config.peer_listen_port, store, cache.get_views
+        )
+    logger.info("Supervisor pid=%s started %s workers snapshot=%s", os.getpid(), len(workers), path)
+
+    def _handle_stop(signum, frame) -> None:
+        state["stop"] = True
+
+    def _handle_reload(signum, frame) -> None:
+        state["reload"] = True
+
+    def _forward(signum, frame) -> None:
+        _signal_workers(workers, signum)
+
+    signal.signal(signal.SIGTERM, _handle_stop)
+    signal.signal(signal.SIGINT, _handle_stop)
+    signal.signal(signal.SIGHUP, _handle_reload)
+    signal.signal(signal.SIGUSR1, _forward)
+    signal.signal(signal.SIGUSR2, _forward)
+
+    def _reload() -> None:
+        logger.info("Supervisor reloading config")
+        current = state["config"]
+        try:
+            new_config, ignored = merge_reload(current, load_config(config_path))
+        except Exception as exc:
+            logger.error("Config reload failed; keeping current config: %s", exc)
+            return
+        for name in ignored:
+            logger.warning("%s changed; restart required to apply", name)
+        refetch = source_changed(current, new_config)
+        if upstream_client_changed(current, new_config):
+            # Otherwise the client, with its node health and peer sync state, stays.
+            if state["store"] is None and new_config.peer_nodes:
+                state["store"] = peer_store(new_config)
+            state["upstream"] = build_upstream(new_config, state["store"])
+        overlay_changed = cache.set_overlay_file(new_config.overlay_file)
+        prewarmed = cache.reload_settings(
+            state["upstream"],
+            new_config.all_views,
+            new_config.cache_ttl_seconds,
+            refetch,
+            new_config.cache_ttl_max_seconds,
+        )
+        state["config"] = new_config
+        if refetch:
+            # Workers pick up the pre-warmed generation on their next
+            # search; if the pre-warm failed, they ask for a refresh.
+            if prewarmed:
+                _publish()
+            else:
+                publisher.invalidate()
+        elif overlay_changed:
+            _publish()
+
+    def _publish() -> None:
+        # One snapshot carries every view; each entry's base DN says which.
+        entries = [entry for view in cache.get_views().values() for entry in view]
+        generation, refreshed_at = cache.snapshot_info()
+        publisher.publish(entries, generation, refreshed_at, cache.ttl_info()["ttl_seconds"])
+
+    while not state["stop"]:
+        readable, _, _ = select.select([request_read], [], [], _SUPERVISOR_POLL_SECONDS)
+
+        if state["reload"]:
+            state["reload"] = False
+            _reload()
+            _signal_workers(workers, signal.SIGHUP)
+
+        if readable:
+            try:
+                # Every pending request is satisfied by the same refresh.
+                while os.read(request_read, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+            _publish()
+
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            slot = workers.pop(pid, None)
+            if slot is None or state["stop"]:
+                continue
+            logger.warning("Worker %s pid=%s exited status=%s; respawning", slot, pid, status)
+            time.sleep(_RESPAWN_DELAY_SECONDS)
+            _spawn(slot)
+
+    logger.info("Supervisor stopping %s workers", len(workers))
+    _signal_workers(workers, signal.SIGTERM)
+    for pid in list(workers):
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    if metrics_server is not None:
+        metrics_server.close()
+    if admin_server is not None:
+        admin_server.close()
+    if peer_server is not None:
+        peer_server.close()
+
+
+def _request_refresh(fd: int) -> None:
+    try:
+        os.write(fd, b"r")
+    except BlockingIOError:
+        # The pipe is full, so a refresh request is already pending.
+        pass
+
+
+def _signal_workers(workers: Dict[int, int], signum: int) -> None:
+    for pid in workers:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Stage of a sampled stack: the innermost frame found in this table wins.
+_STAGE_FRAMES: Dict[Tuple[str, str], str] = {
+    ("ldap_server.py", "feed"): "decode",
+    ("ldap_protocol.py", "decode_ldap_message"): "decode",
+    ("ldap_protocol.py", "decode_abandon_request"): "decode",
+    ("matcher.py", "parse_filter_bytes"): "filter_parse",
+    ("matcher.py", "match_entries"): "match",
+    ("matcher.py", "match"): "match",
+    ("model.py", "entry_attributes"): "encode",
+    ("ldap_protocol.py", "build_search_result_entry"): "encode",
+    ("ldap_protocol.py", "encode_search_result_entry_op"): "encode",
+    ("ldap_protocol.py", "frame_ldap_message"): "encode",
+    ("ldap_protocol.py", "build_search_result_done"): "encode",
+    ("ldap_protocol.py", "encode_ldap_message"): "encode",
+    ("ldap_server.py", "_send"): "send",
+    ("async_server.py", "_drain"): "send",
+    ("streams.py", "write"): "send",
+    ("cache.py", "get_entries"): "cache_wait",
+    ("cache.py", "get_entry"): "cache_wait",
+    ("snapshot.py", "get_entries"): "cache_wait",
+    ("snapshot.py", "get_entry"): "cache_wait",
+}
+# pyasn1 codec frames are attributed by module when no bridge frame is closer.
+_CODEC_STAGES = {"decoder.py": "decode", "encoder.py": "encode"}
+# Stacks with none of these frames are idle threads and are not counted.
+_REQUEST_FRAMES = {("ldap_server.py", "responses")}
+STAGES = ("decode", "filter_parse", "match", "encode", "send", "cache_wait", "other")
+# sys.monitoring tool id for the stage timer; 0-2 and 5 are reserved by CPython.
+_MONITORING_TOOL_ID = 3
+
+
+class Profiler:
+    # Started by SIGUSR1 (sampling, collapsed stacks) or SIGUSR2 (cProfile)
+    # and stopped after `window_seconds`. Nothing is hooked while idle, so it
+    # costs nothing until a signal arrives.
+
+    def __init__(self, output_dir: str, window_seconds: float, interval_seconds: float) -> None:
+        self._output_dir = output_dir
+        self._window_seconds = window_seconds
+        self._interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._stage_functions: List[Tuple[str, Callable]] = []
+        self._logger = logging.getLogger("aredn_ldap_bridge.profiler")
+
+    def register_stage(self, stage: str, function: Callable) -> None:
+        # For stage functions that only exist per server, such as the send path.
+        self._stage_functions.append((stage, function))
+
+    def configure(self, output_dir: str, window_seconds: float, interval_seconds: float) -> None:
+        with self._lock:
+            self._output_dir = output_dir
+            self._window_seconds = window_seconds
+            self._interval_seconds = interval_seconds
+
+    def start(self, mode: str) -> bool:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._logger.warning("Profiler already running; ignoring %s request", mode)
+                return False
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(mode, self._output_dir, self._window_seconds, self._interval_seconds),
+                name=f"profiler-{mode}",
+                daemon=True,
+            )
+            self._thread.start()
+        self._logger.info("Profiler started mode=%s window=%ss", mode, self._window_seconds)
+        return True
+
+    def _run(self, mode: str, output_dir: str, window_seconds: float, interval_seconds: float) -> None:
+        stem = self._output_stem(output_dir)
+        timer = _StageTimer(self._stage_functions)
+        timing = timer.start()
+        try:
+            if mode == "sampling":
+                self._run_sampling(stem, window_seconds, interval_seconds)
+            else:
+                self._run_cprofile(stem, window_seconds)
+        except Exception:
+            self._logger.exception("Profiler failed mode=%s", mode)
+        finally:
+            stages = timer.stop() if timing else None
+        if stages is None:
+            self._logger.info("Stage timing needs Python 3.12+ (sys.monitoring); skipped")
+            return
+        path = f"{stem}.stages.json"
+        with open(path, "w", encoding="utf-8") as handle:
+            json.dump({"window_seconds": window_seconds, "stages": stages}, handle, indent=2)
+        self._logger.info(
+            "Stage timing written path=%s %s",
+            path,
+            " ".join(f"{stage}={stages[stage]['seconds'] * 1000:.1f}ms" for stage in STAGES if stage in stages),
+        )
+
+    def _run_sampling(self, stem: str, window_seconds: float, interval_seconds: float) -> None:
+        # Wall-clock samples of every thread inside a request. A thread is only
+        # observed when the GIL changes hands, which favours blocking calls
+        # such as sendall; the stage timing file has the CPU-accurate split.
+        own_id = threading.get_ident()
+        stacks: Counter = Counter()
+        stages: Counter = Counter()
+        deadline = time.monotonic() + window_seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                sample = _classify(frame)
+                if sample is None:
+                    continue
+                stage, stack = sample
+                stages[stage] += 1
+                stacks[f"{stage};{stack}"] += 1
+            time.sleep(interval_seconds)
+
+        path = f"{stem}.collapsed"
+        with open(path, "w", encoding="utf-8") as handle:
+            for stack, count in stacks.most_common():
+                handle.write(f"{stack} {count}\n")
+        total = sum(stages.values())
+        self._logger.info(
+            "Profile written path=%s samples=%s %s",
+            path,
+            total,
+            " ".join(f"{stage}={stages[stage] * 100.0 / total:.1f}%" for stage in STAGES if stages[stage]),
+        )
+
+    def _run_cprofile(self, stem: str, window_seconds: float) -> None:
+        # cProfile sees every thread on Python 3.12+; older interpreters only
+        # profile this thread, so prefer sampling mode there.
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as exc:
+            self._logger.warning("cProfile unavailable: %s", exc)
+            return
+        try:
+            time.sleep(window_seconds)
+        finally:
+            profile.disable()
+
+        path = f"{stem}.pstats"
+        profile.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(15)
+        self._logger.info("Profile written path=%s\n%s", path, output.getvalue().strip())
+
+    def _output_stem(self, output_dir: str) -> str:
+        os.makedirs(output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        return os.path.join(output_dir, f"profile-{os.getpid()}-{stamp}")
+
+
+def _classify(frame) -> Optional[Tuple[str, str]]:
+    stage = None
+    in_request = False
+    names: List[str] = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        key = (filename, code.co_name)
+        if stage is None:
+            stage = _STAGE_FRAMES.get(key)
+            if stage is None and "pyasn1" in code.co_filename:
+                stage = _CODEC_STAGES.get(filename)
+        if key in _REQUEST_FRAMES:
+            in_request = True
+        names.append(f"{filename[:-3]}:{code.co_name}")
+        frame = frame.f_back
+    if stage is None and not in_request:
+        return None
+    names.reverse()
+    return stage or "other", ";".join(names)
+
+
+class _StageTimer:
+    # Times each stage with sys.monitoring events enabled only on the stage
+    # functions and only for the profiling window. Time is charged to the
+    # outermost stage function running on a thread, so nested stage calls
+    # (decode_ldap_message inside feed) are not counted twice.
+
+    def __init__(self, extra_functions: List[Tuple[str, Callable]]) -> None:
+        self._extra_functions = extra_functions
+        self._codes: Dict[object, str] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._seconds: Dict[str, float] = {}
+        self._calls: Dict[str, int] = {}
+
+    def start(self) -> bool:
+        monitoring = getattr(sys, "monitoring", None)
+        if monitoring is None:
+            return False
+        try:
+            monitoring.use_tool_id(_MONITORING_TOOL_ID, "aredn-ldap-bridge")
+        except ValueError:
+            return False
+        self._codes = _stage_codes(self._extra_functions)
+        events = monitoring.events
+        monitoring.register_callback(_MONITORING_TOOL_ID, events.PY_START, self._enter)
+        monitoring.register_callback(_MONITORING_TOOL_ID, events.PY_RESUME, self._enter)
+        monitoring.register_callback(_MONITORING_TOOL_ID, events.PY_RETURN, self._exit)
+        monitoring.register_callback(_MONITORING_TOOL_ID, events.PY_YIELD, self._exit)
+        monitoring.register_callback(_MONITORING_TOOL_ID, events.PY_UNWIND, self._unwind)
+        local_events = events.PY_START | events.PY_RESUME | events.PY_RETURN | events.PY_YIELD
+        for code in self._codes:
+            monitoring.set_local_events(_MONITORING_TOOL_ID, code, local_events)
+        # Unwind cannot be enabled per function; exceptions are rare on these paths.
+        monitoring.set_events(_MONITORING_TOOL_ID, events.PY_UNWIND)
+        return True
+
+    def stop(self) -> Dict[str, Dict[str, float]]:
+        monitoring = sys.monitoring
+        monitoring.set_events(_MONITORING_TOOL_ID, 0)
+        for code in self._codes:
+            monitoring.set_local_events(_MONITORING_TOOL_ID, code, 0)
+        monitoring.free_tool_id(_MONITORING_TOOL_ID)
+        with self._lock:
+            return {
+                stage: {"seconds": round(self._seconds[stage], 6), "calls": self._calls[stage]}
+                for stage in STAGES
+                if stage in self._seconds
+            }
+
+    def _state(self):
+        state = self._local
+        if not hasattr(state, "depth"):
+            state.depth = 0
+            state.stage = ""
+            state.started = 0.0
+        return state
+
+    def _enter(self, code, offset) -> None:
+        state = self._state()
+        if state.depth == 0:
+            state.stage = self._codes[code]
+            state.started = time.perf_counter()
+        state.depth += 1
+
+    def _exit(self, code, offset, retval) -> None:
+        state = self._state()
+        if state.depth == 0:
+            # Entered before the window opened.
+            return
+        state.depth -= 1
+        if state.depth == 0:
+            elapsed = time.perf_counter() - state.started
+            with self._lock:
+                self._seconds[state.stage] = self._seconds.get(state.stage, 0.0) + elapsed
+                self._calls[state.stage] = self._calls.get(state.stage, 0) + 1
+
+    def _unwind(self, code, offset, exception) -> None:
+        if code in self._codes:
+            self._exit(code, offset, None)
+
+
+def _stage_codes(extra_functions: List[Tuple[str, Callable]]) -> Dict[object, str]:
+    # Imported here so the profiler module stays importable on its own.
+    from pyasn1.codec.ber import decoder
+
+    from . import cache, ldap_protocol, ldap_server, matcher, model, snapshot
+
+    functions: List[Tuple[str, Callable]] = [
+        ("decode", ldap_server.LDAPSession.feed),
+        ("decode", ldap_protocol.decode_ldap_message),
+        ("decode", ldap_protocol.decode_abandon_request),
+        ("decode", decoder.decode.__call__),
+        ("filter_parse", matcher.parse_filter_bytes),
+        ("match", matcher.match_entries),
+        ("match", matcher.TypeaheadNarrower.match),
+        ("encode", model.entry_attributes),
+        ("encode", ldap_protocol.build_search_result_entry),
+        ("encode", ldap_protocol.encode_search_result_entry_op),
+        ("encode", ldap_protocol.frame_ldap_message),
+        ("encode", ldap_protocol.build_search_result_done),
+        ("encode", ldap_protocol.encode_ldap_message),
+        ("cache_wait", cache.LazyCache.get_entries),
+        ("cache_wait", cache.LazyCache.get_entry),
+        ("cache_wait", snapshot.SharedSnapshotCache.get_entries),
+        ("cache_wait", snapshot.SharedSnapshotCache.get_entry),
+    ]
+    codes: Dict[object, str] = {}
+    for stage, function in functions + list(extra_functions):
+        function = getattr(function, "__func__", function)
+        code = getattr(function, "__code__", None)
+        if code is not None:
+            codes[code] = stage
+    return codes
@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from .matcher import forget_narrowing
+from .metrics import CACHE_REQUESTS
+from .config import ViewConfig
+from .model import OBJECT_CLASSES, DirectoryEntry, Interner, index_by_uid, normalize_dn
+from .upstream import UpstreamClient
+
+# File layout: fixed header followed by a JSON array of entry rows.
+#   magic(4) version(H) pad(H) generation(Q) attempt(Q) refreshed_at(d) ttl(d) payload_len(Q)
+_MAGIC = b"ALBS"
+_VERSION = 3
+_HEADER = struct.Struct("<4sHHQQddQ")
+_WAIT_POLL_SECONDS = 0.02
+_NO_ENTRIES: List[DirectoryEntry] = []
+
+
+class SnapshotHeader(NamedTuple):
+    generation: int
+    attempt: int
+    refreshed_at: float
+    ttl_seconds: float
+    payload_len: int
+
+
+def snapshot_path(state_dir: str, listen_port: int) -> str:
+    return os.path.join(state_dir, f"snapshot-{listen_port}.bin")
+
+
+class SnapshotPublisher:
+    # Writes each snapshot to a temp file and renames it into place, so readers
+    # only ever map a complete file.
+
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._attempt = 0
+        self._generation = 0
+        self._refreshed_at = 0.0
+        self._ttl_seconds = 0.0
+        self._payload = b"[]"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # A file left by a previous run could share generation numbers with
+        # this one, so start from nothing.
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def publish(
+        self, entries: List[DirectoryEntry], generation: int, refreshed_at: float, ttl_seconds: float = 0.0
+    ) -> None:
+        # Every call bumps `attempt` so waiting workers wake even when the
+        # refresh failed and the data generation is unchanged. `ttl_seconds`
+        # carries the supervisor's effective (possibly adaptive) TTL.
+        if generation != self._generation or not self._attempt:
+            rows = [
+                [entry.uid, entry.cn, entry.telephone_number, entry.base_dn, entry.link, list(entry.object_classes)]
+                for entry in entries
+            ]
+            self._payload = json.dumps(rows, separators=(",", ":")).encode("utf-8")
+            self._generation = generation
+        self._refreshed_at = refreshed_at
+        self._ttl_seconds = ttl_seconds
+        self._attempt += 1
+        self._write()
+
+    def invalidate(self) -> None:
+        # Keep the data but mark it stale so workers request a refresh.
+        self._refreshed_at = 0.0
+        self._attempt += 1
+        self._write()
+
+    def _write(self) -> None:
+        header = _HEADER.pack(
+            _MAGIC,
+            _VERSION,
+            0,
+            self._generation,
+            self._attempt,
+            self._refreshed_at,
+            self._ttl_seconds,
+            len(self._payload),
+        )
+        tmp_path = f"{self._path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as handle:
+            handle.write(header)
+            handle.write(self._payload)
+        os.replace(tmp_path, self._path)
+
+
+class SnapshotReader:
+    def __init__(self, path: str) -> None:
+        self._path = path
+        self._inode: Optional[int] = None
+        self._map: Optional[mmap.mmap] = None
+
+    def header(self) -> Optional[SnapshotHeader]:
+        try:
+            inode = os.stat(self._path).st_ino
+        except FileNotFoundError:
+            return None
+        if inode != self._inode:
+            self._remap(inode)
+        if self._map is None or len(self._map) < _HEADER.size:
+            return None
+        magic, version, _, generation, attempt, refreshed_at, ttl_seconds, payload_len = _HEADER.unpack_from(
+            self._map, 0
+        )
+        if magic != _MAGIC or version != _VERSION:
+            return None
+        return SnapshotHeader(generation, attempt, refreshed_at, ttl_seconds, payload_len)
+
+    def entries(self, header: SnapshotHeader) -> List[DirectoryEntry]:
+        payload = self._map[_HEADER.size : _HEADER.size + header.payload_len]
+        # json.loads makes a new string per row, so share repeated values
+        # (base DN, links, object classes) again.
+        shared = Interner()
+        classes: Dict[Tuple[str, ...], Tuple[str, ...]] = {OBJECT_CLASSES: OBJECT_CLASSES}
+        return [
+            DirectoryEntry(
+                uid=uid,
+                cn=shared(cn),
+                telephone_number=telephone_number,
+                base_dn=shared(base_dn),
+                link=shared(link),
+                object_classes=classes.setdefault(tuple(object_classes), tuple(object_classes)),
+            )
+            for uid, cn, telephone_number, base_dn, link, object_classes in json.loads(payload)
+        ]
+
+    def _remap(self, inode: int) -> None:
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._inode = inode
+        try:
+            with open(self._path, "rb") as handle:
+                self._map = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self._inode = None
+
+
+class SharedSnapshotCache:
+    # Worker-process stand-in for LazyCache: entries come from the snapshot
+    # file published by the supervisor, and a stale snapshot is refreshed by
+    # asking the supervisor rather than fetching upstream directly.
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: int,
+        request_refresh: Callable[[], None],
+        wait_seconds: float,
+    ) -> None:
+        self._reader = SnapshotReader(path)
+        self._ttl_seconds = max(1, int(ttl_seconds))
+        self._request_refresh = request_refresh
+        self._wait_seconds = wait_seconds
+        self._lock = threading.Lock()
+        self._generation = -1
+        self._refreshed_at = 0.0
+        # The snapshot holds every view; entries are split back out by their
+        # base DN when a generation is loaded.
+        self._entries: Dict[str, List[DirectoryEntry]] = {}
+        self._uid_index: Optional[Dict[str, Dict[str, DirectoryEntry]]] = None
+        self._logger = logging.getLogger("aredn_ldap_bridge.snapshot")
+
+    def get_entries(self, view_key: str) -> List[DirectoryEntry]:
+        # Shared with other searches of this generation; must not be modified.
+        return self._current_views().get(view_key, _NO_ENTRIES)
+
+    def get_entries_generation(self, view_key: str) -> Tuple[List[DirectoryEntry], int]:
+        # The entries together with the generation they belong to.
+        self._current_views()
+        with self._lock:
+            return self._entries.get(view_key, _NO_ENTRIES), self._generation
+
+    def get_entry(self, view_key: str, uid: str) -> Optional[DirectoryEntry]:
+        views = self._current_views()
+        with self._lock:
+            if self._uid_index is None or views is not self._entries:
+                index = index_by_uid(views)
+                if views is self._entries:
+                    self._uid_index = index
+            else:
+                index = self._uid_index
+        return index.get(view_key, {}).get(uid)
+
+    def _current_views(self) -> Dict[str, List[DirectoryEntry]]:
+        with self._lock:
+            header = self._reader.header()
+            if header is not None and time.time() - header.refreshed_at < self._ttl_locked(header):
+                CACHE_REQUESTS.inc("hit")
+                return self._views_locked(header)
+
+        CACHE_REQUESTS.inc("miss")
+        last_attempt = header.attempt if header is not None else -1
+        self._request_refresh()
+        deadline = time.monotonic() + self._wait_seconds
+        while time.monotonic() < deadline:
+            time.sleep(_WAIT_POLL_SECONDS)
+            with self._lock:
+                header = self._reader.header()
+            if header is not None and header.attempt != last_attempt:
+                break
+        else:
+            self._logger.info("Snapshot refresh not published within %.1fs; serving current snapshot", self._wait_seconds)
+
+        with self._lock:
+            header = self._reader.header()
+            return self._entries if header is None else self._views_locked(header)
+
+    def snapshot_info(self) -> Tuple[int, float]:
+        with self._lock:
+            return max(0, self._generation), self._refreshed_at
+
+    def ttl_info(self) -> Dict[str, float]:
+        with self._lock:
+            return {"ttl_seconds": self._ttl_locked(self._reader.header())}
+
+    def reload_settings(
+        self,
+        upstream: UpstreamClient,
+        views: Sequence[ViewConfig],
+        ttl_seconds: int,
+        refetch: bool,
+        ttl_max_seconds: int = 0,
+    ) -> bool:
+        # Upstream and views belong to the supervisor, which also does any
+        # pre-warm and adapts the TTL; workers only need the configured TTL
+        # for snapshots published without one.
+        with self._lock:
+            self._ttl_seconds = max(1, int(ttl_seconds))
+        return True
+
+    def set_overlay_file(self, overlay_file: str) -> bool:
+        # The supervisor merges the overlay into the snapshot it publishes.
+        return False
+
+    def _ttl_locked(self, header: Optional[SnapshotHeader]) -> float:
+        if header is not None and header.ttl_seconds > 0:
+            return header.ttl_seconds
+        return self._ttl_seconds
+
+    def _views_locked(self, header: SnapshotHeader) -> Dict[str, List[DirectoryEntry]]:
+        if header.refreshed_at:
+            self._refreshed_at = header.refreshed_at
+        if header.generation != self._generation:
+            entries = self._reader.entries(header)
+            views: Dict[str, List[DirectoryEntry]] = {}
+            keys: Dict[str, str] = {}
+            for entry in entries:
+                key = keys.get(entry.base_dn)
+                if key is None:
+                    key = keys[entry.base_dn] = normalize_dn(entry.base_dn)
+                views.setdefault(key, []).append(entry)
+            self._entries = views
+            self._uid_index = None
+            self._generation = header.generation
+            forget_narrowing()
+            self._logger.info("Loaded snapshot generation=%s entries=%s", header.generation, len(entries))
+        return self._entries
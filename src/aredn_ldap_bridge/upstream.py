@@ -2,49 +2,147 @@ from __future__ import annotations
 
 import json
 import logging
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPException
+from typing import Dict, List
 from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
+
+from .metrics import UPSTREAM_REQUESTS
+from .util import stable_uid
+
+_READ_CHUNK_SIZE = 65536
+# OSError covers URLError/HTTPError plus resets and read timeouts mid-body;
+# HTTPException covers short reads.
+FETCH_ERRORS = (OSError, HTTPException, ValueError)
+UPSTREAM_MODES = ("failover", "union")
 
 
 class UpstreamClient:
-    def __init__(self, nodes: List[str], timeout_seconds: int, protocol_filter: str) -> None:
+    # Fetches every advertised service; views pick theirs out with
+    # model.services_for_protocol, so one fetch serves them all.
+
+    def __init__(self, nodes: List[str], timeout_seconds: int, mode: str = "failover") -> None:
         self._nodes = nodes
         self._timeout_seconds = timeout_seconds
-        self._protocol_filter = protocol_filter.lower()
+        self._mode = mode
         self._logger = logging.getLogger("aredn_ldap_bridge.upstream")
+        self._lock = threading.Lock()
+        # node -> wall time of its last successful fetch
+        self._last_success: Dict[str, float] = {}
 
     def fetch_services(self) -> List[dict]:
+        if self._mode == "union" and len(self._nodes) > 1:
+            return self._fetch_union()
         last_error: Exception | None = None
         for node in self._nodes:
-            url = f"http://{node}/a/sysinfo?services=1"
-            self._logger.info("Fetching upstream services from %s", url)
             try:
-                request = Request(url)
-                with urlopen(request, timeout=self._timeout_seconds) as response:
-                    raw = response.read()
-                payload = json.loads(raw.decode("utf-8"))
-                services = list(payload.get("services", []) or [])
-                filtered = []
-                for svc in services:
-                    protocol = str(svc.get("protocol", "")).lower()
-                    name = str(svc.get("name", "")).lower()
-                    tag = f"[{self._protocol_filter}]"
-                    if protocol == self._protocol_filter or tag in name:
-                        filtered.append(svc)
-                self._logger.info(
-                    "Upstream %s returned %s services (%s matched protocol=%s)",
-                    node,
-                    len(services),
-                    len(filtered),
-                    self._protocol_filter,
-                )
-                return filtered
-            except (HTTPError, URLError, ValueError) as exc:
+                return self._fetch_node(node)
+            except FETCH_ERRORS as exc:
                 last_error = exc
-                self._logger.warning("Upstream %s failed: %s", node, exc)
                 continue
 
         if last_error is not None:
             raise last_error
         return []
+
+    def node_status(self) -> Dict[str, float]:
+        # Seconds since each node last answered; NaN if it never has.
+        now = time.time()
+        with self._lock:
+            last_success = dict(self._last_success)
+        return {
+            node: now - last_success[node] if node in last_success else float("nan") for node in self._nodes
+        }
+
+    def _fetch_union(self) -> List[dict]:
+        # Partitioned meshes: each node may see a different subset of phones,
+        # so ask all of them at once and merge. Each node's list is folded in
+        # as it arrives and then dropped; only the merged services stay alive.
+        # A duplicate keeps the copy from the node listed first in
+        # upstream_nodes, and the result is in that order too, so the union
+        # does not depend on which node answered first.
+        rank = {node: index for index, node in enumerate(self._nodes)}
+        # One bucket per node, uid -> service in that node's order; `owner`
+        # says which bucket holds each uid. Concatenating the buckets in rank
+        # order gives the result without sorting.
+        buckets: List[Dict[str, dict]] = [{} for _ in self._nodes]
+        owner: Dict[str, int] = {}
+        failed: List[str] = []
+        last_error: Exception | None = None
+        with ThreadPoolExecutor(max_workers=len(self._nodes), thread_name_prefix="upstream") as pool:
+            futures = {pool.submit(self._fetch_node, node): node for node in self._nodes}
+            for future in as_completed(list(futures)):
+                node = futures.pop(future)
+                try:
+                    services = future.result()
+                except FETCH_ERRORS as exc:
+                    failed.append(node)
+                    last_error = exc
+                    continue
+                finally:
+                    # The future holds the node's list; let it go once merged.
+                    del future
+                node_rank = rank[node]
+                bucket = buckets[node_rank]
+                for svc in services:
+                    uid = stable_uid(str(svc.get("ip", "")).strip(), str(svc.get("name", "")).strip())
+                    current = owner.get(uid)
+                    if current is None or node_rank < current:
+                        if current is not None:
+                            del buckets[current][uid]
+                        owner[uid] = node_rank
+                        bucket[uid] = svc
+                del services
+        if len(failed) == len(self._nodes) and last_error is not None:
+            raise last_error
+        if failed:
+            status = self.node_status()
+            self._logger.warning(
+                "Union fetch missing %s of %s nodes: %s",
+                len(failed),
+                len(self._nodes),
+                ", ".join(f"{node} (last success {_format_age(status[node])})" for node in sorted(failed)),
+            )
+        self._logger.info(
+            "Union fetch merged %s unique services from %s nodes", len(owner), len(self._nodes) - len(failed)
+        )
+        return [svc for bucket in buckets for svc in bucket.values()]
+
+    def _fetch_node(self, node: str) -> List[dict]:
+        url = f"http://{node}/a/sysinfo?services=1"
+        self._logger.info("Fetching upstream services from %s", url)
+        try:
+            request = Request(url)
+            deadline = time.monotonic() + self._timeout_seconds
+            with urlopen(request, timeout=self._timeout_seconds) as response:
+                raw = read_body(response, deadline)
+            payload = json.loads(raw.decode("utf-8"))
+            services = list(payload.get("services", []) or [])
+            self._logger.info("Upstream %s returned %s services", node, len(services))
+        except FETCH_ERRORS as exc:
+            UPSTREAM_REQUESTS.inc(node, "failure")
+            self._logger.warning("Upstream %s failed: %s", node, exc)
+            raise
+        UPSTREAM_REQUESTS.inc(node, "success")
+        with self._lock:
+            self._last_success[node] = time.time()
+        return services
+
+
+def read_body(response, deadline: float) -> bytes:
+    # The socket timeout applies per read, so a node trickling its body out
+    # could otherwise hold a refresh far past upstream_timeout_seconds.
+    chunks = []
+    while True:
+        chunk = response.read(_READ_CHUNK_SIZE)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+        if time.monotonic() > deadline:
+            raise TimeoutError("upstream body not received within timeout")
+
+
+def _format_age(seconds: float) -> str:
+    return "never" if seconds != seconds else f"{seconds:.0f}s ago"